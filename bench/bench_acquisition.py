@@ -0,0 +1,238 @@
+# -*- coding: utf-8 -*-
+"""
+Banc de mesure des chemins critiques de l'acquisition et de la relecture.
+
+L'acquisition est pilotee par le backend simule (megaSysteme_simu) en debit maximal : on mesure
+donc la marge dont disposent fn_callback_py, buffer2disque / buffer2buffer, get_data et
+lecture_dat par rapport au debit temps reel du boitier.
+
+Pour chaque configuration (nombre de MEMS, s_pkt, n_tdf, mode disque ou interactif) on releve :
+    - le debit en Mo/s et en echantillons/s,
+    - les percentiles de latence par appel (en microsecondes),
+    - les octets alloues par paquet (tracemalloc, Python 3 uniquement).
+
+usage :
+    python bench/bench_acquisition.py --sortie bench.json
+    python bench/bench_acquisition.py --mems 8 128 --s_pkt 0 262144 --n_tdf 8 16
+"""
+from __future__ import division
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import threading
+import time
+
+REPERTOIRE = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(REPERTOIRE, '..', 'mm'))
+sys.path.append(os.path.join(REPERTOIRE, '..', 'lecture'))
+
+import numpy as np
+import megaSysteme_128 as mega
+from megaSysteme_simu import LibusbSimu
+from lectureDat import lecture_dat, LectureDat
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+horloge = getattr(time, 'perf_counter', time.time)
+
+
+class Chrono():
+    """
+    enveloppe une fonction et enregistre la duree de chaque appel dans un tableau prealloue
+    """
+
+    def __init__(self, fn=None, n_max=100000):
+        self.fn = fn
+        self.durees = np.zeros((n_max,))
+        self.n = 0
+
+    def __call__(self, *args, **kwargs):
+        t0 = horloge()
+        retour = self.fn(*args, **kwargs)
+        duree = horloge() - t0
+        if self.n < len(self.durees):
+            self.durees[self.n] = duree
+        self.n += 1
+        return retour
+
+    def total(self):
+        return float(np.sum(self.durees[:min(self.n, len(self.durees))]))
+
+    def resume(self):
+        """
+        :return: dictionnaire des percentiles de latence en microsecondes
+        """
+        durees = self.durees[:min(self.n, len(self.durees))] * 1e6
+        if not len(durees):
+            return {'appels': 0}
+        p50, p90, p99 = np.percentile(durees, [50, 90, 99])
+        return {'appels': self.n, 'moyenne_us': float(durees.mean()), 'p50_us': float(p50),
+                'p90_us': float(p90), 'p99_us': float(p99), 'max_us': float(durees.max())}
+
+
+class SimuChrono(LibusbSimu):
+    """
+    backend simule qui chronometre le callback complet (trampoline ctypes compris)
+    """
+
+    def __init__(self, **kwargs):
+        LibusbSimu.__init__(self, **kwargs)
+        self.chrono = Chrono()
+
+    def libusb_fill_bulk_transfer(self, transfert, handle, endpoint, buffer, length, callback, user_data, timeout):
+        if callback is not self.chrono:
+            self.chrono.fn = callback
+        LibusbSimu.libusb_fill_bulk_transfer(self, transfert, handle, endpoint, buffer, length,
+                                             self.chrono, user_data, timeout)
+
+
+def matrice_mems(nb_mems):
+    mems = np.zeros((16 * 8,), bool)
+    mems[:nb_mems] = True
+    return mems.reshape((16, 8))
+
+
+def allocations_par_paquet(Mm, simu, n=50):
+    """
+    rejoue n callbacks sous tracemalloc et retourne le pic d'octets alloues par paquet
+    """
+    if tracemalloc is None or not hasattr(tracemalloc, 'reset_peak'):
+        return None
+    transfert = simu.libusb_alloc_transfer(0)
+    transfert.contents.status = simu.LIBUSB_TRANSFER_COMPLETED
+    num_pkt, last_pkt = Mm.num_pkt, Mm.last_pkt
+    pics = []
+    tracemalloc.start()
+    for i in range(n):
+        Mm.num_pkt = i % max(Mm.n_pkt - 1, 1)
+        courant = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        Mm.fn_callback_c(transfert)
+        pics.append(tracemalloc.get_traced_memory()[1] - courant)
+    tracemalloc.stop()
+    # les transferts relances par ces appels ne doivent pas etre traites
+    simu.soumis = []
+    Mm.num_pkt, Mm.last_pkt = num_pkt, last_pkt
+    return float(np.median(pics))
+
+
+def bench_acquisition(nb_mems, s_pkt, n_tdf, interactif, duree, chemin, duree_bloc=0.1):
+    """
+    une acquisition complete en debit maximal
+
+    :return: dictionnaire des mesures
+    """
+    simu = SimuChrono(debit=0)
+    Mm = mega.System128(duree=duree, filename='bench.dat', path=chemin, mems=matrice_mems(nb_mems),
+                        va=np.ones((4,), bool), cpt=1, interactif=interactif, backend=simu,
+                        s_pkt=s_pkt or None, n_tdf=n_tdf)
+    if interactif:
+        Mm.buffer2buffer = chrono_sortie = Chrono(Mm.buffer2buffer)
+        chrono_get_data = Chrono(Mm.get_data)
+        fini = []
+
+        def lecteur():
+            while not fini:
+                res, data = chrono_get_data(duree=duree_bloc)
+                if not res:
+                    time.sleep(0.0005)
+
+        thread = threading.Thread(target=lecteur)
+        thread.start()
+    else:
+        Mm.buffer2disque = chrono_sortie = Chrono(Mm.buffer2disque)
+
+    t0 = horloge()
+    Mm.start()
+    Mm.show()
+    duree_mur = horloge() - t0
+    if interactif:
+        fini.append(True)
+        thread.join()
+
+    octets = Mm.tot
+    echantillons = Mm.COUNT * Mm.nb_voies
+    callback = simu.chrono.total()
+    resultat = {'mode': 'interactif' if interactif else 'disque',
+                'nb_mems': nb_mems,
+                'nb_voies': int(Mm.nb_voies),
+                's_pkt': Mm.s_pkt,
+                'n_tdf': Mm.n_tdf,
+                'n_paquets': Mm.n_pkt,
+                'octets': int(octets),
+                'temps_reel_Mo_s': 4 * Mm.nb_voies * Mm.frequence / 1e6,
+                'debit_Mo_s': octets / duree_mur / 1e6,
+                'debit_callback_Mo_s': octets / callback / 1e6,
+                'echantillons_s': echantillons / callback,
+                'marge': (octets / callback) / (4 * Mm.nb_voies * Mm.frequence),
+                'callback': simu.chrono.resume(),
+                'sortie': chrono_sortie.resume()}
+    if interactif:
+        resultat['get_data'] = chrono_get_data.resume()
+    resultat['alloc_octets_par_paquet'] = allocations_par_paquet(Mm, simu)
+    Mm.close()
+    return resultat
+
+
+def bench_lecture(nomfic, nb_voies, taille_bloc=65536):
+    """
+    relecture complete d'un fichier .dat avec lecture_dat puis LectureDat par blocs
+    """
+    octets = os.path.getsize(nomfic)
+    chrono = Chrono(lecture_dat)
+    chrono(nomfic, nb_voies)
+    resultat = {'octets': octets, 'nb_voies': nb_voies,
+                'lecture_dat_Mo_s': octets / chrono.total() / 1e6}
+    lecteur = LectureDat(nomfic, nb_voies)
+    t0 = horloge()
+    for debut, bloc in lecteur.blocs(taille_bloc):
+        np.sum(bloc[:, 0])
+    resultat['LectureDat_blocs_Mo_s'] = octets / (horloge() - t0) / 1e6
+    lecteur.close()
+    return resultat
+
+
+def main():
+    parser = argparse.ArgumentParser(description="banc de mesure des chemins critiques Megamicros")
+    parser.add_argument('--mems', type=int, nargs='+', default=[1, 8, 32, 64, 128],
+                        help="nombres de MEMS actifs (les 4 voies analogiques et le compteur sont ajoutes)")
+    parser.add_argument('--s_pkt', type=int, nargs='+', default=[0, 262144],
+                        help="tailles de paquets en octets (0 : valeur par defaut de MegaMicros)")
+    parser.add_argument('--n_tdf', type=int, nargs='+', default=[8, 16], help="nombres de transferts en parallele")
+    parser.add_argument('--duree', type=float, default=2., help="duree de chaque acquisition (s)")
+    parser.add_argument('--sortie', default='bench.json', help="fichier json des resultats")
+    args = parser.parse_args()
+
+    chemin = tempfile.mkdtemp()
+    resultats = {'machine': {'python': platform.python_version(), 'numpy': np.__version__,
+                             'plateforme': platform.platform(), 'processeur': platform.processor()},
+                 'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                 'acquisition': [],
+                 'lecture': []}
+    for nb_mems in args.mems:
+        for s_pkt in args.s_pkt:
+            for n_tdf in args.n_tdf:
+                for interactif in (0, 1):
+                    r = bench_acquisition(nb_mems, s_pkt, n_tdf, interactif, args.duree, chemin)
+                    resultats['acquisition'].append(r)
+                    print("%-10s %3d voies  s_pkt %7d  n_tdf %2d : %8.1f Mo/s (callback), marge x%.1f, "
+                          "p99 callback %.0f us" % (r['mode'], r['nb_voies'], r['s_pkt'], r['n_tdf'],
+                                                    r['debit_callback_Mo_s'], r['marge'], r['callback']['p99_us']))
+        nomfic = os.path.join(chemin, 'bench.dat')
+        resultats['lecture'].append(bench_lecture(nomfic, nb_mems + 5))
+        os.remove(nomfic)
+    os.rmdir(chemin)
+
+    with open(args.sortie, 'w') as f:
+        json.dump(resultats, f, indent=2)
+    print("resultats ecrits dans " + args.sortie)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+"""
+Analyse en lot d'une archive de fichiers .dat (int32 entrelaces, cf. buffer2disque).
+
+Chaque fichier est lu par blocs en memoire projetee (LectureDat) : la memoire utilisee ne depend
+pas de la taille des fichiers. Les fichiers sont repartis sur un pool de processus. Pour chaque
+voie on calcule la valeur efficace, la crete, le nombre d'echantillons satures et l'energie dans
+des bandes de frequence.
+
+Le resume est un fichier .npz en colonnes (une ligne par fichier) qui sert aussi de cache : a la
+relance, un fichier dont la taille et la date de modification n'ont pas change n'est pas relu
+(si les parametres d'analyse sont les memes).
+
+usage :
+    python lecture/batchDat.py archive/ --nb_voies 133 --sortie resume.npz
+    python lecture/batchDat.py archive/ --nb_voies 133 --compteur --bandes 0 500 2000 8000 25000 --processus 8
+
+    resume = np.load('resume.npz')
+    resume['fichiers'], resume['rms'][i_fichier, i_voie], resume['energies'][i_fichier, i_bande, i_voie]
+"""
+from __future__ import division
+import argparse
+import multiprocessing
+import os
+import sys
+import time
+import numpy as np
+
+REPERTOIRE = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(REPERTOIRE)
+
+from lectureDat import LectureDat
+
+COLONNES = ('rms', 'crete', 'saturations', 'energies')
+
+
+def analyse_dat(nomfic, nb_voies, frequence=50000., bandes=(0., 25000.), saturation=np.iinfo(np.int32).max,
+                compteur=0, taille_bloc=65536):
+    """
+    statistiques par voie d'un fichier .dat, lu par blocs
+
+    :param nomfic:      [str]   fichier .dat
+    :param nb_voies:    [int]   nombre de voies entrelacees
+    :param frequence:   [float] frequence d'echantillonnage (Hz)
+    :param bandes:      [list]  limites des bandes de frequence (Hz), croissantes
+    :param saturation:  [int]   valeur absolue a partir de laquelle un echantillon est compte comme sature
+    :param compteur:    [int]   flag : la derniere voie est le compteur, elle n'est pas analysee
+    :param taille_bloc: [int]   nombre de tixels lus et transformes a la fois
+    :return: dictionnaire nb_tixels, rms (nb_voies,), crete (nb_voies,), saturations (nb_voies,),
+             energies (nb_bandes, nb_voies) : puissance moyenne de chaque bande (unites des echantillons au carre)
+    """
+    lecteur = LectureDat(nomfic, nb_voies, frequence=frequence)
+    voies = slice(0, nb_voies - 1) if compteur else slice(0, nb_voies)
+    nv = nb_voies - 1 if compteur else nb_voies
+    bandes = np.asarray(bandes, float)
+    freqs = np.fft.rfftfreq(taille_bloc, 1. / frequence)
+    # appartenance des raies aux bandes : l'energie des bandes est un produit matriciel par bloc
+    appartenance = ((freqs[None, :] >= bandes[:-1, None]) & (freqs[None, :] < bandes[1:, None])).astype(np.float64)
+    somme_carres = np.zeros((nv,))
+    crete = np.zeros((nv,), np.int64)
+    saturations = np.zeros((nv,), np.int64)
+    energies = np.zeros((len(bandes) - 1, nv))
+    for debut, bloc in lecteur.blocs(taille_bloc):
+        x = bloc[:, voies]
+        crete = np.maximum(crete, np.maximum(x.max(axis=0).astype(np.int64), -x.min(axis=0).astype(np.int64)))
+        saturations += np.count_nonzero((x >= saturation) | (x <= -saturation), axis=0)
+        xf = x.astype(np.float64)
+        somme_carres += np.einsum('ij,ij->j', xf, xf)
+        # periodogramme du bloc (le dernier bloc, plus court, est complete par des zeros) : par
+        # Parseval, la somme sur toutes les raies est la somme des carres du bloc
+        spectre = np.fft.rfft(xf, n=taille_bloc, axis=0)
+        puissance = spectre.real ** 2 + spectre.imag ** 2
+        puissance[1:taille_bloc - len(freqs) + 1] *= 2
+        energies += np.matmul(appartenance, puissance) / taille_bloc
+    nb_tixels = len(lecteur)
+    lecteur.close()
+    return {'nb_tixels': nb_tixels,
+            'rms': np.sqrt(somme_carres / max(nb_tixels, 1)),
+            'crete': crete,
+            'saturations': saturations,
+            'energies': energies / max(nb_tixels, 1)}
+
+
+def _analyse(tache):
+    """
+    analyse d'un fichier dans un processus du pool
+
+    :return: (chemin, resultat ou None, message d'erreur ou None)
+    """
+    chemin, parametres = tache
+    try:
+        return chemin, analyse_dat(chemin, **parametres), None
+    except (IOError, OSError, ValueError) as e:
+        return chemin, None, str(e)
+
+
+def liste_dat(repertoire, recursif=False):
+    """
+    :return: chemins des fichiers .dat du repertoire, tries
+    """
+    if not recursif:
+        return sorted(os.path.join(repertoire, f) for f in os.listdir(repertoire) if f.endswith('.dat'))
+    chemins = []
+    for racine, _, fichiers in os.walk(repertoire):
+        chemins.extend(os.path.join(racine, f) for f in fichiers if f.endswith('.dat'))
+    return sorted(chemins)
+
+
+def charge_cache(sortie, parametres):
+    """
+    :return: dictionnaire chemin -> (taille, mtime, resultat) du resume precedent, vide si absent
+             ou calcule avec d'autres parametres
+    """
+    if not os.path.exists(sortie):
+        return {}
+    with np.load(sortie) as resume:
+        if str(resume['parametres']) != repr(sorted(parametres.items())):
+            return {}
+        cache = {}
+        for i, chemin in enumerate(resume['fichiers']):
+            resultat = dict((c, resume[c][i]) for c in COLONNES)
+            resultat['nb_tixels'] = int(resume['nb_tixels'][i])
+            cache[str(chemin)] = (int(resume['tailles'][i]), float(resume['mtimes'][i]), resultat)
+    return cache
+
+
+def ecrit_resume(sortie, chemins, signatures, resultats, parametres):
+    """
+    ecriture du resume en colonnes (une ligne par fichier)
+    """
+    colonnes = dict((c, np.array([resultats[ch][c] for ch in chemins])) for c in COLONNES)
+    # ecriture dans un fichier temporaire puis renommage : un resume interrompu n'ecrase pas le cache
+    temporaire = sortie + '.tmp.npz'
+    np.savez(temporaire,
+             fichiers=np.array(chemins),
+             tailles=np.array([signatures[ch][0] for ch in chemins], np.int64),
+             mtimes=np.array([signatures[ch][1] for ch in chemins]),
+             nb_tixels=np.array([resultats[ch]['nb_tixels'] for ch in chemins], np.int64),
+             bandes=np.asarray(parametres['bandes'], float),
+             parametres=np.array(repr(sorted(parametres.items()))),
+             **colonnes)
+    os.rename(temporaire, sortie)
+
+
+def analyse_repertoire(repertoire, sortie, parametres, nb_processus=None, recursif=False, verbose=1):
+    """
+    analyse de tous les fichiers .dat d'un repertoire, avec reprise du cache
+
+    :param repertoire:      [str]  repertoire de l'archive
+    :param sortie:          [str]  resume .npz (lu comme cache s'il existe)
+    :param parametres:      [dict] parametres de analyse_dat (nb_voies, frequence, bandes, saturation, compteur)
+    :param nb_processus:    [int]  taille du pool (par defaut le nombre de coeurs)
+    :param recursif:        [bool] parcours des sous-repertoires
+    :return: (nombre de fichiers analyses, nombre de fichiers repris du cache, erreurs)
+    """
+    chemins = liste_dat(os.path.abspath(repertoire), recursif)
+    cache = charge_cache(sortie, parametres)
+    signatures = {}
+    resultats = {}
+    a_faire = []
+    for chemin in chemins:
+        etat = os.stat(chemin)
+        signatures[chemin] = (etat.st_size, etat.st_mtime)
+        if chemin in cache and cache[chemin][:2] == signatures[chemin]:
+            resultats[chemin] = cache[chemin][2]
+        else:
+            a_faire.append(chemin)
+    erreurs = []
+    if a_faire:
+        pool = multiprocessing.Pool(nb_processus)
+        try:
+            for i, (chemin, resultat, erreur) in enumerate(
+                    pool.imap_unordered(_analyse, [(c, parametres) for c in a_faire])):
+                if erreur is not None:
+                    erreurs.append((chemin, erreur))
+                else:
+                    resultats[chemin] = resultat
+                if verbose:
+                    print("[%d/%d] %s%s" % (i + 1, len(a_faire), chemin, '' if erreur is None else ' : ' + erreur))
+        finally:
+            pool.close()
+            pool.join()
+    chemins = [c for c in chemins if c in resultats]
+    if chemins:
+        ecrit_resume(sortie, chemins, signatures, resultats, parametres)
+    return len(a_faire) - len(erreurs), len(chemins) - len(a_faire) + len(erreurs), erreurs
+
+
+def main():
+    parser = argparse.ArgumentParser(description="analyse en lot de fichiers .dat Megamicros")
+    parser.add_argument('repertoire', help="repertoire des fichiers .dat")
+    parser.add_argument('--nb_voies', type=int, required=True, help="nombre de voies entrelacees (compteur compris)")
+    parser.add_argument('--frequence', type=float, default=50000., help="frequence d'echantillonnage (Hz)")
+    parser.add_argument('--bandes', type=float, nargs='+', default=[0., 500., 2000., 8000., 25000.],
+                        help="limites des bandes de frequence (Hz)")
+    parser.add_argument('--saturation', type=int, default=np.iinfo(np.int32).max,
+                        help="valeur absolue a partir de laquelle un echantillon est sature")
+    parser.add_argument('--compteur', action='store_true', help="la derniere voie est le compteur (non analysee)")
+    parser.add_argument('--taille_bloc', type=int, default=65536, help="tixels lus a la fois")
+    parser.add_argument('--processus', type=int, default=None, help="nombre de processus (defaut : nombre de coeurs)")
+    parser.add_argument('--recursif', action='store_true', help="parcours des sous-repertoires")
+    parser.add_argument('--sortie', default='resume.npz', help="resume en colonnes (sert de cache)")
+    args = parser.parse_args()
+
+    if len(args.bandes) < 2 or np.any(np.diff(args.bandes) <= 0):
+        parser.error("les limites des bandes doivent etre croissantes")
+    parametres = {'nb_voies': args.nb_voies, 'frequence': args.frequence, 'bandes': tuple(args.bandes),
+                  'saturation': args.saturation, 'compteur': int(args.compteur), 'taille_bloc': args.taille_bloc}
+    t0 = time.time()
+    analyses, repris, erreurs = analyse_repertoire(args.repertoire, args.sortie, parametres,
+                                                   nb_processus=args.processus, recursif=args.recursif)
+    print("%d fichiers analyses, %d repris du cache, %d erreurs en %.1f s -> %s"
+          % (analyses, repris, len(erreurs), time.time() - t0, args.sortie))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,8 +1,123 @@
+import os
+import numpy as np
+
+
 def lecture_dat(nomfic, n_channels):
     """
     """
     f = open(nomfic)
     A = np.fromfile(f, dtype = np.int32)
-    sz = np.size(A)/n_channels
-    Data = A.reshape((sz, n_channels))
-    return Data
\ No newline at end of file
+    sz = np.size(A)//n_channels
+    Data = A[:sz * n_channels].reshape((sz, n_channels))
+    return Data
+
+
+class LectureDat():
+    """
+    Lecteur paresseux d'un fichier .dat (int32 entrelaces) base sur np.memmap :
+    seules les pages correspondant aux tixels demandes sont lues sur le disque.
+    """
+
+    def __init__(self, nomfic, n_channels, frequence=50000., dtype=np.int32, carte=None):
+        """
+        :param nomfic:      [str]   fichier .dat ecrit par buffer2disque
+        :param n_channels:  [int]   nombre de voies entrelacees
+        :param frequence:   [float] frequence d'echantillonnage (Hz)
+        :param dtype:       type des echantillons
+        :param carte:       carte des voies de l'acquisition (megaSysteme_voies.CarteVoies) : les voies
+                            peuvent alors etre designees par leur nom ('mems', (faisceau, micro), 'va_0', ...)
+        :return:
+        """
+        self.nomfic = nomfic
+        self.carte = carte
+        self.n_channels = int(n_channels)
+        self.frequence = float(frequence)
+        taille_tixel = np.dtype(dtype).itemsize * self.n_channels
+        taille = os.path.getsize(nomfic)
+        self.nb_tixels = taille // taille_tixel
+        # octets d'un tixel incomplet en fin de fichier (acquisition interrompue) : ignores
+        self.reste = taille % taille_tixel
+        if self.nb_tixels > 0:
+            self.data = np.memmap(nomfic, dtype=dtype, mode='r', shape=(self.nb_tixels, self.n_channels))
+        else:
+            self.data = np.zeros((0, self.n_channels), dtype)
+
+    def __len__(self):
+        return self.nb_tixels
+
+    def __getitem__(self, item):
+        return self.data[item]
+
+    def duree(self):
+        """
+        :return: duree de l'enregistrement en secondes
+        """
+        return self.nb_tixels / self.frequence
+
+    def _voies(self, voies):
+        if voies is None or self.carte is None:
+            return voies
+        return self.carte.selection(voies)
+
+    def _index(self, t):
+        return min(max(int(round(t * self.frequence)), 0), self.nb_tixels)
+
+    def lire(self, t0=0., t1=None, voies=None):
+        """
+        lecture d'une fenetre temporelle pour une selection de voies
+
+        :param t0:      [float] debut de la fenetre (s)
+        :param t1:      [float] fin de la fenetre (s), None pour la fin du fichier
+        :param voies:   [list]  indices (ou noms, cf. carte) des voies a lire, None pour toutes
+        :return: tableau (nb_tixels, nb_voies_lues) en memoire
+        """
+        voies = self._voies(voies)
+        i0 = self._index(t0)
+        i1 = self.nb_tixels if t1 is None else self._index(t1)
+        if voies is None:
+            return np.array(self.data[i0:i1])
+        return self.data[i0:i1, voies]
+
+    def blocs(self, taille, recouvrement=0, voies=None, t0=0., t1=None):
+        """
+        iteration par blocs de taille fixe avec recouvrement (pour le traitement du signal)
+
+        :param taille:          [int]   nombre de tixels par bloc
+        :param recouvrement:    [int]   nombre de tixels communs a deux blocs successifs
+        :param voies:           [list]  indices (ou noms, cf. carte) des voies a lire, None pour toutes
+        :param t0:              [float] debut de la zone a parcourir (s)
+        :param t1:              [float] fin de la zone a parcourir (s), None pour la fin du fichier
+        :return: generateur de (indice du premier tixel, bloc); le dernier bloc peut etre plus court
+        """
+        pas = taille - recouvrement
+        if pas <= 0:
+            raise ValueError("le recouvrement doit etre inferieur a la taille des blocs")
+        voies = self._voies(voies)
+        i0 = self._index(t0)
+        i1 = self.nb_tixels if t1 is None else self._index(t1)
+        debut = i0
+        while debut < i1:
+            fin = min(debut + taille, i1)
+            if voies is None:
+                yield debut, self.data[debut:fin]
+            else:
+                yield debut, self.data[debut:fin, voies]
+            if fin == i1:
+                break
+            debut += pas
+
+    def blocs_voies(self, desentrelaceur, taille, recouvrement=0, t0=0., t1=None):
+        """
+        iteration par blocs rangees par voie (nb_voies_choisies, nb_tixels), chaque voie contigue
+
+        :param desentrelaceur:  megaSysteme_voies.Desentrelaceur des voies a lire (cf. CarteVoies.desentrelaceur)
+        :param taille:          [int]   nombre de tixels par bloc
+        :param recouvrement:    [int]   nombre de tixels communs a deux blocs successifs
+        :return: generateur de (indice du premier tixel, bloc) ; le bloc est reutilise d'une iteration a l'autre
+        """
+        for debut, bloc in self.blocs(taille, recouvrement=recouvrement, t0=t0, t1=t1):
+            yield debut, desentrelaceur.traite(bloc)
+
+    def close(self):
+        # le fichier est ferme quand plus aucune vue ne reference le memmap
+        self.data = None
@@ -1,10 +1,10 @@
 # -*- coding: utf-8 -*-
 from __future__ import division
 import megaSysteme_core as core
-import libusb1
 import numpy as np
 import time
 import ctypes
+import struct
 import sys
 
 if sys.version_info > (3,):
@@ -17,13 +17,22 @@ class version():
 class System128(core.MegaMicros):
     def __init__(self, duree=0.00, filename='toto.dat', path='.',
                  mems=np.ones((16, 8), np.bool), va=np.ones((4), np.bool), cpt=1,
-                 clockdiv=9, interactif=0, verbose=0):
+                 clockdiv=9, interactif=0, verbose=0, politique='drop_oldest',
+                 ecriture_async=0, fsync_interval=0., backend=None, s_pkt=None, n_tdf=8,
+                 autotune=0, latence=0.01, reserve=0.1, format='dat', codec=None, decimation=1,
+                 continu=0, duree_fichier=0., taille_fichier=0, duree_buffer=5.,
+                 bus=None, port=None, serial=None):
 
         core.MegaMicros.__init__(self, duree=duree, filename=filename, path=path,
                  mems=mems, va=va, cpt=cpt,
-                 clockdiv=clockdiv, interactif=interactif, verbose=verbose, addr=0x82)
-
-        self.usbh = core.usb2(my_vid=0xFE27, my_pid=0xAC00)
+                 clockdiv=clockdiv, interactif=interactif, verbose=verbose, addr=0x82,
+                 politique=politique, ecriture_async=ecriture_async, fsync_interval=fsync_interval,
+                 backend=backend, s_pkt=s_pkt, n_tdf=n_tdf,
+                 autotune=autotune, latence=latence, reserve=reserve, format=format, codec=codec,
+                 decimation=decimation, continu=continu, duree_fichier=duree_fichier,
+                 taille_fichier=taille_fichier, duree_buffer=duree_buffer)
+
+        self.usbh = core.usb2(my_vid=0xFE27, my_pid=0xAC00, lib=self.lib, bus=bus, port=port, serial=serial)
         self.init_module128()
         self.init_transfert_usb()
         self.version = 128
@@ -54,20 +63,14 @@ class System128(core.MegaMicros):
 
         # init acq128 (clockdiv)
         buf[0] = b'\x01'  # commande init
-        buf[1] = b'\x09'  # clockdiv=9
+        buf[1] = struct.pack('B', self.clockdiv)  # clockdiv (9 : 50kHz), coherent avec self.frequence
         self.usbh.write_command(0xB1, buf, 2)
 
         # attente
         time.sleep(1)  # nécessaire pour que les MEMS soient bien démarrés...
 
         # Nombre de tixels à acquérir (COUNT )
-        c = long(self.COUNT)
-        buf[0] = b'\x04'  # commande COUNT
-        buf[1] = chr(c & 0x000000ff)
-        buf[2] = chr((c & 0x0000ff00) >> 8)
-        buf[3] = chr((c & 0x00ff0000) >> 16)
-        buf[4] = chr((c & 0xff000000) >> 24)
-        self.usbh.write_command(0xB4, buf, 5)
+        self.envoie_count()
 
         # Choix DataType
         buf[0] = b'\x09'
@@ -91,6 +94,28 @@ class System128(core.MegaMicros):
 
         print("initialisation de la carte Mm .................. ok")
 
+    def envoie_count(self):
+        """
+        programme le nombre de tixels a acquerir (COUNT)
+        """
+        buf = ctypes.create_string_buffer(16)
+        c = long(self.COUNT)
+        buf[0] = b'\x04'  # commande COUNT
+        buf[1:5] = struct.pack('<I', c & 0xffffffff)  # octet de poids faible en premier
+        self.usbh.write_command(0xB4, buf, 5)
+
+    def rearme(self):
+        """
+        acquisition continue : le boitier s'est arrete apres COUNT tixels, il est reprogramme et relance
+        pour un nouveau segment. Les transferts en attente recoivent les tixels du nouveau segment ;
+        l'interruption (quelques ms, non mesurable sur les donnees) est notee dans self.rearmements et
+        le compteur du boitier repart de zero.
+        """
+        self.a_rearmer = False
+        self.rearmements.append(((len(self.rearmements) + 1) * self.COUNT, time.time()))
+        self.envoie_count()
+        self.start()
+
     def reset_fifo(self):
         # reset FIFOs
         msg = b'\x00'
@@ -107,9 +132,20 @@ class System128(core.MegaMicros):
 
     def close(self):
         if self.filename and self.interactif == 0:
-            self.Filep.close()
+            if self.ecriture_async == 1:
+                self.writer.close()
+            else:
+                self.Filep.close()
+        if self.stats is not None:
+            self.stats.close()
+        if self.declencheur is not None:
+            self.declencheur.close()
+        if self.serveur is not None:
+            self.serveur.close()
+        if self.interactif == 1:
+            self.ring.libere()
         for i in range(self.n_tdf):
-            libusb1.libusb_free_transfer(self.transfert[i])
+            self.lib.libusb_free_transfer(self.transfert[i])
         self.reset_fifo()
         time.sleep(1)
         self.usbh.close()
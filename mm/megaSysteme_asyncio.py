@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+"""
+Interface asyncio du mode interactif (Python 3 uniquement).
+
+La boucle libusb (show) tourne dans un thread, la boucle asyncio dans le thread principal.
+Le callback ne reveille le consommateur que lorsqu'un bloc complet est disponible, par
+call_soon_threadsafe : il n'y a aucune attente active.
+
+    Mm = System128(duree=60., interactif=1, politique='block')
+
+    async def main():
+        acquisition = asyncio.ensure_future(lance(Mm))
+        async for bloc in Mm.stream(0.1):
+            ...
+        await acquisition
+
+Contre-pression : avec politique='block', le callback attend (au plus un quart de paquet) que le
+consommateur ait lu avant de rejeter des donnees ; avec 'drop_oldest', les debordements sont
+comptes dans Mm.ring.
+
+Le flux est lie a la boucle asyncio en cours : Mm.stream() s'appelle depuis une coroutine, ou
+recoit la boucle explicitement (loop=...).
+Mm.stop() termine l'acquisition, puis l'iteration une fois les blocs restants lus.
+"""
+import asyncio
+
+
+class FluxAsync():
+    """
+    Iterateur asynchrone des blocs de get_data, reveille par le callback
+    """
+
+    def __init__(self, Mm, duree_bloc, copie=True, loop=None):
+        """
+        :param Mm:          objet MegaMicros en mode interactif
+        :param duree_bloc:  [float] duree des blocs (s)
+        :param copie:       [bool]  copier les blocs hors du buffer circulaire
+        :param loop:        boucle asyncio (par defaut la boucle en cours d'execution : le flux est alors
+                            cree dans une coroutine)
+        """
+        if Mm.interactif != 1:
+            raise ValueError("le flux asyncio necessite le mode interactif")
+        self.Mm = Mm
+        self.duree_bloc = duree_bloc
+        self.nb_tixels = int(duree_bloc * Mm.frequence_sortie)
+        self.copie = copie
+        self.loop = asyncio.get_running_loop() if loop is None else loop
+        self.evenement = asyncio.Event()
+        self.en_attente = False     # le consommateur attend un bloc (ecrit par la boucle asyncio)
+        self.termine = False        # l'acquisition est terminee (ecrit par le thread de show)
+        Mm.ajoute_observateur(self)
+
+    # ------------------------------------------------------------------
+    # cote callback (thread de show)
+    # ------------------------------------------------------------------
+    def paquet(self, bloc):
+        if self.en_attente and self.Mm.ring.available() >= self.nb_tixels:
+            self.en_attente = False
+            self.loop.call_soon_threadsafe(self.evenement.set)
+
+    def fin(self):
+        self.termine = True
+        self.loop.call_soon_threadsafe(self.evenement.set)
+
+    # ------------------------------------------------------------------
+    # cote asyncio
+    # ------------------------------------------------------------------
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        while True:
+            res, data = self.Mm.get_data(self.duree_bloc)
+            if res == 1:
+                return data.copy() if self.copie else data
+            if self.termine:
+                self.close()
+                raise StopAsyncIteration
+            # on se declare en attente avant de reverifier : un paquet arrive entre les deux
+            # verifications reveillera le consommateur
+            self.evenement.clear()
+            self.en_attente = True
+            if self.Mm.ring.available() >= self.nb_tixels or self.termine:
+                self.en_attente = False
+                continue
+            try:
+                await self.evenement.wait()
+            except asyncio.CancelledError:
+                self.close()
+                raise
+
+    def close(self):
+        """
+        detache le flux de l'objet MegaMicros
+        """
+        self.en_attente = False
+        self.Mm.retire_observateur(self)
+
+
+async def lance(Mm):
+    """
+    demarre l'acquisition et execute la boucle libusb (show) dans un thread de l'executeur par defaut
+
+    :param Mm: objet MegaMicros
+    """
+    loop = asyncio.get_running_loop()
+    Mm.start()
+    await loop.run_in_executor(None, Mm.show)
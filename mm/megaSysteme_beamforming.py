@@ -0,0 +1,370 @@
+# -*- coding: utf-8 -*-
+"""
+Formation de voies (delay-and-sum) dans le domaine frequentiel sur le reseau de MEMS.
+
+Chaque bloc retourne par get_data est decoupe en trames de nfft tixels, transforme par une
+seule FFT reelle sur toutes les trames et toutes les voies, puis projete sur les vecteurs de
+pointage de toutes les directions par un produit matriciel par frequence :
+
+    Y[f, d, t] = sum_m W[f, d, m] X[f, m, t]      P[d] = sum_{f, t} |Y[f, d, t]|^2
+
+Les poids W ne dependent que de la geometrie, des directions et de nfft : ils sont calcules
+une fois et conserves en cache.
+
+La localisation SRP-PHAT (SrpPhat) somme, pour chaque direction, les correlations GCC-PHAT de
+toutes les paires de micros lues au decalage attendu pour cette direction :
+
+    G[p, f] = sum_t X[f, i_p, t] X*[f, j_p, t]      R[p] = irfft(G[p] / |G[p]|)
+    P[d] = sum_p R[p, tdoa[d, p]]
+
+Les interspectres de toutes les paires sont obtenus par un produit matriciel par frequence, les
+correlations par une irfft par lot de paires, et les decalages tdoa (echantillons sur-echantillonnes)
+sont des tables calculees une fois par grille et partagees entre les instances.
+"""
+from __future__ import division
+import hashlib
+import threading
+import numpy as np
+
+C_SON = 343.  # celerite du son dans l'air (m/s)
+_TABLES_SRP = {}  # tables de decalages SRP-PHAT par grille (cf. tables_srp)
+
+
+def positions_mems(mems, ecart_micros=0.05, ecart_faisceaux=0.05):
+    """
+    positions des MEMS actifs dans le plan du reseau, dans l'ordre des voies d'acquisition
+
+    :param mems:            [bool np.array(16,8)] MEMS actifs
+    :param ecart_micros:    [float] distance (m) entre deux micros d'un meme faisceau
+    :param ecart_faisceaux: [float] distance (m) entre deux faisceaux
+    :return: np.array (nb_mems, 3) des positions en metres, centrees sur le barycentre
+    """
+    faisceaux, micros = np.nonzero(np.asarray(mems))
+    positions = np.zeros((len(faisceaux), 3))
+    positions[:, 0] = micros * ecart_micros
+    positions[:, 1] = faisceaux * ecart_faisceaux
+    return positions - positions.mean(axis=0)
+
+
+def grille_directions(n_azimut=72, n_elevation=19):
+    """
+    grille de directions d'arrivee sur le demi-espace devant le reseau
+
+    :param n_azimut:    [int] nombre d'azimuts entre 0 et 360 degres
+    :param n_elevation: [int] nombre d'elevations entre 0 et 90 degres
+    :return: (directions np.array (n_elevation * n_azimut, 3) de vecteurs unitaires, forme de la grille)
+    """
+    azimut = np.linspace(0, 2 * np.pi, n_azimut, endpoint=False)
+    elevation = np.linspace(0, np.pi / 2, n_elevation)
+    el, az = np.meshgrid(elevation, azimut, indexing='ij')
+    directions = np.stack([np.cos(el) * np.cos(az), np.cos(el) * np.sin(az), np.sin(el)], axis=-1)
+    return directions.reshape((-1, 3)), (n_elevation, n_azimut)
+
+
+class Beamformer():
+    """
+    Formation de voies delay-and-sum vectorisee (FFT par lots et produit matriciel par frequence)
+    """
+
+    def __init__(self, positions, directions, frequence, nfft=512, bande=(500., 8000.), colonnes=None,
+                 forme=None, c=C_SON):
+        """
+        :param positions:   [np.array (nb_mems, 3)] positions des micros (m)
+        :param directions:  [np.array (nb_dir, 3)]  vecteurs unitaires des directions de pointage
+        :param frequence:   [float] frequence d'echantillonnage (Hz)
+        :param nfft:        [int]   taille des trames
+        :param bande:       [tuple] bande de frequences (Hz) prise en compte dans la puissance
+        :param colonnes:    [list]  colonnes des MEMS dans les blocs de get_data (par defaut les premieres)
+        :param forme:       [tuple] forme de la carte de puissance retournee (par defaut (nb_dir,))
+        :param c:           [float] celerite du son (m/s)
+        :return:
+        """
+        self.positions = np.asarray(positions, np.float64)
+        self.directions = np.asarray(directions, np.float64)
+        self.frequence = float(frequence)
+        self.nfft = int(nfft)
+        self.bande = bande
+        self.c = c
+        if colonnes is None:
+            colonnes = np.arange(len(self.positions))
+        self.colonnes = np.asarray(colonnes)
+        self.forme = (len(self.directions),) if forme is None else forme
+        # retards de propagation (s) : (nb_dir, nb_mems)
+        self.retards = np.dot(self.directions, self.positions.T) / self.c
+        self._cache = {}
+        self.fenetre = np.hanning(self.nfft).astype(np.float32)
+        self.bins_bande = self.bins(self.nfft)     # frequences de la bande pour nfft
+
+    def bins(self, nfft):
+        """
+        :return: indices des frequences de la bande pour une taille de trame donnee
+        """
+        freqs = np.fft.rfftfreq(nfft, 1. / self.frequence)
+        return np.nonzero((freqs >= self.bande[0]) & (freqs <= self.bande[1]))[0]
+
+    def poids(self, nfft):
+        """
+        vecteurs de pointage pour une taille de trame donnee (calcules une seule fois)
+
+        :return: (indices des frequences retenues, W np.array complex64 (nb_freq, nb_dir, nb_mems))
+        """
+        if nfft not in self._cache:
+            freqs = np.fft.rfftfreq(nfft, 1. / self.frequence)
+            bins = self.bins(nfft)
+            phase = -2j * np.pi * freqs[bins][:, None, None] * self.retards[None, :, :]
+            W = (np.exp(phase) / len(self.positions)).astype(np.complex64)
+            self._cache[nfft] = (bins, W)
+        return self._cache[nfft]
+
+    def spectres(self, bloc):
+        """
+        FFT par lots de toutes les trames et de toutes les voies d'un bloc
+
+        :param bloc: [np.array (nb_tixels, nb_voies)] bloc retourne par get_data
+        :return: X np.array complex64 (nb_freq, nb_mems, nb_trames) restreint a la bande
+        """
+        n_trames = len(bloc) // self.nfft
+        if n_trames == 0:
+            raise ValueError("bloc plus court qu'une trame (" + str(self.nfft) + " tixels)")
+        x = bloc[:n_trames * self.nfft, self.colonnes].astype(np.float32)
+        x = x.reshape((n_trames, self.nfft, len(self.colonnes)))
+        x -= x.mean(axis=1, keepdims=True)
+        x *= self.fenetre[None, :, None]
+        X = np.fft.rfft(x, axis=1)[:, self.bins_bande, :]
+        # (nb_trames, nb_freq, nb_mems) -> (nb_freq, nb_mems, nb_trames) pour le produit matriciel
+        return np.ascontiguousarray(X.transpose((1, 2, 0)), dtype=np.complex64)
+
+    def traite(self, bloc):
+        """
+        carte de puissance d'un bloc
+
+        :param bloc: [np.array (nb_tixels, nb_voies)] bloc retourne par get_data
+        :return: np.array (forme) puissance par direction
+        """
+        X = self.spectres(bloc)
+        bins, W = self.poids(self.nfft)
+        Y = np.matmul(W, X)  # (nb_freq, nb_dir, nb_trames)
+        puissance = (Y.real ** 2 + Y.imag ** 2).sum(axis=(0, 2))
+        return puissance.reshape(self.forme)
+
+    def traite_spectres(self, spectres):
+        """
+        carte de puissance a partir de trames deja transformees (cf. megaSysteme_stft), sans nouvelle FFT
+
+        :param spectres: [np.array (nb_trames, nfft // 2 + 1, nb_mems)] trames d'une StreamingSTFT de meme nfft
+                         dont les voies sont les MEMS dans l'ordre des positions
+        :return: np.array (forme) puissance par direction
+        """
+        bins, W = self.poids((spectres.shape[1] - 1) * 2)
+        X = np.ascontiguousarray(spectres[:, bins, :len(self.positions)].transpose((1, 2, 0)), dtype=np.complex64)
+        Y = np.matmul(W, X)
+        puissance = (Y.real ** 2 + Y.imag ** 2).sum(axis=(0, 2))
+        return puissance.reshape(self.forme)
+
+    def direction_max(self, puissance):
+        """
+        :return: vecteur unitaire de la direction de puissance maximale
+        """
+        return self.directions[np.argmax(puissance)]
+
+
+def beamformer_megamicros(Mm, directions=None, forme=None, ecart_micros=0.05, ecart_faisceaux=0.05, **kwargs):
+    """
+    construit un Beamformer a partir de la configuration d'un objet MegaMicros
+
+    :param Mm:          objet MegaMicros (mems, frequence)
+    :param directions:  [np.array (nb_dir, 3)] directions de pointage (par defaut grille_directions())
+    :return: Beamformer
+    """
+    if directions is None:
+        directions, forme = grille_directions()
+    positions = positions_mems(Mm.mems, ecart_micros=ecart_micros, ecart_faisceaux=ecart_faisceaux)
+    return Beamformer(positions, directions, Mm.frequence_sortie, colonnes=Mm.index_mems(), forme=forme, **kwargs)
+
+
+def tables_srp(retards, paires, frequence, interpolation, taille_lot):
+    """
+    tables des decalages de chaque paire pour chaque direction, par lots de paires, calculees une
+    seule fois par grille (geometrie, directions, frequence) et partagees entre les instances
+
+    :param retards:         [np.array (nb_dir, nb_mems)] retards de propagation (s)
+    :param paires:          [np.array (nb_paires, 2)] micros (i, j) de chaque paire
+    :param frequence:       [float] frequence d'echantillonnage (Hz)
+    :param interpolation:   [int] facteur de sur-echantillonnage des correlations
+    :param taille_lot:      [int] nombre de paires par lot
+    :return: (L, lots) : decalage maximal L (echantillons sur-echantillonnes) et liste de
+             (debut, fin, index) ou index np.array int32 (nb_dir, fin - debut) donne la position a plat,
+             dans les correlations du lot restreintes aux decalages -L..L (fin - debut, 2L + 1), de la
+             valeur de chaque paire pour chaque direction
+    """
+    cle = hashlib.sha1(np.ascontiguousarray(retards).tobytes() + np.ascontiguousarray(paires).tobytes() +
+                       repr((float(frequence), int(interpolation), int(taille_lot))).encode()).hexdigest()
+    if cle not in _TABLES_SRP:
+        echelle = frequence * interpolation
+        # les micros recoivent l'onde a -retards : la correlation de la paire (i, j) culmine en t_i - t_j
+        decalages = [np.rint((retards[:, paires[debut:debut + taille_lot, 1]] -
+                              retards[:, paires[debut:debut + taille_lot, 0]]) * echelle).astype(np.int32)
+                     for debut in range(0, len(paires), taille_lot)]
+        L = max([int(np.abs(d).max()) for d in decalages if d.size] + [0])
+        largeur = 2 * L + 1
+        lots = []
+        for k, d in enumerate(decalages):
+            debut = k * taille_lot
+            d += L
+            d += np.arange(d.shape[1], dtype=np.int32)[None, :] * largeur
+            lots.append((debut, debut + d.shape[1], d))
+        _TABLES_SRP[cle] = (L, lots)
+    return _TABLES_SRP[cle]
+
+
+class SrpPhat(Beamformer):
+    """
+    Localisation de sources SRP-PHAT (GCC-PHAT par lots de paires et tables de decalages en cache)
+    """
+
+    def __init__(self, positions, directions, frequence, nfft=512, bande=(500., 8000.), colonnes=None,
+                 forme=None, c=C_SON, interpolation=4, distance_max=None, taille_lot=1024, nb_threads=0):
+        """
+        :param positions:       [np.array (nb_mems, 3)] positions des micros (m)
+        :param directions:      [np.array (nb_dir, 3)]  vecteurs unitaires des directions testees
+        :param frequence:       [float] frequence d'echantillonnage (Hz)
+        :param nfft:            [int]   taille des trames
+        :param bande:           [tuple] bande de frequences (Hz) prise en compte
+        :param colonnes:        [list]  colonnes des MEMS dans les blocs de get_data (par defaut les premieres)
+        :param forme:           [tuple] forme de la carte retournee (par defaut (nb_dir,))
+        :param c:               [float] celerite du son (m/s)
+        :param interpolation:   [int]   sur-echantillonnage des correlations (precision des decalages)
+        :param distance_max:    [float] seules les paires plus proches que distance_max (m) sont utilisees,
+                                        None pour toutes : le cout est proportionnel au nombre de paires
+        :param taille_lot:      [int]   nombre de paires traitees a la fois (memoire des correlations)
+        :param nb_threads:      [int]   nombre de threads se partageant les lots (0 : pas de pool)
+        :return:
+        """
+        Beamformer.__init__(self, positions, directions, frequence, nfft=nfft, bande=bande, colonnes=colonnes,
+                            forme=forme, c=c)
+        i, j = np.triu_indices(len(self.positions), 1)
+        if distance_max is not None:
+            garde = np.linalg.norm(self.positions[i] - self.positions[j], axis=1) <= distance_max
+            i, j = i[garde], j[garde]
+        self.paires = np.stack([i, j], axis=1)
+        self.interpolation = int(interpolation)
+        self.n_correlation = self.nfft * self.interpolation
+        self.L, self.lots = tables_srp(self.retards, self.paires, self.frequence, self.interpolation,
+                                       int(taille_lot))
+        if 2 * self.L + 1 > self.n_correlation:
+            raise ValueError("trames trop courtes pour l'ouverture du reseau : nfft >= " +
+                             str(2 * self.L // self.interpolation + 1) + " tixels")
+        # spectre de correlation d'un lot, un par thread : hors de la bande il reste nul
+        self._local = threading.local()
+        self.executeur = None
+        if nb_threads > 1:
+            # numpy relache le GIL pendant les FFT et les lectures des tables
+            from concurrent.futures import ThreadPoolExecutor
+            self.executeur = ThreadPoolExecutor(int(nb_threads))
+
+    def _lot(self, C, debut, fin, index):
+        """
+        contribution d'un lot de paires a la carte
+
+        :param C: [np.array complex64 (nb_freq, nb_mems, nb_mems)] matrices interspectrales de la bande
+        :return: np.array (nb_dir,)
+        """
+        G = C[:, self.paires[debut:fin, 0], self.paires[debut:fin, 1]].T
+        spectre = getattr(self._local, 'spectre', None)
+        if spectre is None:
+            taille_lot = max(f - d for d, f, _ in self.lots)
+            spectre = self._local.spectre = np.zeros((taille_lot, self.n_correlation // 2 + 1), np.complex64)
+        spectre = spectre[:fin - debut]
+        spectre[:, self.bins_bande] = G / np.maximum(np.abs(G), 1e-30)
+        r = np.fft.irfft(spectre, n=self.n_correlation, axis=1)
+        # decalages -L..L : les decalages negatifs sont a la fin de la correlation circulaire
+        r = np.concatenate((r[:, self.n_correlation - self.L:], r[:, :self.L + 1]), axis=1)
+        return np.take(r.ravel(), index).sum(axis=1)
+
+    def carte(self, X):
+        """
+        :param X: [np.array complex64 (nb_freq, nb_mems, nb_trames)] spectres de la bande (cf. spectres())
+        :return: np.array (forme) puissance SRP-PHAT par direction
+        """
+        C = np.matmul(X, X.conj().transpose((0, 2, 1)))
+        if self.executeur is None:
+            contributions = [self._lot(C, *lot) for lot in self.lots]
+        else:
+            contributions = list(self.executeur.map(lambda lot: self._lot(C, *lot), self.lots))
+        return np.sum(contributions, axis=0).reshape(self.forme)
+
+    def traite(self, bloc):
+        """
+        carte SRP-PHAT d'un bloc
+
+        :param bloc: [np.array (nb_tixels, nb_voies)] bloc retourne par get_data (au moins nfft tixels)
+        :return: np.array (forme) puissance par direction
+        """
+        return self.carte(self.spectres(bloc))
+
+    def traite_spectres(self, spectres):
+        """
+        carte SRP-PHAT a partir de trames deja transformees (cf. megaSysteme_stft), sans nouvelle FFT
+
+        :param spectres: [np.array (nb_trames, nfft // 2 + 1, nb_mems)] trames d'une StreamingSTFT de meme nfft
+        :return: np.array (forme) puissance par direction
+        """
+        if (spectres.shape[1] - 1) * 2 != self.nfft:
+            raise ValueError("trames de taille differente de nfft = " + str(self.nfft))
+        X = spectres[:, self.bins_bande, :len(self.positions)].transpose((1, 2, 0))
+        return self.carte(np.ascontiguousarray(X, dtype=np.complex64))
+
+    def pics(self, carte, nb_pics=1, exclusion=10.):
+        """
+        maxima de la carte, separes d'au moins 'exclusion' degres
+
+        :param carte:       [np.array (forme)] carte retournee par traite
+        :param nb_pics:     [int]   nombre de sources cherchees
+        :param exclusion:   [float] ecart angulaire minimal (degres) entre deux pics
+        :return: (directions np.array (nb_pics, 3), valeurs (nb_pics,), indices dans la carte a plat)
+        """
+        valeurs = np.asarray(carte, np.float64).ravel()
+        reste = valeurs.copy()
+        cos_min = np.cos(np.radians(exclusion))
+        indices = []
+        for _ in range(nb_pics):
+            k = int(np.argmax(reste))
+            if not np.isfinite(reste[k]):
+                break
+            indices.append(k)
+            reste[np.dot(self.directions, self.directions[k]) >= cos_min] = -np.inf
+        indices = np.asarray(indices, int)
+        return self.directions[indices], valeurs[indices], indices
+
+    def localise(self, bloc, nb_pics=1, exclusion=10.):
+        """
+        :param bloc: [np.array (nb_tixels, nb_voies)] bloc retourne par get_data
+        :return: (carte, directions des pics, valeurs des pics) (cf. traite et pics)
+        """
+        carte = self.traite(bloc)
+        directions, valeurs, _ = self.pics(carte, nb_pics, exclusion)
+        return carte, directions, valeurs
+
+    def close(self):
+        if self.executeur is not None:
+            self.executeur.shutdown()
+
+    def __str__(self):
+        chaine = "SRP-PHAT : " + str(len(self.positions)) + " micros, " + str(len(self.paires)) + " paires, " + \
+                 str(len(self.directions)) + " directions, decalages +/- " + str(self.L) + " (x" + \
+                 str(self.interpolation) + ")"
+        return chaine
+
+
+def srp_megamicros(Mm, directions=None, forme=None, ecart_micros=0.05, ecart_faisceaux=0.05, **kwargs):
+    """
+    construit un SrpPhat a partir de la configuration d'un objet MegaMicros
+
+    :param Mm:          objet MegaMicros (mems, frequence)
+    :param directions:  [np.array (nb_dir, 3)] directions testees (par defaut grille_directions())
+    :return: SrpPhat
+    """
+    if directions is None:
+        directions, forme = grille_directions()
+    positions = positions_mems(Mm.mems, ecart_micros=ecart_micros, ecart_faisceaux=ecart_faisceaux)
+    return SrpPhat(positions, directions, Mm.frequence_sortie, colonnes=Mm.index_mems(), forme=forme, **kwargs)
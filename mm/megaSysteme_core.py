@@ -20,26 +20,57 @@ SUBSYSTEM=="usb", ATTRS{idVendor}=="fe27", ATTRS{idProduct}=="ac00", MODE="0666"
 3) sudo udevadm trigger (pour reloader les rules)
 """
 from __future__ import division
-import libusb1
 import numpy as np
+import collections
 import time
 import ctypes
 import struct
 import sys
+from megaSysteme_ring import RingBuffer, OverrunError
+from megaSysteme_writer import DiskWriter
+from megaSysteme_stft import StreamingSTFT
+from megaSysteme_format import ChunkWriter
+from megaSysteme_integrite import VerifCompteur
+from megaSysteme_stats import StatsCallback
+from megaSysteme_decimation import Decimateur
+from megaSysteme_voies import CarteVoies
+from megaSysteme_declenchement import Declencheur, EnregistreurEvenements
+from megaSysteme_enveloppe import Enveloppe
+from megaSysteme_serveur import ServeurFlux
+from megaSysteme_sante import SanteVoies
+
+try:
+    import libusb1
+except ImportError:
+    # sans libusb1, seul un backend simule (cf. megaSysteme_simu) est utilisable
+    libusb1 = None
+
+try:
+    from math import gcd
+except ImportError:
+    from fractions import gcd
 
 NULL = None
 
 if sys.version_info > (3,):
     long = int
 
+COUNT_MAX = 0xFFFFFFFF  # nombre maximal de tixels d'une acquisition (compteur 32 bits du boitier)
+PKT_INFINI = 1 << 62    # nombre de paquets d'une acquisition continue (arretee par stop())
+
 class usb():
     """
     Class générique contenant les commandes de gestion de l'USB
     """
 
-    def __init__(self, my_vid=0xFE27, my_pid=0xAC00):
+    def __init__(self, my_vid=0xFE27, my_pid=0xAC00, lib=None, bus=None, port=None, serial=None):
         self.my_vid = my_vid
         self.my_pid = my_pid
+        self.lib = libusb1 if lib is None else lib
+        # selection d'un boitier parmi plusieurs boitiers identiques (cf. ouvre_selection)
+        self.bus = bus
+        self.port = port
+        self.serial = serial
         self.initialisation()
         self.LIBUSB_RECIPIENT_DEVICE = 0x00
         self.LIBUSB_REQUEST_TYPE_VENDOR = 0x02 << 5
@@ -54,12 +85,79 @@ class usb():
         :return: un handle sur la liaison usb (self.handle)
         """
         print('Initialisation usb')
-        libusb1.libusb_init(NULL)
-        libusb1.libusb_set_debug(NULL, 3)
-        self.handle = libusb1.libusb_open_device_with_vid_pid(NULL, self.my_vid, self.my_pid)
-        libusb1.libusb_claim_interface(self.handle, 0)
+        self.lib.libusb_init(NULL)
+        self.lib.libusb_set_debug(NULL, 3)
+        if self.bus is None and self.port is None and self.serial is None:
+            self.handle = self.lib.libusb_open_device_with_vid_pid(NULL, self.my_vid, self.my_pid)
+        else:
+            self.handle = self.ouvre_selection()
+        self.lib.libusb_claim_interface(self.handle, 0)
         print('Initialisation usb  ........  ok')
 
+    def liste_peripheriques(self):
+        """
+        liste des boitiers branches ayant le vid/pid attendu
+
+        :return: liste de dictionnaires {'bus', 'port', 'serial', 'device'}
+        """
+        if hasattr(self.lib, 'liste_peripheriques'):
+            # backend simule
+            return self.lib.liste_peripheriques(self.my_vid, self.my_pid)
+        lib = self.lib
+        self._liste = ctypes.POINTER(lib.libusb_device_p)()
+        n = lib.libusb_get_device_list(NULL, ctypes.byref(self._liste))
+        peripheriques = []
+        for i in range(n):
+            device = self._liste[i]
+            desc = lib.libusb_device_descriptor()
+            lib.libusb_get_device_descriptor(device, ctypes.byref(desc))
+            if desc.idVendor != self.my_vid or desc.idProduct != self.my_pid:
+                continue
+            serial = None
+            handle = lib.libusb_device_handle_p()
+            if desc.iSerialNumber and lib.libusb_open(device, ctypes.byref(handle)) == lib.LIBUSB_SUCCESS:
+                texte = ctypes.create_string_buffer(64)
+                n_car = lib.libusb_get_string_descriptor_ascii(handle, desc.iSerialNumber, texte, 64)
+                if n_car > 0:
+                    serial = texte.raw[:n_car].decode('ascii')
+                lib.libusb_close(handle)
+            peripheriques.append({'bus': lib.libusb_get_bus_number(device),
+                                  'port': lib.libusb_get_port_number(device),
+                                  'serial': serial,
+                                  'device': device})
+        return peripheriques
+
+    def ouvre_selection(self):
+        """
+        ouverture du boitier designe par bus/port ou par numero de serie
+
+        :return: handle du boitier
+        """
+        self._liste = None
+        try:
+            choix = None
+            for periph in self.liste_peripheriques():
+                if (self.bus is None or periph['bus'] == self.bus) and \
+                        (self.port is None or periph['port'] == self.port) and \
+                        (self.serial is None or periph['serial'] == self.serial):
+                    choix = periph
+                    break
+            if choix is None:
+                raise IOError("aucun boitier Megamicros pour bus=" + str(self.bus) + " port=" + str(self.port) +
+                              " serial=" + str(self.serial))
+            if hasattr(self.lib, 'ouvre_peripherique'):
+                return self.lib.ouvre_peripherique(choix['device'])
+            handle = self.lib.libusb_device_handle_p()
+            retour = self.lib.libusb_open(choix['device'], ctypes.byref(handle))
+            if retour:
+                raise IOError("Erreur " + str(retour) + " a l'ouverture du boitier")
+            return handle
+        finally:
+            # le handle garde une reference sur le peripherique : la liste est liberee dans tous les cas
+            if self._liste is not None:
+                self.lib.libusb_free_device_list(self._liste, 1)
+                self._liste = None
+
     def close(self):
         """
         fermeture de la liaison usb
@@ -67,9 +165,9 @@ class usb():
         :return:
         """
         print ('* fermeture de la liaison usb *')
-        libusb1.libusb_release_interface(self.handle, 0)
-        libusb1.libusb_close(self.handle)
-        libusb1.libusb_exit(NULL)
+        self.lib.libusb_release_interface(self.handle, 0)
+        self.lib.libusb_close(self.handle)
+        self.lib.libusb_exit(NULL)
         print ('* liaison usb fermee  *')
 
 
@@ -77,8 +175,8 @@ class usb2(usb):
     """ classe concue pour la gestion de l'usb2
     """
 
-    def __init__(self, my_vid=0xFE27, my_pid=0xAC00):
-        usb.__init__(self, my_vid=my_vid, my_pid=my_pid)
+    def __init__(self, my_vid=0xFE27, my_pid=0xAC00, lib=None, bus=None, port=None, serial=None):
+        usb.__init__(self, my_vid=my_vid, my_pid=my_pid, lib=lib, bus=bus, port=port, serial=serial)
         self.version = 2
         print ("liaison par USB2")
 
@@ -96,10 +194,10 @@ class usb2(usb):
         index = 0
         if (length == 0):
             dat = '\x00'
-            dbg = libusb1.libusb_control_transfer(self.handle, typerequest, request, value, index, dat, 1, self.TIMEOUT)
+            dbg = self.lib.libusb_control_transfer(self.handle, typerequest, request, value, index, dat, 1, self.TIMEOUT)
             assert dbg == 1
         else:
-            dbg = libusb1.libusb_control_transfer(self.handle, typerequest, request, value, index, data_ptr, length,
+            dbg = self.lib.libusb_control_transfer(self.handle, typerequest, request, value, index, data_ptr, length,
                                                   self.TIMEOUT)
             assert dbg == length
 
@@ -108,8 +206,8 @@ class usb3(usb):
     """ classe concue pour la gestion de l'usb3
     """
 
-    def __init__(self, my_vid=0xFE27, my_pid=0xAC01):
-        usb.__init__(self, my_vid=my_vid, my_pid=my_pid)
+    def __init__(self, my_vid=0xFE27, my_pid=0xAC01, lib=None, bus=None, port=None, serial=None):
+        usb.__init__(self, my_vid=my_vid, my_pid=my_pid, lib=lib, bus=bus, port=port, serial=serial)
         self.version = 3
         print ("liaison par USB3")
 
@@ -125,7 +223,7 @@ class usb3(usb):
         typerequest = self.LIBUSB_RECIPIENT_DEVICE | self.LIBUSB_REQUEST_TYPE_VENDOR | self.LIBUSB_ENDPOINT_OUT
         value = 0
         index = 0
-        dbg = libusb1.libusb_control_transfer(self.handle, typerequest, request, value, index, data_ptr, length,
+        dbg = self.lib.libusb_control_transfer(self.handle, typerequest, request, value, index, data_ptr, length,
                                               self.TIMEOUT)
         assert dbg == length
 
@@ -142,7 +240,10 @@ class MegaMicros():
 
     def __init__(self, duree=0.00, filename='toto.dat', path='.',
                  mems=np.ones((16, 8), np.bool), va=np.ones((4), np.bool), vl=0, cpt=1,
-                 clockdiv=9, interactif=0, verbose=0, addr=0x82):
+                 clockdiv=9, interactif=0, verbose=0, addr=0x82, politique='drop_oldest',
+                 ecriture_async=0, fsync_interval=0., backend=None, s_pkt=None, n_tdf=8,
+                 autotune=0, latence=0.01, reserve=0.1, format='dat', codec=None, decimation=1,
+                 continu=0, duree_fichier=0., taille_fichier=0, duree_buffer=5.):
         """
         Initialisation de la classe Megamicros
 
@@ -154,14 +255,44 @@ class MegaMicros():
         :param vl:          [bool np.array(4,)]   tableau indiquant la position des voies logiques actives
         :param cpt:         [int] flag indiquant si le compteur est actif
         :param clockdiv:    [int] valaur de l'horloge (9 correspond a une frequence d echantillonnage de 50kHz
+        :param politique:   [str] comportement du buffer interactif quand le lecteur est en retard
+                                  ('block', 'drop_oldest' ou 'raise', cf. megaSysteme_ring) ; en 'block',
+                                  le callback attend au plus un quart de paquet, un paquet rejete est perdu
+        :param ecriture_async: [int] flag : l'ecriture sur le disque est confiee a un thread (cf. megaSysteme_writer)
+        :param fsync_interval: [float] intervalle (s) entre deux fsync en ecriture asynchrone (0 : jamais)
+        :param backend:     module libusb1 (par defaut) ou backend simule (cf. megaSysteme_simu.LibusbSimu)
+        :param s_pkt:       [int] taille des paquets en octets, multiple de 512 (par defaut 1024 octets par MEMS actif)
+        :param n_tdf:       [int] nombre de transferts usb en parallele (taches de fond)
+        :param autotune:    [int] flag : s_pkt et n_tdf sont choisis par auto_tune (s_pkt et n_tdf sont alors ignores)
+        :param latence:     [float] duree cible d'un paquet en secondes (autotune)
+        :param reserve:     [float] duree de donnees que les transferts en attente doivent pouvoir absorber (autotune)
+        :param format:      [str] 'dat' : int32 entrelaces bruts, 'mmc' : fichier par blocs compresses avec metadonnees
+                                  (cf. megaSysteme_format, impose l'ecriture asynchrone)
+        :param codec:       [str] codec de compression du format 'mmc' (par defaut le meilleur disponible)
+        :param decimation:  [int] facteur de decimation applique aux paquets avant leur stockage
+                                  (cf. megaSysteme_decimation) : frequence_sortie = frequence / decimation
+        :param continu:     [int] flag : acquisition sans fin (duree est ignoree), jusqu'a stop() ; le boitier
+                                  est rearme a chaque limite de son compteur de tixels (2**32 - 1 tixels,
+                                  environ 24 h a 50 kHz), les interruptions sont notees dans rearmements
+        :param duree_fichier:  [float] duree (s) de chaque fichier en rotation, 0 : pas de limite de duree
+        :param taille_fichier: [int] taille maximale (octets) de chaque fichier en rotation, 0 : pas de limite
+                                  (la rotation impose l'ecriture asynchrone, cf. megaSysteme_writer)
+        :param duree_buffer: [float] duree (s) du buffer du mode interactif
 
         :return:
         """
+        self.lib = libusb1 if backend is None else backend
         self.filename = filename
         self.path = path
         self.fichier = self.path + '/' + self.filename
-        if interactif == 0:
+        self.format = format
+        if self.format == 'mmc' or duree_fichier or taille_fichier:
+            # la compression et les changements de fichier ne doivent pas se faire dans le callback
+            ecriture_async = 1
+        self.ecriture_async = ecriture_async
+        if interactif == 0 and self.ecriture_async == 0:
             self.Filep = open(self.fichier, 'wb+')
+        self.continu = continu
         self.duree = float(duree)
         self.mems = mems
         self.va = va
@@ -171,24 +302,56 @@ class MegaMicros():
 
         # initialisation des differentes donnees : techniques, internes et stockage et usb
         self.clockdiv = clockdiv  # 9 corespond a freq = 50kHz   => freq = 500kHz/(clockdiv+1)
-        self.init_technical_data(s_pkt=np.sum(self.mems)*1024, n_tdf=8, timeout=1000, addr=addr)
+        if s_pkt is None:
+            s_pkt = np.sum(self.mems) * 1024
+        self.init_technical_data(s_pkt=s_pkt, n_tdf=n_tdf, timeout=1000, addr=addr)
+        # correspondance colonnes <-> voies, calculee une fois pour tous les consommateurs
+        self.carte = CarteVoies(self.mems, self.va, self.cpt, self.vl)
+        self.autotune = autotune
+        if self.autotune == 1:
+            self.auto_tune(latence=latence, reserve=reserve)
         self.compute_technical_data()
+        # decimation en flux : le boitier echantillonne a self.frequence, les donnees stockees
+        # (fichier, buffer interactif, observateurs) sont a self.frequence_sortie
+        self.decimation = int(decimation)
+        self.frequence_sortie = self.frequence / self.decimation
+        self.decimateur = None
+        if self.decimation > 1:
+            self.decimateur = Decimateur(self.decimation, self.nb_voies,
+                                         brutes=self.carte.selection('cpt'),
+                                         bloc_max=self.s_pkt // (4 * int(self.nb_voies)) + 1)
         self.init_util_var()
-
+        self.writer = None
+        if interactif == 0 and self.ecriture_async == 1:
+            conteneur = None
+            fabrique = None
+            n_buffers = max(64, 4 * self.n_tdf)
+            rotation = self.taille_rotation(duree_fichier, taille_fichier)
+            if self.format == 'mmc':
+                def fabrique(chemin):
+                    return ChunkWriter(chemin, self.metadonnees(), codec=codec,
+                                       tixels_par_bloc=int(self.frequence_sortie))
+                if not rotation:
+                    conteneur = fabrique(self.fichier)
+                # la file doit absorber la compression d'un bloc d'une seconde : 2 secondes de paquets
+                n_buffers = max(n_buffers, int(2 * 4 * self.nb_voies * self.frequence / self.s_pkt))
+            self.writer = DiskWriter(self.fichier, self.s_pkt, n_buffers=n_buffers,
+                                     fsync_interval=fsync_interval, conteneur=conteneur,
+                                     rotation=rotation, fabrique=fabrique, taille_tixel=4 * int(self.nb_voies))
 
         # Initialisation des differents modules usb et megamicros
 
         self.interactif = interactif
         # Gestion de l interactivite
         if self.interactif == 1:
-            self.duree_ideale_buffer = int(5 * self.frequence * self.nb_voies)  # par defaut 30 sec
-            self.data_len = int(self.duree_ideale_buffer / (self.s_pkt / 4)) * (self.s_pkt / 4)
-            self.data = np.zeros((self.data_len,)).astype(np.int32)
-            self.data_ptr = 0
-            self.data_ptr_lenmax = len(self.data)
-            self.data_ptr_R = 0
-            self.data_ptr_retour = 0
-            self.last_data_ptr = 0
+            self.duree_ideale_buffer = float(duree_buffer)  # duree du buffer interactif en secondes
+            # politique 'block' : le callback attend au plus un quart de paquet, au-dela les
+            # transferts en attente ne sont plus servis et le boitier risque de deborder
+            duree_pkt = self.s_pkt / (4. * self.nb_voies * self.frequence)
+            self.ring = RingBuffer(int(self.duree_ideale_buffer * self.frequence_sortie), self.nb_voies,
+                                   politique=politique, timeout=min(self.TIMEOUT / 1000., duree_pkt / 4))
+            self.data = self.ring.buffer
+            self.erreur_ring = None  # OverrunError levee dans le callback, transmise au lecteur
 
     def init_util_var(self):
         """
@@ -203,9 +366,36 @@ class MegaMicros():
         self.bbuffer_p = {}  # dictionnaire contenant les adresses memoires des sous buffers (contigus dans BBUFFER)
         for i in range(self.n_tdf):
             self.bbuffer_p[i] = ctypes.addressof(self.BBUFFER) + i * self.s_pkt
-        CMPFUNC = ctypes.CFUNCTYPE(None, libusb1.libusb_transfer_p)
+        # vues int32 permanentes sur les sous buffers : le callback n'a aucun objet a creer pour lire un paquet
+        self.vues_paquets = [np.frombuffer(self.BBUFFER, np.int32, self.s_pkt // 4, i * self.s_pkt)
+                             for i in range(self.n_tdf)]
+        self._vide = None  # bloc de zeros (lecture seule) retourne par get_data sans donnees disponibles
+        CMPFUNC = ctypes.CFUNCTYPE(None, self.lib.libusb_transfer_p)
         self.fn_callback_c = CMPFUNC(self.fn_callback_py)
         self.last_pkt = 0
+        # traitements appeles a chaque paquet recu (cf. ajoute_observateur)
+        self.observateurs = []
+        self._tampon_obs = np.zeros((self.s_pkt // 4 + int(self.nb_voies),), np.int32)
+        self._reste_obs = 0  # mots d'un tixel incomplet en attente dans _tampon_obs
+        self._num_decime = -1  # paquet dont la sortie du decimateur est dans _decime
+        self._decime = None
+        # transferts en erreur (cf. perte_paquet)
+        self.erreurs_transfert = 0
+        self.paquets_en_erreur = collections.deque(maxlen=1024)  # (num_pkt, status, actual_length), les derniers
+        self.valeur_perte = 0        # valeur des mots non recus d'un paquet en erreur
+        self.mots_recus = None       # mots recus du paquet courant s'il est interrompu par un timeout
+        self.mots_retardes = 0       # mots non transferes a cause des timeouts, arrives dans les paquets suivants
+        # acquisition continue : segments de COUNT tixels (cf. rearme)
+        self.mots_segment = 0        # mots recus du segment en cours
+        self.a_rearmer = False       # segment termine, le boitier doit etre rearme par show()
+        self.rearmements = []        # (indice du premier tixel du segment, date du rearmement)
+        self.verif = None            # verification du compteur (cf. init_verif_compteur)
+        self.transferts_en_vol = 0   # transferts soumis a libusb et pas encore termines
+        self.stats = None            # instrumentation du callback (cf. init_stats)
+        self.declencheur = None      # enregistrement declenche (cf. init_declenchement)
+        self.enveloppe = None        # enveloppes pour la visualisation (cf. init_enveloppe)
+        self.serveur = None          # diffusion aux clients distants (cf. init_serveur)
+        self.sante = None            # surveillance de l'etat des voies (cf. init_sante)
 
     def init_technical_data(self, s_pkt=512*1024, n_tdf=8, timeout=1000, addr=0x82):
         # donnees techniques Mm
@@ -214,10 +404,12 @@ class MegaMicros():
         self.datatype = "int32"  # type des donnes transmises par le systeme
         # Attention les 2 voies logiques sont codees sur le meme octet
         self.nb_voies = np.sum(self.mems) + np.sum(self.va) + self.cpt + self.vl
-        print 50 * '_'        
-        print self.nb_voies
-        print 50 * '_'
-        self.s_pkt = s_pkt#self.nb_voies * (8 * 1024)  # ATTENTION doit etre multiple de 512octets
+        print (50 * '_')
+        print (self.nb_voies)
+        print (50 * '_')
+        if s_pkt % 512:
+            raise ValueError("la taille des paquets doit etre un multiple de 512 octets : " + str(s_pkt))
+        self.s_pkt = int(s_pkt)#self.nb_voies * (8 * 1024)  # ATTENTION doit etre multiple de 512octets
         self.n_tdf = n_tdf  # nombre de tache de fond
         self.TIMEOUT = timeout
         self._ADDR = addr
@@ -228,25 +420,85 @@ class MegaMicros():
     def init_transfert_usb(self):
         print ("initialisation du transfert usb <-> Mm")
         for i in range(self.n_tdf):
-            self.transfert[i] = libusb1.libusb_alloc_transfer(0)
-            libusb1.libusb_fill_bulk_transfer(self.transfert[i], self.usbh.handle, self._ADDR, self.bbuffer_p[i],
+            self.transfert[i] = self.lib.libusb_alloc_transfer(0)
+            self.lib.libusb_fill_bulk_transfer(self.transfert[i], self.usbh.handle, self._ADDR, self.bbuffer_p[i],
                                               self.s_pkt,
                                               self.fn_callback_c, self.NULL, self.TIMEOUT)
-            retour = libusb1.libusb_submit_transfer(self.transfert[i])
+            retour = self.lib.libusb_submit_transfer(self.transfert[i])
             if retour:
                 print ("Erreur " + str(retour) + " au lancement du paquet" + str(i))
+            else:
+                self.transferts_en_vol += 1
                 # else:
                 #    print "Pret a recevoir"
         print ("initialisation du transfert usb <-> Mm .................... ok")
         self.etat=1
+    def auto_tune(self, latence=0.01, reserve=0.1, s_pkt_max=4 * 1024 * 1024, n_tdf_max=64):
+        """
+        choix de la taille des paquets et du nombre de transferts en parallele a partir du nombre de voies,
+        de la frequence d'echantillonnage et d'un budget de latence
+
+        - un paquet contient environ 'latence' secondes de donnees (arrondi au multiple de 512 octets superieur),
+          ce qui fixe le nombre de callbacks par seconde quel que soit le nombre de voies actives
+        - les n_tdf transferts en attente couvrent au moins 'reserve' secondes de donnees, c'est la duree
+          pendant laquelle le callback peut etre retarde sans que le boitier ne manque de buffers
+
+        :param latence:     [float] duree cible d'un paquet (s)
+        :param reserve:     [float] duree minimale couverte par les transferts en attente (s)
+        :param s_pkt_max:   [int]   taille maximale d'un paquet en octets
+        :param n_tdf_max:   [int]   nombre maximal de transferts en parallele
+        :return: (s_pkt, n_tdf)
+        """
+        debit = 4 * self.nb_voies * self.frequence  # octets par seconde
+        s_pkt = int(np.ceil(latence * debit / 512.)) * 512
+        self.s_pkt = int(min(max(s_pkt, 512), s_pkt_max))
+        duree_pkt = self.s_pkt / debit
+        # au moins 2 transferts pour que le boitier ait toujours un buffer pendant le callback
+        self.n_tdf = int(min(max(np.ceil(reserve / duree_pkt) + 1, 2), n_tdf_max))
+        self.latence = latence
+        self.reserve = reserve
+        return self.s_pkt, self.n_tdf
+
     def compute_technical_data(self):
-        self.COUNT = long(np.floor(self.duree * self.frequence))  # nombre d echantillons a recuperer sur chaque voie
-        self.n_pkt = long(np.ceil((4. * self.COUNT * self.nb_voies) / self.s_pkt))  # nombre de paquets a recevoir
+        if self.continu == 1:
+            # acquisition sans fin : le boitier est programme par segments de COUNT tixels (au plus son
+            # compteur 32 bits, un nombre entier de paquets) et rearme a la fin de chaque segment
+            # (cf. rearme) ; la session s'arrete sur stop()
+            unite = self.s_pkt // gcd(self.s_pkt, 4 * int(self.nb_voies))
+            self.COUNT = long(max(COUNT_MAX // unite, 1) * unite)
+            self.n_pkt = long(PKT_INFINI)
+        else:
+            self.COUNT = long(np.floor(self.duree * self.frequence))  # nombre d echantillons a recuperer sur chaque voie
+            self.n_pkt = long(np.ceil((4. * self.COUNT * self.nb_voies) / self.s_pkt))  # nombre de paquets a recevoir
         self.s_l_pkt = (
                            4 * self.COUNT * self.nb_voies) % self.s_pkt  # taille du dernier paquet (car s_pkt n est pas comensurable avec count)
+        if self.s_l_pkt == 0:
+            # count est commensurable avec s_pkt : le dernier paquet est un paquet complet
+            self.s_l_pkt = self.s_pkt
         self.check_n_tdf()
         self.tot = 4 * self.nb_voies * self.COUNT  # // nombre de données attendues
 
+    def taille_rotation(self, duree_fichier=0., taille_fichier=0):
+        """
+        taille des fichiers en rotation, en octets : un nombre entier de tixels, au plus duree_fichier
+        secondes et taille_fichier octets
+
+        :param duree_fichier:   [float] duree (s) de chaque fichier, 0 : pas de limite de duree
+        :param taille_fichier:  [int]   taille maximale (octets) de chaque fichier, 0 : pas de limite
+        :return: taille en octets, 0 si pas de rotation
+        """
+        taille_tixel = 4 * int(self.nb_voies)
+        tixels = []
+        if duree_fichier:
+            tixels.append(int(round(duree_fichier * self.frequence_sortie)))
+        if taille_fichier:
+            tixels.append(int(taille_fichier) // taille_tixel)
+        if not tixels:
+            return 0
+        if min(tixels) < 1:
+            raise ValueError("fichiers de rotation plus petits qu'un tixel")
+        return min(tixels) * taille_tixel
+
     def check_n_tdf(self):
         """
         verifie que le nombre de tache de fond (n_tdf) est compatible avec le nombre de paquets a recuperer
@@ -266,12 +518,12 @@ class MegaMicros():
         :param nb_micros:
         :return:
         """
-        if self.mems == 'all':
+        if isinstance(self.mems, str) and self.mems == 'all':
             self.active_mems = np.ones((nb_faisceaux, nb_micros), np.bool)
         else:
             self.active_mems = self.mems
 
-        if self.va == 'all':
+        if isinstance(self.va, str) and self.va == 'all':
             self.active_va = np.ones((4,), np.bool)
         else:
             self.active_va = self.va
@@ -295,159 +547,500 @@ class MegaMicros():
         self.page[nb_faisceaux] = struct.pack('B', ipage)
 
 
+    def metadonnees(self):
+        """
+        :return: dictionnaire des parametres d'acquisition (enregistre dans l'entete des fichiers .mmc)
+        """
+        return {'nb_voies': int(self.nb_voies),
+                'frequence': float(self.frequence_sortie),
+                'decimation': self.decimation,
+                'clockdiv': int(self.clockdiv),
+                'mems': np.asarray(self.mems).astype(int).tolist(),
+                'va': np.asarray(self.va).astype(int).tolist(),
+                'cpt': int(self.cpt),
+                'datatype': self.datatype,
+                'duree': self.duree,
+                'date': time.strftime('%Y-%m-%dT%H:%M:%S')}
+
+    def index_mems(self):
+        """
+        colonnes des MEMS actifs dans les blocs de donnees
+
+        Les voies sont entrelacees dans l'ordre des pages de SelectChannels : les MEMS actifs
+        (faisceau 0 micros 0..7, faisceau 1, ...), puis les voies analogiques actives, puis le compteur.
+
+        :return: np.array des indices de colonnes
+        """
+        return self.carte.colonnes_mems
+
     def fn_callback_py(self, transfer_i):
+        self.transferts_en_vol -= 1
+        self.mots_recus = None
+        stats = self.stats
+        if stats is not None:
+            t0 = stats.horloge()
+            en_vol = self.transferts_en_vol
         if self.verbose == 1:
             print ("callback, num_pkt = " + str(self.num_pkt + 1) + " / " + str(self.n_pkt))
         # --------------------------------------------------------------------------------------------------
         # 1 le transfert s est mal passe
         # --------------------------------------------------------------------------------------------------
-        if transfer_i.contents.status != libusb1.LIBUSB_TRANSFER_COMPLETED:
-            if transfer_i.contents.status == libusb1.LIBUSB_TRANSFER_TIMED_OUT:
+        if transfer_i.contents.status != self.lib.LIBUSB_TRANSFER_COMPLETED:
+            if transfer_i.contents.status == self.lib.LIBUSB_TRANSFER_TIMED_OUT:
                 print ("TIMEOUT lors du transfert du paquet" + str(self.num_pkt + 1))
             else:
                 print ("Erreur lors du transfert du paquet " + str(transfer_i.contents.status))
-            libusb1.libusb_cancel_transfer(transfer_i)
+            if not self.perte_paquet(transfer_i):
+                self.lib.libusb_cancel_transfer(transfer_i)
+                return
         # --------------------------------------------------------------------------------------------------
-        # 2 le transfert s est bien passe
+        # 2 le transfert s est bien passe (ou le paquet perdu a ete remplace, cf. perte_paquet)
         # --------------------------------------------------------------------------------------------------
+        # ++++++++++++++++++++++++++++++++++++++++++
+        # 2.1 Sauvegarde des donnees sur le disque dur
+        # ++++++++++++++++++++++++++++++++++++++++++
+        if self.interactif == 0:
+            self.buffer2disque()
+        elif self.interactif == 1:
+            self.buffer2buffer()
+        if stats is not None:
+            t1 = stats.horloge()
+        if self.observateurs:
+            self.distribue(self.paquet_courant())
+        if stats is not None:
+            t2 = stats.horloge()
+        if self.continu == 1:
+            self.mots_segment += len(self.paquet_brut())
+            if self.mots_segment >= self.COUNT * self.nb_voies:
+                # le boitier s'est arrete apres COUNT tixels : rearmement dans show()
+                self.mots_segment -= self.COUNT * self.nb_voies
+                self.a_rearmer = True
+                if self.verif is not None:
+                    self.verif.reprise()
+        # ++++++++++++++++++++++++++++++++++++++++++
+        # 2.2 Relance des transferts
+        # ++++++++++++++++++++++++++++++++++++++++++
+        self.relance_transfert(transfer_i)
+        if stats is not None:
+            stats.enregistre(t0, t1, t2, stats.horloge(), transfer_i.contents.actual_length,
+                             en_vol, vidange=self.num_pkt + self.n_tdf > self.n_pkt - 1)
+        # ++++++++++++++++++++++++++++++++++++++++++
+        # 2.2 On incremente le nombre de paquets traites
+        # ++++++++++++++++++++++++++++++++++++++++++
+        self.num_pkt += 1
+
+    def perte_paquet(self, transfer_i):
+        """
+        comptabilise un transfert en erreur.
+
+        TIMEOUT : les mots non transferes ne sont pas perdus, ils restent dans la FIFO du boitier
+        et arrivent en tete du transfert suivant (comportement des endpoints bulk). Seuls les
+        actual_length octets recus sont traites, sans remplissage : le flux reste continu et aligne.
+        Les derniers mots de l'acquisition (autant que de mots retardes) restent dans la FIFO,
+        videe par reset_fifo a la fermeture.
+
+        Autres erreurs (ERROR, STALL, OVERFLOW, ...) : les donnees sont perdues, les mots non recus
+        sont remplaces par self.valeur_perte : le paquet garde sa taille, les paquets suivants restent
+        alignes sur les tixels, et le trou est visible sur la voie compteur
+
+        :param transfer_i:
+        :return: True si le paquet doit etre traite comme un paquet recu, False si le transfert est abandonne
+        """
+        status = transfer_i.contents.status
+        if status == self.lib.LIBUSB_TRANSFER_CANCELLED or self.num_pkt >= self.n_pkt:
+            return False
+        recu = transfer_i.contents.actual_length
+        self.erreurs_transfert += 1
+        self.paquets_en_erreur.append((self.num_pkt, status, recu))
+        if status == self.lib.LIBUSB_TRANSFER_TIMED_OUT:
+            self.mots_retardes += len(self.paquet_brut()) - recu // 4
+            self.mots_recus = recu // 4
         else:
-            # ++++++++++++++++++++++++++++++++++++++++++
-            # 2.1 Sauvegarde des donnees sur le disque dur
-            # ++++++++++++++++++++++++++++++++++++++++++
-            if self.interactif == 0:
-                self.buffer2disque()
-            elif self.interactif == 1:
-                self.buffer2buffer()
-            # ++++++++++++++++++++++++++++++++++++++++++
-            # 2.2 Relance des transferts
-            # ++++++++++++++++++++++++++++++++++++++++++
-            self.relance_transfert(transfer_i)
-            # ++++++++++++++++++++++++++++++++++++++++++
-            # 2.2 On incremente le nombre de paquets traites
-            # ++++++++++++++++++++++++++++++++++++++++++
-            self.num_pkt += 1
+            self.paquet_brut()[recu // 4:] = self.valeur_perte
+        return True
+
+    def paquet_brut(self):
+        """
+        :return: vue int32 (sans copie) sur le paquet courant dans BBUFFER
+        """
+        vue = self.vues_paquets[self.num_pkt % self.n_tdf]
+        if self.mots_recus is not None:
+            # transfert interrompu par un timeout (cf. perte_paquet)
+            return vue[:self.mots_recus]
+        if self.num_pkt < self.n_pkt - 1:
+            return vue
+        return vue[:self.s_l_pkt // 4]
+
+    def paquet_courant(self):
+        """
+        :return: vue int32 (sans copie) sur le paquet courant dans BBUFFER,
+                 ou tixels decimes du paquet courant (calcules une seule fois par paquet) si decimation > 1
+        """
+        paquet = self.paquet_brut()
+        if self.decimateur is None:
+            return paquet
+        if self._num_decime != self.num_pkt:
+            self._decime = self.decimateur.traite(paquet).reshape(-1)
+            self._num_decime = self.num_pkt
+        return self._decime
+
+    def ajoute_observateur(self, observateur):
+        """
+        enregistre un traitement appele depuis le callback a chaque paquet recu
+
+        L'observateur doit fournir une methode paquet(bloc), qui recoit les tixels complets du paquet
+        sous la forme d'un tableau int32 (nb_tixels, nb_voies) valide uniquement pendant l'appel,
+        et peut fournir une methode fin(), appelee a la fin de l'acquisition.
+        Il s'execute dans le thread de show() : il doit rester court.
+
+        :param observateur:
+        :return:
+        """
+        self.observateurs.append(observateur)
+
+    def retire_observateur(self, observateur):
+        if observateur in self.observateurs:
+            self.observateurs.remove(observateur)
+
+    def distribue(self, paquet):
+        """
+        realigne le paquet sur les tixels (les paquets ne contiennent pas un nombre entier de tixels)
+        et le transmet aux observateurs
+
+        :param paquet: [np.array int32] contenu du paquet
+        :return:
+        """
+        total = self._reste_obs + len(paquet)
+        self._tampon_obs[self._reste_obs:total] = paquet
+        complet = (total // self.nb_voies) * self.nb_voies
+        bloc = self._tampon_obs[:complet].reshape((-1, int(self.nb_voies)))
+        for observateur in self.observateurs:
+            observateur.paquet(bloc)
+        self._reste_obs = total - complet
+        self._tampon_obs[:self._reste_obs] = self._tampon_obs[complet:total]
+
+    def fin_observateurs(self):
+        for observateur in list(self.observateurs):
+            if hasattr(observateur, 'fin'):
+                observateur.fin()
+
+    def stream(self, duree_bloc, copie=True, loop=None):
+        """
+        flux asyncio des blocs du mode interactif :
+
+            async for bloc in Mm.stream(0.1):
+                ...
+
+        (Python 3 uniquement, cf. megaSysteme_asyncio)
+
+        :param duree_bloc:  [float] duree des blocs en secondes
+        :param copie:       [bool]  si False, les blocs sont des vues sur le buffer circulaire
+        :param loop:        boucle asyncio, par defaut celle de la coroutine appelante
+        :return: iterateur asynchrone de blocs (nb_tixels, nb_voies)
+        """
+        from megaSysteme_asyncio import FluxAsync
+        return FluxAsync(self, duree_bloc, copie=copie, loop=loop)
 
     def buffer2disque(self):
         """
         transfert le contenu du buffer courant dans le fichier ouvert sur le disque
+        (ou dans la file du thread d'ecriture en mode ecriture_async)
 
         :return:
         """
-        if self.num_pkt < self.n_pkt - 1:
-            # 2.1.1 Cas standard => le paquet recu est un paquet de longueur normale
-            if self.filename:
-                adr_debut = (self.num_pkt % self.n_tdf) * self.s_pkt
-                adr_fin = adr_debut + self.s_pkt
-                self.Filep.write(self.BBUFFER[adr_debut:adr_fin])
-            # ATTENTION : si le paquet a une taille standard mais que c'est le dernier paquet a avoir cette taille
-            #       il envoie l info via le flag self.last_pkt
-            if self.num_pkt == self.n_pkt - 2:
-                self.last_pkt = 1
-        else:
-            # 2.1.2 Cas particulier  => le paquet recu n'est pas un paquet de longueur normale
-            #               c'est le dernier paquet de la liste avec une longueur self.s_l_pkt
-            if self.filename:
-                adr_debut = (self.num_pkt % self.n_tdf) * self.s_pkt
-                adr_fin = adr_debut + self.s_l_pkt
-                self.Filep.write(self.BBUFFER[adr_debut:adr_fin])
+        # ATTENTION : si le paquet a une taille standard mais que c'est le dernier paquet a avoir cette taille
+        #       il envoie l info via le flag self.last_pkt
+        if self.num_pkt == self.n_pkt - 2:
+            self.last_pkt = 1
+        if self.filename:
+            # vue sur le paquet dans BBUFFER (ou sur les tixels decimes) : aucune copie avant l'ecriture
+            donnees = self.paquet_courant().view(np.uint8)
+            if self.ecriture_async == 1:
+                self.writer.submit(donnees)
+            else:
+                self.Filep.write(donnees)
 
     def buffer2buffer(self):
         """
-        transfert le contenu du buffer courant dans le fichier ouvert sur le disque
+        transfert le contenu du buffer courant dans le buffer circulaire du mode interactif
 
         :return:
         """
-        if self.num_pkt < self.n_pkt - 1:
-            # 2.1.1 Cas standard => le paquet recu est un paquet de longueur normale
-            adr_debut = (self.num_pkt % self.n_tdf) * self.s_pkt
-            adr_fin = adr_debut + self.s_pkt
-            size = (adr_fin - adr_debut) / 4
-            if self.data_ptr + size > self.data_ptr_lenmax:
-                self.last_data_ptr = self.data_ptr
-                self.data_ptr = 0
-                self.data_ptr_retour = 1
-            self.data[self.data_ptr:self.data_ptr + size] = np.frombuffer(self.BBUFFER[adr_debut:adr_fin], np.int32)
-            self.data_ptr = self.data_ptr + size
-            # self.Filep.write(self.BBUFFER[adr_debut:adr_fin])
-            if self.num_pkt == self.n_pkt - 2:
-                
-                self.last_pkt = 1
-        else:
-            # 2.1.2 Cas particulier  => le paquet recu n'est pas un paquet de longueur normale
-            #               c'est le dernier paquet de la liste avec une longueur self.s_l_pkt
-            adr_debut = (self.num_pkt % self.n_tdf) * self.s_pkt
-            adr_fin = adr_debut + self.s_l_pkt
-            size = (adr_fin - adr_debut) / 4
-            if self.data_ptr + size > self.data_ptr_lenmax:
-                self.last_data_ptr = self.data_ptr
-                self.data_ptr = 0
-                self.data_ptr_retour = 1
-            self.data[self.data_ptr:self.data_ptr + size] = np.frombuffer(self.BBUFFER[adr_debut:adr_fin], np.int32)
-            self.data_ptr = self.data_ptr + size
-            # self.Filep.write(self.BBUFFER[adr_debut:adr_fin])
-
-    def get_data(self, duree):
+        if self.num_pkt == self.n_pkt - 2:
+            self.last_pkt = 1
+        try:
+            # une seule copie : de la vue sur BBUFFER vers le buffer circulaire
+            if not self.ring.write(self.paquet_courant()):
+                # politique 'block' : timeout, le paquet est rejete (par tixels entiers)
+                raise OverrunError("buffer circulaire plein depuis " + str(self.ring.timeout) + " s : " +
+                                   str(self.ring.perdus) + " tixels perdus")
+        except OverrunError as e:
+            # une exception ne doit pas sortir du callback libusb : elle est relevee par get_data
+            self.erreur_ring = e
+
+    def get_data(self, duree, out=None):
         """
         Va chercher dans Mm les donnees d une duree de 'duree'
 
         :param duree:
+        :param out:     [np.array int32 (nb_tixels, nb_voies)] buffer prealloue a remplir (optionnel)
         :return:
         res = 1  si la fct retourne un buffer rempli
         res = 0 si la fct ne retourne rien
 
-        data2 buffer contenant les donnees demandees
-        """
-        nb_tixels = int(duree * self.frequence)
-        # on calcule la longueur du buffer a recuperer
-        size = long(nb_tixels * self.nb_voies)
-        # on verifie que cette longueur existe
-        res = 0
-        data2 = np.zeros(nb_tixels , self.nb_voies).astype(np.int32)
-        tmp = np.zeros(nb_tixels  * self.nb_voies).astype(np.int32)
-
-        if self.data_ptr_R + size < len(self.data):
-            # print "donnees contigues"
-            if self.data_ptr > self.data_ptr_R + size:  # or self.data_ptr_retour == 1:
-                res = 1
-                # print "bloc pret pour lecture"
-                if self.data_ptr_R + size < len(self.data):
-                    data2 = self.data[self.data_ptr_R:self.data_ptr_R + size].reshape(
-                        (nb_tixels, self.nb_voies))
-                    self.data_ptr_R = self.data_ptr_R + size
+        data2 buffer contenant les donnees demandees, de forme (nb_tixels, nb_voies).
+        Avec out, data2 est out (une copie depuis le buffer circulaire, aucune allocation).
+        Sans out, quand le bloc est contigu dans le buffer circulaire, data2 est une vue sans copie.
+        Sans donnees, data2 est out mis a zero ou un bloc de zeros en lecture seule reutilise.
+        """
+        if self.erreur_ring is not None:
+            erreur = self.erreur_ring
+            self.erreur_ring = None
+            raise erreur
+        nb_tixels = int(duree * self.frequence_sortie)
+        data2 = self.ring.read(nb_tixels, out=out)
+        if data2 is None:
+            if out is not None:
+                out[...] = 0
+                return 0, out
+            if self._vide is None or len(self._vide) != nb_tixels:
+                self._vide = np.zeros((nb_tixels, int(self.nb_voies)), np.int32)
+                self._vide.setflags(write=False)
+            return 0, self._vide
+        return 1, data2
+
+    def init_verif_compteur(self, remplissage=0):
+        """
+        attache la verification de la continuite du compteur (cf. megaSysteme_integrite)
+
+        :param remplissage: [int] valeur ecrite a la place des mots d'un paquet perdu
+        :return: l'objet VerifCompteur (trous, tixels_perdus, tixels_invalides)
+        """
+        if self.cpt != 1:
+            raise ValueError("la verification necessite la voie compteur (cpt=1)")
+        self.valeur_perte = remplissage
+        if self.writer is not None:
+            self.writer.valeur_perte = remplissage
+        self.verif = VerifCompteur(colonne=self.carte.colonne_cpt, pas=self.decimation)
+        self.ajoute_observateur(self.verif)
+        return self.verif
+
+    def init_stats(self, taille=4096, export=None, periode=1.):
+        """
+        active l'instrumentation du callback (cf. megaSysteme_stats)
+
+        :param taille:  [int]   nombre de paquets conserves pour les percentiles et le debit
+        :param export:  [str]   fichier ou 'unix:<chemin>' pour un export periodique, None pour aucun
+        :param periode: [float] intervalle entre deux exports (s)
+        :return: l'objet StatsCallback (cf. resume())
+        """
+        self.stats = StatsCallback(4. * self.nb_voies * self.frequence, self.s_pkt, self.n_tdf, taille=taille)
+        if export is not None:
+            self.stats.exporte(export, periode)
+        return self.stats
+
+    def init_pool_dsp(self, fonction, duree_bloc=0.1, nb_processus=None, nb_blocs=None):
+        """
+        remplace le buffer interactif par un buffer circulaire en memoire partagee dont chaque bloc
+        complet est traite par un pool de processus (cf. megaSysteme_partage, Python 3.8 et plus).
+        Le producteur n'attend jamais les processus : seule la politique 'drop_oldest' est possible.
+
+        :param fonction:        fonction(bloc) -> resultat, du niveau module (elle est transmise aux processus)
+        :param duree_bloc:      [float] duree des blocs traites (s)
+        :param nb_processus:    [int]   nombre de processus (par defaut le nombre de coeurs moins un)
+        :param nb_blocs:        [int]   capacite du buffer en blocs (par defaut duree_ideale_buffer)
+        :return: l'objet PoolDSP (iterable sur les resultats)
+        """
+        if self.interactif != 1:
+            raise ValueError("le pool de traitement necessite le mode interactif")
+        if self.ring.politique != 'drop_oldest':
+            raise ValueError("le pool de traitement necessite la politique 'drop_oldest'")
+        from megaSysteme_partage import PoolDSP
+        if nb_blocs is None:
+            nb_blocs = max(2, int(self.duree_ideale_buffer / duree_bloc))
+        self.pool = PoolDSP(fonction, nb_blocs, int(duree_bloc * self.frequence_sortie), self.nb_voies,
+                            nb_processus=nb_processus, frequence=self.frequence_sortie)
+        self.ring = self.pool.ring
+        self.data = self.ring.buffer
+        return self.pool
+
+    def init_diffusion(self, duree_bloc=0.1):
+        """
+        place le buffer interactif en memoire partagee pour que d'autres processus locaux lisent
+        le flux en direct, chacun avec son curseur (cf. megaSysteme_partage.Abonne) :
+
+            (autre processus) abonne = Abonne(nom)
+
+        Si un pool de traitement est deja attache (init_pool_dsp), son buffer est diffuse.
+        Le producteur n'attend jamais les abonnes : seule la politique 'drop_oldest' est possible.
+
+        :param duree_bloc:  [float] granularite du buffer partage (s)
+        :return: nom de la memoire partagee
+        """
+        if self.interactif != 1:
+            raise ValueError("la diffusion necessite le mode interactif")
+        if self.ring.politique != 'drop_oldest':
+            raise ValueError("la diffusion necessite la politique 'drop_oldest'")
+        from megaSysteme_partage import RingPartage
+        if not isinstance(self.ring, RingPartage):
+            nb_blocs = max(2, int(self.duree_ideale_buffer / duree_bloc))
+            self.ring = RingPartage(nb_blocs, int(duree_bloc * self.frequence_sortie), self.nb_voies,
+                                    frequence=self.frequence_sortie)
+            self.data = self.ring.buffer
+        return self.ring.nom
+
+    def init_declenchement(self, seuil, voies=None, mode='niveau', pre=0.5, post=1., fenetre=0.005,
+                           repertoire=None, prefixe='evenement'):
+        """
+        enregistrement declenche : seuls les evenements (historique + fenetre apres le declenchement)
+        sont ecrits sur le disque, depuis le buffer interactif (cf. megaSysteme_declenchement).
+        A appeler apres init_pool_dsp / init_diffusion, qui remplacent le buffer.
+
+        :param seuil:       [float] seuil de declenchement : crete ('niveau') ou valeur efficace ('energie')
+        :param voies:       voies surveillees (cf. CarteVoies.selection, par defaut toutes sauf le compteur)
+        :param mode:        [str]   'niveau' ou 'energie'
+        :param pre:         [float] historique ecrit avant le declenchement (s)
+        :param post:        [float] duree ecrite apres le declenchement (s)
+        :param fenetre:     [float] duree des fenetres du mode 'energie' (s)
+        :param repertoire:  [str]   repertoire des evenements (par defaut path)
+        :param prefixe:     [str]   prefixe des fichiers d'evenements
+        :return: l'objet Declencheur
+        """
+        if self.interactif != 1:
+            raise ValueError("le declenchement necessite le mode interactif")
+        if self.ring.politique != 'drop_oldest':
+            raise ValueError("le declenchement necessite la politique 'drop_oldest'")
+        pre = int(pre * self.frequence_sortie)
+        if pre + self.s_pkt // (4 * int(self.nb_voies)) >= self.ring.capacite // self.ring.nb_voies:
+            raise ValueError("historique plus long que le buffer interactif")
+        enregistreur = EnregistreurEvenements(self.ring, self.path if repertoire is None else repertoire,
+                                              prefixe=prefixe, frequence=self.frequence_sortie)
+        self.declencheur = Declencheur(self.carte.selection(voies), seuil, enregistreur, mode=mode,
+                                       fenetre=max(1, int(fenetre * self.frequence_sortie)),
+                                       pre=pre, post=int(post * self.frequence_sortie))
+        self.ajoute_observateur(self.declencheur)
+        return self.declencheur
+
+    def init_enveloppe(self, voies=None, resolutions=(64, 512, 4096, 32768), capacite=4096):
+        """
+        attache le calcul en flux des enveloppes min / max / valeur efficace des voies
+        a plusieurs resolutions (cf. megaSysteme_enveloppe), lues par get_enveloppe
+
+        :param voies:       voies suivies (cf. CarteVoies.selection, par defaut toutes sauf le compteur)
+        :param resolutions: [list] nombre de tixels par point de chaque niveau, chacun multiple du precedent
+        :param capacite:    [int]  nombre de points conserves par niveau
+        :return: l'objet Enveloppe
+        """
+        self.enveloppe = Enveloppe(self.carte.selection(voies), self.frequence_sortie,
+                                   resolutions=resolutions, capacite=capacite)
+        self.ajoute_observateur(self.enveloppe)
+        return self.enveloppe
+
+    def init_sante(self, voies=None, duree=1., **kwargs):
+        """
+        attache la surveillance en flux de l'etat des voies (valeur efficace, crete, continu,
+        saturations, suites de zeros) et les alertes associees (cf. megaSysteme_sante)
+
+        :param voies:   voies surveillees (cf. CarteVoies.selection, par defaut toutes sauf le compteur)
+        :param duree:   [float] periode d'evaluation (s)
+        :param kwargs:  limites des alertes (saturation, rms_min, ecart_median, taux_saturation, dc_max, duree_zeros)
+        :return: l'objet SanteVoies
+        """
+        colonnes = self.carte.selection(voies)
+        self.sante = SanteVoies(colonnes, [self.carte.noms[c] for c in colonnes], self.frequence_sortie,
+                                duree=duree, **kwargs)
+        self.ajoute_observateur(self.sante)
+        return self.sante
+
+    def init_serveur(self, adresse='tcp:127.0.0.1:5050', duree_buffer=2., duree_bloc=0.05):
+        """
+        attache un serveur de flux : les clients (ClientFlux, cf. megaSysteme_serveur) s'abonnent a une
+        selection de voies et a une decimation, et recoivent les tixels en trames binaires
+
+        :param adresse:         [str]   'tcp:<hote>:<port>' ou 'unix:<chemin>' (port 0 : choisi par le systeme)
+        :param duree_buffer:    [float] retard maximal (s) d'un client avant qu'il perde des tixels
+        :param duree_bloc:      [float] duree par defaut des trames (s)
+        :return: l'objet ServeurFlux
+        """
+        self.serveur = ServeurFlux(adresse, self.nb_voies, self.frequence_sortie, self.carte,
+                                   duree_buffer=duree_buffer, duree_bloc=duree_bloc)
+        self.ajoute_observateur(self.serveur)
+        return self.serveur
+
+    def get_enveloppe(self, duree, nb_pixels, voies=None):
+        """
+        enveloppes des 'duree' dernieres secondes (peut etre appele depuis n'importe quel thread)
+
+        :param duree:       [float] duree de la fenetre (s)
+        :param nb_pixels:   [int]   largeur de l'affichage en points
+        :param voies:       voies a lire parmi les voies suivies (cf. CarteVoies.selection), None pour toutes
+        :return: (indice du premier tixel, tixels par point, mins, maxs, rms), tableaux (nb_voies, nb_points)
+        """
+        lignes = None
+        if voies is not None:
+            lignes = [self.enveloppe.lignes[int(c)] for c in self.carte.selection(voies)]
+        return self.enveloppe.derniers(duree, nb_pixels, lignes)
+
+    def init_stft(self, nfft=1024, hop=512, colonnes=None, fenetre=None):
+        """
+        attache une STFT en flux aux blocs lus par get_stft
+
+        :param nfft:        [int]  taille des trames
+        :param hop:         [int]  pas entre deux trames (tixels)
+        :param colonnes:    voies a transformer (cf. CarteVoies.selection, par defaut toutes sauf le compteur)
+        :param fenetre:     [np.array (nfft,)] fenetre d'analyse (Hann par defaut)
+        :return: l'objet StreamingSTFT
+        """
+        self.stft = StreamingSTFT(nfft, hop, self.carte.selection(colonnes), self.frequence_sortie,
+                                  fenetre=fenetre)
+        return self.stft
+
+    def get_stft(self, duree):
+        """
+        Va chercher dans Mm les donnees d une duree de 'duree' et les passe dans la STFT (cf. init_stft)
+
+        :param duree:
+        :return:
+        res = 1  si la fct retourne des trames
+        res = 0 si la fct ne retourne rien
+
+        spectres (nb_trames, nb_freq, nb_voies) et indices absolus du premier tixel de chaque trame,
+        valides jusqu'a l'appel suivant
+        """
+        res, data = self.get_data(duree)
+        if res == 0:
+            return 0, None, None
+        spectres, debuts = self.stft.push(data)
+        return 1, spectres, debuts
 
-            else:
-                # print "bloc non pret pour lecture"
-                res = 0
+    def init_voies(self, voies=None, dtype=np.float32):
+        """
+        attache un desentrelacement aux blocs lus par get_voies (cf. megaSysteme_voies)
 
-        else:
-            # print "pb:::::::::"
-            size_end = self.last_data_ptr - self.data_ptr_R
-            if (size_end + self.data_ptr > size) and (self.data_ptr_retour == 1):
-                # on calcule la duree corresondant a size_end
-                # duree_partielle = size_end / self.frequence / self.nb_voies
-                # print size_begin
-                # print size_end
-                # print size
-                # print size_end/self.nb_voies
-                # print self.nb_voies
-
-                # print np.shape(data2[0:size_end,:])
-                tmp1 = self.data[self.data_ptr_R:self.last_data_ptr]
-                tmp2 = self.data[0:size - size_end]
-                # print size_end
-                # print self.data_ptr
-                tmp[0:len(tmp1)] = tmp1
-                tmp[len(tmp1):] = tmp2
-                data2 = tmp.reshape((nb_tixels, self.nb_voies))
-                self.data_ptr_R = size - size_end
-                self.data_ptr_retour = 0
-                # data2[size_end:size - size_end,:]
-                res = 1
-            else:
-                res = 0
-                # print "donnees non contigues"
+        :param voies:   selection des voies (cf. CarteVoies.selection, par defaut toutes sauf le compteur)
+        :param dtype:   type des echantillons en sortie
+        :return: l'objet Desentrelaceur
+        """
+        self.desentrelaceur = self.carte.desentrelaceur(voies, dtype=dtype)
+        return self.desentrelaceur
 
-        return res, data2
+    def get_voies(self, duree, out=None):
+        """
+        Va chercher dans Mm les donnees d une duree de 'duree', rangees par voie (cf. init_voies)
+
+        :param duree:
+        :param out:     [np.array (nb_voies_choisies, nb_tixels)] buffer prealloue a remplir (optionnel)
+        :return:
+        res = 1  si la fct retourne un buffer rempli
+        res = 0 si la fct ne retourne rien
+
+        voies (nb_voies_choisies, nb_tixels) : chaque voie contigue en memoire, dans out ou dans
+        un buffer reutilise d'un appel a l'autre
+        """
+        res, data = self.get_data(duree)
+        if res == 0:
+            return 0, None
+        return 1, self.desentrelaceur.traite(data, out=out)
 
     def relance_transfert(self, transfer_i):
         """
@@ -463,21 +1056,25 @@ class MegaMicros():
             # le paquet sera le dernier de la liste :
             # avant de le relancer, il faut changer la taille du buffer attendu
             # on allonge egalement la taille du timeout pour avoir le temps de lancer l instruction packend
-            libusb1.libusb_fill_bulk_transfer(transfer_i, self.usbh.handle, self._ADDR,
+            self.lib.libusb_fill_bulk_transfer(transfer_i, self.usbh.handle, self._ADDR,
                                               self.bbuffer_p[self.num_pkt % self.n_tdf],
                                               self.s_l_pkt, self.fn_callback_c, NULL, 10 * self.TIMEOUT)
             # on relance le transfert
-            retour = libusb1.libusb_submit_transfer(transfer_i)
+            retour = self.lib.libusb_submit_transfer(transfer_i)
             if retour:
                 print (".....Erreur " + str(retour) + " au lancement transfert du dernier paquet " + str(self.num_pkt))
+            else:
+                self.transferts_en_vol += 1
                 # else:
                 #    print "dernier paquet, s_pkt = " + str(self.s_l_pkt)
         elif id_futur < self.n_pkt - 1:
             # le paquet sera un paquet (normal) dans la liste :
             # on relance le transfert
-            retour = libusb1.libusb_submit_transfer(transfer_i)
+            retour = self.lib.libusb_submit_transfer(transfer_i)
             if retour:
                 print (".....Erreur " + str(retour) + " au lancement du paquet " + str(self.num_pkt))
+            else:
+                self.transferts_en_vol += 1
                 # else:
                 #    print "paquet standard"
         elif id_futur > self.n_pkt - 1 or self.etat==0:
@@ -489,29 +1086,40 @@ class MegaMicros():
         self.last_pkt = 1
         self.etat=0
 
+    def fin_paquets(self):
+        """
+        envoie la commande 'packet end' au boitier une fois le dernier paquet de taille standard recu
+        """
+        if self.last_pkt == 1 and self.usbh.version == 2:
+            msg = ctypes.create_string_buffer(16)
+            print(self.num_pkt)
+            print ('packet end')
+            if self.interactif == 1 or self.continu == 1:
+                self.num_pkt = self.n_pkt
+            time.sleep(1)
+            self.usbh.write_command(0xC1, msg, 0)
+
     def show(self):
         """
         boucle interne de megamicros pour permettre l'acquisition et la gestion des evenements
         :return:
         """
-        LIBUSB_SUCCESS = libusb1.LIBUSB_SUCCESS
+        LIBUSB_SUCCESS = self.lib.LIBUSB_SUCCESS
         rc = 0
         while rc == LIBUSB_SUCCESS and self.num_pkt < self.n_pkt:
 
-            rc = libusb1.libusb_handle_events(NULL)
+            rc = self.lib.libusb_handle_events(NULL)
             #print("ac")
-            if self.last_pkt == 1 and self.usbh.version == 2:
-                msg = ctypes.create_string_buffer(16)
-                print(self.num_pkt)
-                print ('packet end')
-                if(self.interactif==1):
-                    self.num_pkt = self.n_pkt
-                time.sleep(1)
-                self.usbh.write_command(0xC1, msg, 0)
+            if self.a_rearmer and self.etat == 1:
+                self.rearme()
+            self.fin_paquets()
 
             if rc != LIBUSB_SUCCESS:
                 print ("ERREUR dans la gestion des events")
                 break
+        if self.interactif == 1:
+            self.ring.fin()
+        self.fin_observateurs()
 
     def __str__(self):
         chaine = 50 * '=' + '\n'
@@ -525,5 +1133,33 @@ class MegaMicros():
         chaine = chaine + "nombre de taches de fond : " + str(self.n_tdf) + '\n'
         chaine = chaine + "taille des paquets : " + str(self.s_pkt) + '\n'
         chaine = chaine + "taille du dernier paquet : " + str(self.s_l_pkt) + '\n'
+        if self.autotune == 1:
+            duree_pkt = self.s_pkt / (4. * self.nb_voies * self.frequence)
+            chaine = chaine + "configuration automatique : latence cible " + str(self.latence * 1000) + " ms, " + \
+                     "reserve " + str(self.reserve * 1000) + " ms -> paquets de " + \
+                     str(round(duree_pkt * 1000, 2)) + " ms, " + str(self.n_tdf) + " transferts couvrant " + \
+                     str(round(self.n_tdf * duree_pkt * 1000, 1)) + " ms\n"
+        if self.interactif == 1:
+            chaine = chaine + str(self.ring) + '\n'
+        elif self.ecriture_async == 1:
+            chaine = chaine + str(self.writer) + '\n'
+        if self.erreurs_transfert:
+            chaine = chaine + "transferts en erreur : " + str(self.erreurs_transfert) + " (paquets " + \
+                     str([p[0] for p in list(self.paquets_en_erreur)[-10:]]) + ")\n"
+        if self.rearmements:
+            chaine = chaine + "rearmements du boitier : " + str(len(self.rearmements)) + " (tixels " + \
+                     str([r[0] for r in self.rearmements[-10:]]) + ")\n"
+        if self.mots_retardes:
+            chaine = chaine + "mots retardes par les timeouts : " + str(self.mots_retardes) + "\n"
+        if self.verif is not None:
+            chaine = chaine + str(self.verif) + '\n'
+        if self.stats is not None:
+            chaine = chaine + str(self.stats) + '\n'
+        if self.declencheur is not None:
+            chaine = chaine + str(self.declencheur) + '\n'
+        if self.serveur is not None:
+            chaine = chaine + str(self.serveur) + '\n'
+        if self.sante is not None:
+            chaine = chaine + str(self.sante) + '\n'
         chaine = chaine + 50 * '=' + '\n'
         return chaine
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+"""
+Decimation polyphase en flux des paquets, avant leur stockage (disque ou buffer interactif).
+
+Le filtre passe-bas est un sinus cardinal fenetre (Kaiser) de 2 * longueur * facteur + 1 coefficients,
+coupe a coupure * (frequence de sortie / 2). Seuls les echantillons conserves sont calcules : les
+fenetres des sorties (pas de facteur tixels) sont des vues as_strided sur le tampon d'entree et
+toutes les sorties de toutes les voies sont obtenues par un seul produit matriciel, ecrit dans un
+buffer prealloue puis borne a la plage des int32 (le depassement du filtre sur un signal proche
+de la pleine echelle sature au lieu de deborder).
+
+Les tixels qui n'ont pas encore servi sont conserves d'un paquet au suivant : la sortie ne depend
+pas du decoupage en paquets. Les colonnes brutes (le compteur) ne sont pas filtrees, elles sont
+sous-echantillonnees au centre de la fenetre : le compteur de sortie progresse de facteur par tixel.
+"""
+from __future__ import division
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+from megaSysteme_voies import indexeur
+
+INT32_MIN = float(np.iinfo(np.int32).min)
+INT32_MAX = float(np.iinfo(np.int32).max)
+
+
+def filtre_decimation(facteur, longueur=12, coupure=1.0, beta=8.):
+    """
+    coefficients du filtre passe-bas anti-repliement
+
+    :param facteur:     [int]   facteur de decimation
+    :param longueur:    [int]   demi-longueur du filtre en tixels de sortie
+    :param coupure:     [float] frequence de coupure en fraction de la frequence de Nyquist de sortie
+    :param beta:        [float] parametre de la fenetre de Kaiser
+    :return: np.array (2 * longueur * facteur + 1,) de gain unite en continu
+    """
+    n = 2 * longueur * facteur + 1
+    t = np.arange(n) - longueur * facteur
+    fc = 0.5 * coupure / facteur
+    h = 2 * fc * np.sinc(2 * fc * t) * np.kaiser(n, beta)
+    return h / h.sum()
+
+
+class Decimateur():
+    """
+    Decimation polyphase multi-voies avec etat conserve entre les paquets
+    """
+
+    def __init__(self, facteur, nb_voies, brutes=(), longueur=12, coupure=1.0, bloc_max=8192):
+        """
+        :param facteur:     [int]   facteur de decimation
+        :param nb_voies:    [int]   nombre de voies entrelacees
+        :param brutes:      [list]  colonnes recopiees sans filtrage (compteur)
+        :param longueur:    [int]   demi-longueur du filtre en tixels de sortie
+        :param coupure:     [float] frequence de coupure en fraction de la frequence de Nyquist de sortie
+        :param bloc_max:    [int]   nombre de tixels attendus par paquet, les buffers grandissent si besoin
+        :return:
+        """
+        self.facteur = int(facteur)
+        self.nb_voies = int(nb_voies)
+        self.brutes = np.unique(np.asarray(brutes, int) % self.nb_voies)
+        filtrees = np.setdiff1d(np.arange(self.nb_voies), self.brutes)
+        self.nb_filtrees = len(filtrees)
+        # le tampon range les colonnes filtrees en tete puis les brutes : les fenetres et les colonnes
+        # brutes y sont toujours des tranches ; rang[j] est la colonne du tampon de la colonne j
+        self.rang = np.argsort(np.concatenate((filtrees, self.brutes)))
+        if np.all(self.rang == np.arange(self.nb_voies)):
+            # cas courant (compteur en derniere colonne) : pas de permutation
+            self.rang = slice(None)
+        self.filtrees = indexeur(filtrees)
+        self.longueur = int(longueur)
+        self.h = filtre_decimation(self.facteur, self.longueur, coupure)
+        self.n_h = len(self.h)
+        self.centre = self.longueur * self.facteur  # position du coefficient central
+        self.n_tampon = 0       # tixels dans le tampon
+        self.reste = np.zeros((self.nb_voies,), np.int32)   # mots d'un tixel incomplet
+        self.n_reste = 0
+        self._alloue(bloc_max)
+
+    def _alloue(self, bloc_max):
+        self.bloc_max = int(bloc_max)
+        n = self.n_h + self.bloc_max + self.facteur
+        tampon = np.zeros((n, self.nb_voies))
+        if hasattr(self, 'tampon'):
+            tampon[:self.n_tampon] = self.tampon[:self.n_tampon]
+        self.tampon = tampon
+        n_sorties = n // self.facteur + 1
+        self.sortie = np.zeros((n_sorties, self.nb_voies), np.int32)
+        self.calcul = np.zeros((n_sorties, self.nb_filtrees))
+
+    def traite(self, paquet):
+        """
+        decimation d'un paquet
+
+        :param paquet: [np.array int32 1D] mots du paquet (de longueur quelconque)
+        :return: np.array int32 (nb_tixels_sortie, nb_voies), vue sur un buffer reutilise valide
+                 jusqu'a l'appel suivant
+        """
+        nv = self.nb_voies
+        # realignement sur les tixels
+        debut = 0
+        if self.n_reste:
+            debut = min(nv - self.n_reste, len(paquet))
+            self.reste[self.n_reste:self.n_reste + debut] = paquet[:debut]
+            self.n_reste += debut
+        n_tixels = (len(paquet) - debut) // nv
+        if self.n_tampon + n_tixels + 1 > len(self.tampon):
+            self._alloue(n_tixels + 1)
+        if self.n_reste == nv:
+            self.tampon[self.n_tampon, self.rang] = self.reste
+            self.n_tampon += 1
+            self.n_reste = 0
+        fin = debut + n_tixels * nv
+        self.tampon[self.n_tampon:self.n_tampon + n_tixels, self.rang] = paquet[debut:fin].reshape((n_tixels, nv))
+        self.n_tampon += n_tixels
+        if fin < len(paquet):
+            self.n_reste = len(paquet) - fin
+            self.reste[:self.n_reste] = paquet[fin:]
+
+        # sorties completes : la fenetre de la sortie m couvre les tixels [m * facteur, m * facteur + n_h[
+        n_sorties = max(0, (self.n_tampon - self.n_h) // self.facteur + 1)
+        if n_sorties == 0:
+            return self.sortie[:0]
+        pas_t, pas_v = self.tampon.strides
+        fenetres = as_strided(self.tampon, shape=(n_sorties, self.n_h, self.nb_filtrees),
+                              strides=(self.facteur * pas_t, pas_t, pas_v), writeable=False)
+        calcul = self.calcul[:n_sorties]
+        np.matmul(self.h, fenetres, out=calcul)
+        np.clip(calcul, INT32_MIN, INT32_MAX, out=calcul)
+        sortie = self.sortie[:n_sorties]
+        sortie[:, self.filtrees] = np.rint(calcul, out=calcul)
+        fin_centres = self.centre + self.facteur * (n_sorties - 1) + 1
+        sortie[:, self.brutes] = self.tampon[self.centre:fin_centres:self.facteur, self.nb_filtrees:]
+
+        # on garde les tixels qui serviront aux sorties suivantes
+        consommes = n_sorties * self.facteur
+        self.n_tampon -= consommes
+        self.tampon[:self.n_tampon] = self.tampon[consommes:consommes + self.n_tampon]
+        return sortie
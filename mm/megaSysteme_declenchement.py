@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+"""
+Enregistrement declenche : seuls les evenements sonores sont ecrits sur le disque.
+
+Le Declencheur est un observateur de MegaMicros : a chaque paquet, il calcule le niveau des voies
+choisies (crete de chaque tixel, ou valeur efficace sur des fenetres de quelques ms) et le compare
+a un seuil, sans boucle sur les tixels. Quand le seuil est franchi, l'evenement (historique avant
+le declenchement + fenetre apres) est confie a un thread d'ecriture qui le recopie depuis le buffer
+interactif, sans deplacer son curseur de lecture, au fur et a mesure que les tixels arrivent :
+
+    Mm = System128(duree=3600., interactif=1, ...)
+    declencheur = Mm.init_declenchement(seuil=2000, voies='mems', pre=0.5, post=1.)
+
+Chaque evenement est ecrit dans un fichier .dat (int32 entrelaces, comme buffer2disque) et decrit
+par une ligne JSON du fichier d'index <prefixe>.jsonl. L'historique disponible est limite par la
+capacite du buffer interactif ; les tixels deja ecrases sont comptes dans 'perdus'.
+"""
+from __future__ import division
+import json
+import os
+import threading
+import time
+import numpy as np
+from megaSysteme_voies import indexeur
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+MODES = ('niveau', 'energie')
+
+
+class Declencheur():
+    """
+    Detection vectorisee des depassements de seuil, paquet par paquet (observateur de MegaMicros)
+    """
+
+    def __init__(self, colonnes, seuil, enregistreur, mode='niveau', fenetre=256, pre=0, post=0):
+        """
+        :param colonnes:        [list]  colonnes surveillees
+        :param seuil:           [float] seuil de declenchement (unites des echantillons) : crete en mode
+                                        'niveau', valeur efficace sur la fenetre en mode 'energie'
+        :param enregistreur:    EnregistreurEvenements qui recoit les evenements
+        :param mode:            [str]   'niveau' ou 'energie'
+        :param fenetre:         [int]   taille des fenetres du mode 'energie' (tixels)
+        :param pre:             [int]   historique ecrit avant le declenchement (tixels)
+        :param post:            [int]   fenetre ecrite apres le declenchement (tixels), pendant laquelle
+                                        le declencheur ne se rearme pas
+        :return:
+        """
+        if mode not in MODES:
+            raise ValueError("mode de declenchement inconnu : " + str(mode))
+        self.colonnes = indexeur(colonnes)
+        self.seuil = float(seuil)
+        self.enregistreur = enregistreur
+        self.mode = mode
+        self.fenetre = int(fenetre)
+        self.pre = int(pre)
+        self.post = max(1, int(post))
+        self.tixels = 0         # indice absolu du prochain tixel
+        self.rearme = 0         # premier tixel pouvant declencher
+        self.reste = np.zeros((self.fenetre,))     # puissances des tixels d'une fenetre incomplete
+        self.n_reste = 0
+        self.evenements = 0
+
+    def paquet(self, bloc):
+        """
+        :param bloc: [np.array (nb_tixels, nb_voies)] tixels consecutifs du flux
+        :return:
+        """
+        n = len(bloc)
+        if n == 0:
+            return
+        x = bloc[:, self.colonnes]
+        if self.mode == 'niveau':
+            niveaux = np.maximum(x.max(axis=1).astype(np.int64), -x.min(axis=1).astype(np.int64))
+            positions = np.arange(n)
+        else:
+            niveaux, positions = self._energie(x)
+        depasse = np.flatnonzero(niveaux > self.seuil)
+        if len(depasse):
+            tixels = self.tixels + positions[depasse]
+            k = np.searchsorted(tixels, self.rearme)
+            while k < len(depasse):
+                self._declenche(int(tixels[k]), float(niveaux[depasse[k]]))
+                k = np.searchsorted(tixels, self.rearme)
+        self.tixels += n
+
+    def _energie(self, x):
+        """
+        valeur efficace (toutes voies confondues) des fenetres completees par le bloc
+
+        :return: niveaux et positions (dans le bloc) du debut de chaque fenetre
+        """
+        p = np.square(x, dtype=np.float64).mean(axis=1)
+        q = np.concatenate((self.reste[:self.n_reste], p))
+        nb = len(q) // self.fenetre
+        niveaux = np.sqrt(q[:nb * self.fenetre].reshape((nb, self.fenetre)).mean(axis=1))
+        positions = np.arange(nb) * self.fenetre - self.n_reste
+        self.n_reste = len(q) - nb * self.fenetre
+        self.reste[:self.n_reste] = q[nb * self.fenetre:]
+        return niveaux, positions
+
+    def _declenche(self, tixel, niveau):
+        self.evenements += 1
+        self.rearme = tixel + self.post
+        self.enregistreur.ajoute(tixel, max(0, tixel - self.pre), tixel + self.post, niveau)
+
+    def fin(self):
+        """
+        fin du flux : les evenements en cours sont ecrits avec les tixels disponibles
+        """
+        self.enregistreur.termine()
+
+    def close(self):
+        self.enregistreur.close()
+
+    def __str__(self):
+        chaine = "declenchement (" + self.mode + ", seuil " + str(self.seuil) + ") : " + \
+                 str(self.evenements) + " evenements, " + str(self.enregistreur)
+        return chaine
+
+
+class EnregistreurEvenements():
+    """
+    Thread d'ecriture des evenements, recopies depuis le buffer interactif
+    """
+
+    def __init__(self, ring, repertoire='.', prefixe='evenement', frequence=0., taille_copie=8192, attente=0.01):
+        """
+        :param ring:            buffer interactif (RingBuffer ou RingPartage)
+        :param repertoire:      [str]   repertoire des fichiers d'evenements
+        :param prefixe:         [str]   prefixe des fichiers (<prefixe>_0001.dat, ..., index <prefixe>.jsonl)
+        :param frequence:       [float] frequence des tixels (Hz), reportee dans l'index
+        :param taille_copie:    [int]   nombre de tixels recopies a la fois
+        :param attente:         [float] attente (s) entre deux verifications de l'arrivee des tixels
+        :return:
+        """
+        self.ring = ring
+        self.nb_voies = int(ring.nb_voies)
+        self.repertoire = repertoire
+        self.prefixe = prefixe
+        self.frequence = float(frequence)
+        self.taille_copie = int(taille_copie)
+        self.attente = attente
+        self.copie = np.empty((self.taille_copie, self.nb_voies), ring.buffer.dtype)
+        self.index = open(os.path.join(repertoire, prefixe + '.jsonl'), 'a')
+        self.file = queue.Queue()
+        self.fin_flux = threading.Event()
+        self.ecrits = 0         # evenements ecrits
+        self.tixels = 0         # tixels ecrits
+        self.perdus = 0         # tixels d'evenements deja ecrases dans le buffer
+        self.erreur = None      # exception levee dans le thread d'ecriture
+        self.numero = 0
+        self.thread = threading.Thread(target=self._boucle)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def ajoute(self, declenchement, debut, fin, niveau):
+        """
+        confie un evenement au thread d'ecriture (appele depuis le callback, ne bloque pas)
+
+        :param declenchement:   [int] indice absolu du tixel de declenchement
+        :param debut:           [int] indice absolu du premier tixel a ecrire
+        :param fin:             [int] indice absolu du tixel suivant le dernier a ecrire
+        :param niveau:          [float] niveau ayant declenche
+        :return:
+        """
+        self.numero += 1
+        self.file.put((self.numero, declenchement, debut, fin, niveau, time.time()))
+
+    def _boucle(self):
+        while True:
+            evenement = self.file.get()
+            if evenement is None:
+                break
+            try:
+                self._ecrit(*evenement)
+            except (IOError, OSError) as e:
+                self.erreur = e
+
+    def _ecrit(self, numero, declenchement, debut, fin, niveau, date):
+        nom = self.prefixe + '_' + '%04d' % numero + '.dat'
+        position = debut
+        perdus = 0
+        with open(os.path.join(self.repertoire, nom), 'wb') as f:
+            while position < fin:
+                disponible = min(self.ring.ecrit // self.nb_voies, fin)
+                if position == disponible:
+                    if self.fin_flux.is_set():
+                        break
+                    time.sleep(self.attente)
+                    continue
+                ancien = self.ring.plus_ancien()
+                if position < ancien:
+                    perdus += min(ancien, fin) - position
+                    position = min(ancien, fin)
+                    continue
+                n = min(self.taille_copie, disponible - position)
+                bloc = self.ring.copie(position, n, out=self.copie[:n])
+                if bloc is None:
+                    # ecrase pendant la copie : on repart du plus ancien tixel present
+                    continue
+                f.write(bloc.tobytes())
+                position += n
+        self.ecrits += 1
+        self.tixels += position - debut - perdus
+        self.perdus += perdus
+        ligne = {'numero': numero, 'fichier': nom, 'date': date, 'niveau': niveau,
+                 'declenchement': declenchement, 'debut': debut, 'nb_tixels': position - debut - perdus,
+                 'perdus': perdus, 'nb_voies': self.nb_voies, 'frequence': self.frequence}
+        self.index.write(json.dumps(ligne) + '\n')
+        self.index.flush()
+
+    def termine(self):
+        """
+        fin du flux : les evenements en attente ne recevront plus de tixels
+        """
+        self.fin_flux.set()
+
+    def close(self):
+        """
+        arrete le thread une fois les evenements en attente ecrits
+        """
+        self.fin_flux.set()
+        self.file.put(None)
+        self.thread.join()
+        self.index.close()
+
+    def __str__(self):
+        chaine = str(self.ecrits) + " evenements ecrits, " + str(self.tixels) + " tixels, " + \
+                 str(self.perdus) + " tixels perdus"
+        return chaine
@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+"""
+Enveloppes min / max / valeur efficace des voies, a plusieurs resolutions, pour la visualisation.
+
+L'Enveloppe est un observateur de MegaMicros : a chaque paquet, les tixels sont regroupes par
+paquets de resolutions[0] tixels (niveau 0), puis les points du niveau 0 par groupes de
+resolutions[1] / resolutions[0] points (niveau 1), etc. Chaque niveau garde ses derniers points
+dans un buffer circulaire de taille fixe : la memoire ne depend pas de la duree de l'acquisition,
+et les niveaux grossiers couvrent un historique plus long.
+
+Un afficheur ne lit que les points dont il a besoin : pour une fenetre de temps et une largeur en
+pixels, lit() choisit le niveau le plus grossier qui donne au moins un point par pixel :
+
+    enveloppe = Mm.init_enveloppe(resolutions=(64, 512, 4096, 32768))
+    (thread d'affichage) debut, resolution, mins, maxs, rms = Mm.get_enveloppe(10., 800)
+
+Pour 10 s et 800 pixels, une trame fait 10 a 20 ko par voie, contre 2 Mo par voie de tixels bruts.
+"""
+from __future__ import division
+import numpy as np
+from megaSysteme_voies import indexeur
+
+
+class NiveauEnveloppe():
+    """
+    Un niveau de la pyramide : regroupement par 'facteur' des points du niveau inferieur
+    """
+
+    def __init__(self, facteur, nb_voies, capacite):
+        """
+        :param facteur:     [int] nombre de points du niveau inferieur (ou de tixels) par point
+        :param nb_voies:    [int] nombre de voies
+        :param capacite:    [int] nombre de points conserves
+        :return:
+        """
+        self.facteur = int(facteur)
+        self.nb_voies = int(nb_voies)
+        self.capacite = int(capacite)
+        self.mins = np.zeros((self.capacite, self.nb_voies), np.int32)
+        self.maxs = np.zeros((self.capacite, self.nb_voies), np.int32)
+        self.carres = np.zeros((self.capacite, self.nb_voies), np.float32)     # carre moyen
+        self.ecrits = 0         # nombre total de points produits
+        # point en cours de construction
+        self.p_min = np.zeros((self.nb_voies,), np.int32)
+        self.p_max = np.zeros((self.nb_voies,), np.int32)
+        self.p_somme = np.zeros((self.nb_voies,), np.float64)
+        self.p_n = 0
+
+    def _accumule(self, mins, maxs, carres):
+        if self.p_n == 0:
+            self.p_min[:] = mins.min(axis=0)
+            self.p_max[:] = maxs.max(axis=0)
+            self.p_somme[:] = carres.sum(axis=0)
+        else:
+            np.minimum(self.p_min, mins.min(axis=0), out=self.p_min)
+            np.maximum(self.p_max, maxs.max(axis=0), out=self.p_max)
+            self.p_somme += carres.sum(axis=0)
+        self.p_n += len(mins)
+
+    def ajoute(self, mins, maxs, carres):
+        """
+        :param mins:    [np.array (n, nb_voies)] minima des points (ou tixels) du niveau inferieur
+        :param maxs:    [np.array (n, nb_voies)] maxima
+        :param carres:  [np.array (n, nb_voies)] carres moyens
+        :return: points produits (mins, maxs, carres), chacun (nb_points, nb_voies)
+        """
+        f = self.facteur
+        n = len(mins)
+        points = []
+        i = 0
+        if self.p_n:
+            # fin du point commence au paquet precedent
+            i = min(f - self.p_n, n)
+            self._accumule(mins[:i], maxs[:i], carres[:i])
+            if self.p_n == f:
+                points.append((self.p_min[None, :].copy(), self.p_max[None, :].copy(),
+                               (self.p_somme / f).astype(np.float32)[None, :]))
+                self.p_n = 0
+        m = (n - i) // f
+        if m:
+            forme = (m, f, self.nb_voies)
+            fin = i + m * f
+            points.append((mins[i:fin].reshape(forme).min(axis=1),
+                           maxs[i:fin].reshape(forme).max(axis=1),
+                           carres[i:fin].reshape(forme).mean(axis=1, dtype=np.float64).astype(np.float32)))
+            i = fin
+        if i < n:
+            self._accumule(mins[i:], maxs[i:], carres[i:])
+        if not points:
+            return None
+        if len(points) == 1:
+            sortie = points[0]
+        else:
+            sortie = tuple(np.concatenate(p) for p in zip(*points))
+        self._ecrit(*sortie)
+        return sortie
+
+    def _ecrit(self, mins, maxs, carres):
+        q = len(mins)
+        for tableau, valeurs in ((self.mins, mins), (self.maxs, maxs), (self.carres, carres)):
+            if q >= self.capacite:
+                tableau[:] = np.roll(valeurs[-self.capacite:], self.ecrits + q, axis=0)
+                continue
+            debut = self.ecrits % self.capacite
+            coupe = min(q, self.capacite - debut)
+            tableau[debut:debut + coupe] = valeurs[:coupe]
+            tableau[:q - coupe] = valeurs[coupe:]
+        # le compteur n'est publie qu'une fois les points en place
+        self.ecrits += q
+
+    def copie(self, p0, p1, lignes, groupe=1):
+        """
+        :param p0, p1:  [int]  indices absolus des points [p0, p1[, (p1 - p0) multiple de groupe
+        :param lignes:  [list] voies a copier, None pour toutes
+        :param groupe:  [int]  nombre de points regroupes en un point de sortie
+        :return: (mins, maxs, rms) (nb_voies_choisies, (p1 - p0) / groupe), ou None si les points ont
+                 ete ecrases pendant la copie
+        """
+        indices = np.arange(p0, p1) % self.capacite
+        if lignes is not None:
+            indices = np.ix_(indices, lignes)
+        mins, maxs, carres = self.mins[indices], self.maxs[indices], self.carres[indices]
+        if p0 < self.ecrits - self.capacite:
+            return None
+        if groupe > 1:
+            forme = (-1, groupe, mins.shape[1])
+            mins = mins.reshape(forme).min(axis=1)
+            maxs = maxs.reshape(forme).max(axis=1)
+            carres = carres.reshape(forme).mean(axis=1)
+        return (np.ascontiguousarray(mins.T), np.ascontiguousarray(maxs.T),
+                np.ascontiguousarray(np.sqrt(carres).T))
+
+
+class Enveloppe():
+    """
+    Pyramide d'enveloppes des voies surveillees (observateur de MegaMicros)
+    """
+
+    def __init__(self, colonnes, frequence, resolutions=(64, 512, 4096, 32768), capacite=4096):
+        """
+        :param colonnes:    [list]  colonnes des blocs a suivre
+        :param frequence:   [float] frequence des tixels (Hz)
+        :param resolutions: [list]  nombre de tixels par point de chaque niveau, chacun multiple du precedent
+        :param capacite:    [int]   nombre de points conserves par niveau
+        :return:
+        """
+        resolutions = [int(r) for r in resolutions]
+        if any(r2 % r1 for r1, r2 in zip(resolutions[:-1], resolutions[1:])):
+            raise ValueError("chaque resolution doit etre un multiple de la precedente : " + str(resolutions))
+        self.colonnes_suivies = np.asarray(colonnes, int)
+        self.colonnes = indexeur(self.colonnes_suivies)
+        self.lignes = dict((int(c), i) for i, c in enumerate(self.colonnes_suivies))
+        self.nb_voies = len(self.colonnes_suivies)
+        self.frequence = float(frequence)
+        self.resolutions = resolutions
+        facteurs = [resolutions[0]] + [r2 // r1 for r1, r2 in zip(resolutions[:-1], resolutions[1:])]
+        self.niveaux = [NiveauEnveloppe(f, self.nb_voies, capacite) for f in facteurs]
+        self.tixels = 0
+
+    def paquet(self, bloc):
+        """
+        :param bloc: [np.array (nb_tixels, nb_voies)] tixels consecutifs du flux
+        :return:
+        """
+        if len(bloc) == 0:
+            return
+        x = bloc[:, self.colonnes]
+        points = (x, x, np.square(x, dtype=np.float32))
+        for niveau in self.niveaux:
+            points = niveau.ajoute(*points)
+            if points is None:
+                break
+        self.tixels += len(bloc)
+
+    def lit(self, debut, fin, nb_pixels, lignes=None):
+        """
+        enveloppe d'une fenetre de tixels : les points du niveau le plus grossier qui en donne au moins
+        nb_pixels (ou du niveau le plus fin) sont regroupes pour en garder entre nb_pixels et 2 * nb_pixels.
+        Les groupes sont alignes sur des indices absolus : une fenetre glissante donne des points stables.
+
+        :param debut, fin:  [int]  indices absolus des tixels [debut, fin[
+        :param nb_pixels:   [int]  nombre de points souhaite
+        :param lignes:      [list] voies a lire (rangs dans les colonnes suivies), None pour toutes
+        :return: (indice du premier tixel, resolution, mins, maxs, rms) : tableaux (nb_voies, nb_points),
+                 chaque voie contigue ; nb_points peut etre inferieur a nb_pixels si l'historique est court,
+                 et nul si la fenetre est plus ancienne que l'historique du niveau choisi
+        """
+        choix = 0
+        for k, resolution in enumerate(self.resolutions):
+            if (fin - debut) // resolution >= nb_pixels:
+                choix = k
+        resolution = self.resolutions[choix]
+        niveau = self.niveaux[choix]
+        groupe = max(1, (fin - debut) // resolution // max(1, nb_pixels))
+        while True:
+            # fenetre limitee a l'historique du niveau
+            ecrits = niveau.ecrits
+            p1 = min(fin // resolution, ecrits) // groupe * groupe
+            p0 = -(-max(debut // resolution, ecrits - niveau.capacite, 0) // groupe) * groupe
+            if p0 >= p1:
+                # fenetre hors de l'historique (ou plus courte qu'un groupe) : aucun point
+                nb = self.nb_voies if lignes is None else len(lignes)
+                return (p1 * resolution, resolution * groupe, np.zeros((nb, 0), np.int32),
+                        np.zeros((nb, 0), np.int32), np.zeros((nb, 0), np.float32))
+            donnees = niveau.copie(p0, p1, lignes, groupe)
+            if donnees is not None:
+                return (p0 * resolution, resolution * groupe) + donnees
+            # points ecrases pendant la copie : la fenetre est recalee sur le nouvel historique
+
+    def derniers(self, duree, nb_pixels, lignes=None):
+        """
+        :param duree:       [float] duree de la fenetre (s), terminee au dernier tixel recu
+        :param nb_pixels:   [int]   nombre de points souhaite
+        :return: cf. lit()
+        """
+        return self.lit(self.tixels - int(duree * self.frequence), self.tixels, nb_pixels, lignes)
+
+    def __str__(self):
+        chaine = "enveloppes : " + str(self.nb_voies) + " voies, resolutions " + str(self.resolutions) + \
+                 " tixels, historique " + \
+                 str([round(n.capacite * r / self.frequence, 1) for n, r in zip(self.niveaux, self.resolutions)]) + " s"
+        return chaine
@@ -0,0 +1,318 @@
+# -*- coding: utf-8 -*-
+"""
+Format d'enregistrement par blocs (.mmc) avec metadonnees d'acquisition.
+
+Structure du fichier :
+
+    'MMC1' | taille de l'entete (uint32) | entete JSON (nb_voies, frequence, clockdiv, mems, va, cpt, datatype, ...)
+    bloc 0 : 'CHNK' | premier tixel (uint64) | nb tixels (uint32) | taille des donnees (uint32) | codec (uint8) | donnees
+    bloc 1 ...
+    index  : pour chaque bloc (premier tixel uint64, position uint64, nb tixels uint32)
+    'MIDX' | position de l'index (uint64) | nombre de blocs (uint32)
+
+L'index final permet d'aller directement au bloc qui contient un instant donne. S'il est absent
+(enregistrement interrompu), il est reconstruit en parcourant les entetes de blocs.
+
+Codecs (sans perte) :
+    'raw'       donnees int32 brutes
+    'bitpack'   difference entre tixels successifs, codage zigzag, puis largeur de bits minimale par voie
+    'zstd'      difference + zigzag, compresses par zstandard (si le module est installe)
+    'lz4'       difference + zigzag, compresses par lz4 (si le module est installe)
+    'zlib'      difference + zigzag, compresses par zlib
+"""
+from __future__ import division
+import numpy as np
+import json
+import os
+import struct
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+MAGIC = b'MMC1'
+MAGIC_BLOC = b'CHNK'
+MAGIC_INDEX = b'MIDX'
+ENTETE_BLOC = struct.Struct('<4sQIIB')
+ENTREE_INDEX = struct.Struct('<QQI')
+PIED = struct.Struct('<4sQI')
+
+CODECS = {'raw': 0, 'bitpack': 1, 'zlib': 2, 'zstd': 3, 'lz4': 4}
+NOMS_CODECS = dict((v, k) for k, v in CODECS.items())
+
+
+def codec_par_defaut():
+    """
+    :return: le meilleur codec disponible sur cette machine
+    """
+    if zstandard is not None:
+        return 'zstd'
+    if lz4 is not None:
+        return 'lz4'
+    return 'bitpack'
+
+
+def _zigzag_differences(bloc):
+    """
+    :param bloc: [np.array int32 (n, nb_voies)]
+    :return: (premier tixel int32 (nb_voies,), differences codees en zigzag uint32 (nb_voies, n - 1))
+    """
+    d = np.diff(bloc.astype(np.int64), axis=0)
+    # difference modulo 2**32 ramenee dans l'intervalle des int32
+    d = ((d + (1 << 31)) & 0xFFFFFFFF) - (1 << 31)
+    z = ((d << 1) ^ (d >> 63)).astype('<u4')
+    return bloc[0].copy(), np.ascontiguousarray(z.T)
+
+
+def _integre(premier, z):
+    """
+    inverse de _zigzag_differences
+
+    :return: np.array int32 (n, nb_voies)
+    """
+    z = z.astype(np.int64)
+    d = (z >> 1) ^ -(z & 1)
+    cumul = np.cumsum(np.concatenate([premier.astype(np.int64)[:, None], d], axis=1), axis=1)
+    return np.ascontiguousarray((cumul & 0xFFFFFFFF).astype('<u4').view('<i4').T)
+
+
+def encode(bloc, codec):
+    """
+    compression sans perte d'un bloc
+
+    :param bloc:    [np.array int32 (n, nb_voies)]
+    :param codec:   [str] nom du codec
+    :return: bytes
+    """
+    bloc = np.ascontiguousarray(bloc).view('<i4')
+    if codec == 'raw' or len(bloc) < 2:
+        return bloc.tobytes()
+    premier, z = _zigzag_differences(bloc)
+    if codec == 'bitpack':
+        largeurs = np.array([int(v).bit_length() for v in z.max(axis=1)], np.uint8)
+        morceaux = [premier.tobytes(), largeurs.tobytes()]
+        for c in range(len(z)):
+            if largeurs[c]:
+                bits = np.unpackbits(z[c].view(np.uint8), bitorder='little').reshape((-1, 32))[:, :largeurs[c]]
+                morceaux.append(np.packbits(bits, bitorder='little').tobytes())
+        return b''.join(morceaux)
+    donnees = premier.tobytes() + z.tobytes()
+    if codec == 'zstd':
+        return zstandard.ZstdCompressor(level=1).compress(donnees)
+    if codec == 'lz4':
+        return lz4.frame.compress(donnees)
+    if codec == 'zlib':
+        return zlib.compress(donnees, 1)
+    raise ValueError("codec inconnu : " + str(codec))
+
+
+def decode(donnees, codec, nb_tixels, nb_voies):
+    """
+    inverse de encode
+
+    :return: np.array int32 (nb_tixels, nb_voies)
+    """
+    if codec == 'raw' or nb_tixels < 2:
+        return np.frombuffer(donnees, '<i4').reshape((nb_tixels, nb_voies)).astype(np.int32)
+    if codec == 'bitpack':
+        premier = np.frombuffer(donnees, '<i4', nb_voies)
+        largeurs = np.frombuffer(donnees, np.uint8, nb_voies, 4 * nb_voies)
+        z = np.zeros((nb_voies, nb_tixels - 1), '<u4')
+        position = 5 * nb_voies
+        for c in range(nb_voies):
+            w = int(largeurs[c])
+            if w == 0:
+                continue
+            n_octets = ((nb_tixels - 1) * w + 7) // 8
+            bits = np.unpackbits(np.frombuffer(donnees, np.uint8, n_octets, position), bitorder='little')
+            mots = np.zeros((nb_tixels - 1, 32), np.uint8)
+            mots[:, :w] = bits[:(nb_tixels - 1) * w].reshape((-1, w))
+            z[c] = np.packbits(mots, bitorder='little').view('<u4')
+            position += n_octets
+        return _integre(premier, z)
+    if codec == 'zstd':
+        donnees = zstandard.ZstdDecompressor().decompress(donnees)
+    elif codec == 'lz4':
+        donnees = lz4.frame.decompress(donnees)
+    elif codec == 'zlib':
+        donnees = zlib.decompress(donnees)
+    else:
+        raise ValueError("codec inconnu : " + str(codec))
+    premier = np.frombuffer(donnees, '<i4', nb_voies)
+    z = np.frombuffer(donnees, '<u4', offset=4 * nb_voies).reshape((nb_voies, nb_tixels - 1))
+    return _integre(premier, z)
+
+
+class ChunkWriter():
+    """
+    Ecriture d'un fichier .mmc a partir du flux brut de paquets (non alignes sur les tixels)
+    """
+
+    def __init__(self, fichier, metadonnees, codec=None, tixels_par_bloc=50000):
+        """
+        :param fichier:         [str]  chemin du fichier
+        :param metadonnees:     [dict] metadonnees d'acquisition (doit contenir nb_voies), cf. MegaMicros.metadonnees
+        :param codec:           [str]  codec de compression (par defaut codec_par_defaut())
+        :param tixels_par_bloc: [int]  nombre de tixels par bloc
+        :return:
+        """
+        self.codec = codec_par_defaut() if codec is None else codec
+        if self.codec not in CODECS:
+            raise ValueError("codec inconnu : " + str(self.codec))
+        self.nb_voies = int(metadonnees['nb_voies'])
+        self.tixels_par_bloc = int(tixels_par_bloc)
+        self.metadonnees = dict(metadonnees, codec=self.codec, tixels_par_bloc=self.tixels_par_bloc)
+        self.Filep = open(fichier, 'wb')
+        entete = json.dumps(self.metadonnees).encode('utf-8')
+        self.Filep.write(MAGIC + struct.pack('<I', len(entete)) + entete)
+        self.bloc = np.zeros((self.tixels_par_bloc * self.nb_voies,), np.int32)
+        self.n_mots = 0         # mots en attente dans self.bloc
+        self.tixel = 0          # premier tixel du bloc en cours
+        self.index = []
+        self.octets_bruts = 0
+        self.octets_ecrits = 0
+
+    def fileno(self):
+        return self.Filep.fileno()
+
+    def write(self, paquet):
+        """
+        ajoute un paquet (octets int32 entrelaces) au bloc en cours, ecrit les blocs complets
+
+        :param paquet: objet supportant le protocole buffer (bytes, memoryview, np.array)
+        """
+        mots = np.frombuffer(paquet, np.int32)
+        self.octets_bruts += 4 * len(mots)
+        while len(mots):
+            n = min(len(mots), len(self.bloc) - self.n_mots)
+            self.bloc[self.n_mots:self.n_mots + n] = mots[:n]
+            self.n_mots += n
+            mots = mots[n:]
+            if self.n_mots == len(self.bloc):
+                self._ecrit_bloc(self.tixels_par_bloc)
+
+    def _ecrit_bloc(self, nb_tixels):
+        donnees = encode(self.bloc[:nb_tixels * self.nb_voies].reshape((nb_tixels, self.nb_voies)), self.codec)
+        self.index.append((self.tixel, self.Filep.tell(), nb_tixels))
+        self.Filep.write(ENTETE_BLOC.pack(MAGIC_BLOC, self.tixel, nb_tixels, len(donnees), CODECS[self.codec]))
+        self.Filep.write(donnees)
+        self.octets_ecrits += ENTETE_BLOC.size + len(donnees)
+        reste = self.n_mots - nb_tixels * self.nb_voies
+        self.bloc[:reste] = self.bloc[nb_tixels * self.nb_voies:self.n_mots]
+        self.n_mots = reste
+        self.tixel += nb_tixels
+
+    def taux(self):
+        """
+        :return: taux de compression (octets ecrits / octets bruts)
+        """
+        return self.octets_ecrits / max(self.octets_bruts, 1)
+
+    def close(self):
+        """
+        ecrit le dernier bloc (tixels complets uniquement) et l'index, puis ferme le fichier
+        """
+        if self.n_mots >= self.nb_voies:
+            self._ecrit_bloc(self.n_mots // self.nb_voies)
+        position = self.Filep.tell()
+        for entree in self.index:
+            self.Filep.write(ENTREE_INDEX.pack(*entree))
+        self.Filep.write(PIED.pack(MAGIC_INDEX, position, len(self.index)))
+        self.Filep.flush()
+        os.fsync(self.Filep.fileno())
+        self.Filep.close()
+
+
+class LectureMMC():
+    """
+    Lecture d'un fichier .mmc : seuls les blocs qui recouvrent la zone demandee sont decompresses
+    """
+
+    def __init__(self, fichier):
+        self.fichier = fichier
+        self.Filep = open(fichier, 'rb')
+        if self.Filep.read(4) != MAGIC:
+            raise ValueError(fichier + " n'est pas un fichier .mmc")
+        taille = struct.unpack('<I', self.Filep.read(4))[0]
+        self.metadonnees = json.loads(self.Filep.read(taille).decode('utf-8'))
+        self.debut_blocs = 8 + taille
+        self.nb_voies = int(self.metadonnees['nb_voies'])
+        self.frequence = float(self.metadonnees['frequence'])
+        self._lit_index()
+        self.nb_tixels = int(self.premiers[-1] + self.longueurs[-1]) if len(self.premiers) else 0
+
+    def _lit_index(self):
+        self.Filep.seek(0, os.SEEK_END)
+        fin = self.Filep.tell()
+        index = None
+        if fin - self.debut_blocs >= PIED.size:
+            self.Filep.seek(fin - PIED.size)
+            magic, position, n = PIED.unpack(self.Filep.read(PIED.size))
+            if magic == MAGIC_INDEX:
+                self.Filep.seek(position)
+                brut = self.Filep.read(n * ENTREE_INDEX.size)
+                index = [ENTREE_INDEX.unpack_from(brut, i * ENTREE_INDEX.size) for i in range(n)]
+        if index is None:
+            # pas d'index : enregistrement interrompu, on parcourt les entetes de blocs
+            index = []
+            position = self.debut_blocs
+            while position + ENTETE_BLOC.size <= fin:
+                self.Filep.seek(position)
+                magic, tixel, n, taille, codec = ENTETE_BLOC.unpack(self.Filep.read(ENTETE_BLOC.size))
+                if magic != MAGIC_BLOC or position + ENTETE_BLOC.size + taille > fin:
+                    break
+                index.append((tixel, position, n))
+                position += ENTETE_BLOC.size + taille
+        self.premiers = np.array([e[0] for e in index], np.int64)
+        self.positions = np.array([e[1] for e in index], np.int64)
+        self.longueurs = np.array([e[2] for e in index], np.int64)
+
+    def __len__(self):
+        return self.nb_tixels
+
+    def duree(self):
+        return self.nb_tixels / self.frequence
+
+    def lit_bloc(self, i):
+        """
+        :param i: [int] numero du bloc
+        :return: np.array int32 (nb_tixels du bloc, nb_voies)
+        """
+        self.Filep.seek(self.positions[i])
+        magic, tixel, n, taille, codec = ENTETE_BLOC.unpack(self.Filep.read(ENTETE_BLOC.size))
+        return decode(self.Filep.read(taille), NOMS_CODECS[codec], n, self.nb_voies)
+
+    def lire(self, t0=0., t1=None, voies=None):
+        """
+        lecture d'une fenetre temporelle pour une selection de voies
+
+        :param t0:      [float] debut de la fenetre (s)
+        :param t1:      [float] fin de la fenetre (s), None pour la fin du fichier
+        :param voies:   [list]  indices des voies a lire, None pour toutes
+        :return: np.array (nb_tixels, nb_voies_lues)
+        """
+        i0 = min(max(int(round(t0 * self.frequence)), 0), self.nb_tixels)
+        i1 = self.nb_tixels if t1 is None else min(max(int(round(t1 * self.frequence)), i0), self.nb_tixels)
+        colonnes = slice(None) if voies is None else voies
+        morceaux = []
+        b0 = max(np.searchsorted(self.premiers, i0, side='right') - 1, 0)
+        for b in range(b0, len(self.premiers)):
+            debut = self.premiers[b]
+            if debut >= i1:
+                break
+            bloc = self.lit_bloc(b)
+            morceaux.append(bloc[max(i0 - debut, 0):i1 - debut, colonnes])
+        if not morceaux:
+            n = self.nb_voies if voies is None else len(voies)
+            return np.zeros((0, n), np.int32)
+        return np.concatenate(morceaux)
+
+    def close(self):
+        self.Filep.close()
@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+"""
+Verification de la continuite de la voie compteur (cpt=1).
+
+Le boitier incremente le compteur a chaque tixel : dans un flux sans perte, la derniere
+colonne vaut c0, c0 + 1, c0 + 2, ... (modulo 2**32). Un trou se traduit par :
+    - des tixels invalides : presents dans le flux mais dont le compteur est faux (paquet perdu
+      remplace par des zeros, cf. MegaMicros.perte_paquet) ;
+    - des tixels perdus : le compteur reprend plus loin que prevu.
+
+La verification est vectorisee par bloc : seuls les trous sont traites tixel par tixel.
+Elle s'utilise en ligne comme observateur (Mm.init_verif_compteur()) ou hors ligne sur un
+fichier .dat (verifie_dat), qui peut alors ecrire une copie ou les trous sont combles.
+"""
+from __future__ import division
+import collections
+import os
+import numpy as np
+
+MASQUE = 0xFFFFFFFF
+MARQUE = np.iinfo(np.int32).min  # valeur des voies dans les tixels de remplissage en mode 'marque'
+
+# indice : tixel du flux ou commence le trou, compteur : valeur attendue a cet endroit,
+# invalides : tixels du flux a ecarter, perdus : tixels du boitier absents ou invalides
+Trou = collections.namedtuple('Trou', ['indice', 'compteur', 'invalides', 'perdus'])
+
+
+class VerifCompteur():
+    """
+    Verification en flux de la continuite du compteur
+    """
+
+    def __init__(self, colonne=-1, saut_max=1 << 30, pas=1):
+        """
+        :param colonne:     [int] colonne du compteur dans les tixels (la derniere par defaut)
+        :param saut_max:    [int] saut de compteur maximal accepte comme une reprise apres un trou :
+                                  au-dela, le compteur est considere comme faux (tixel invalide)
+        :param pas:         [int] progression du compteur d'un tixel au suivant (facteur de decimation)
+        :return:
+        """
+        self.colonne = colonne
+        self.saut_max = int(saut_max)
+        self.pas = int(pas)
+        self.attendu = None     # compteur attendu pour le prochain tixel
+        self.tixels = 0         # nombre de tixels verifies
+        self.trou = None        # trou en cours (indice, compteur) quand il se prolonge sur le bloc suivant
+        self.trous = []         # liste des Trou
+        self.tixels_invalides = 0
+        self.tixels_perdus = 0
+
+    def paquet(self, bloc):
+        """
+        verification d'un bloc de tixels (observateur de MegaMicros)
+
+        :param bloc: [np.array (nb_tixels, nb_voies)] tixels consecutifs du flux
+        :return:
+        """
+        n = len(bloc)
+        if n == 0:
+            return
+        c = bloc[:, self.colonne].astype(np.int64) & MASQUE
+        if self.attendu is None:
+            self.attendu = int(c[0])
+        i = 0
+        while i < n:
+            if self.trou is None:
+                ecart = (c[i:] - (self.attendu + self.pas * np.arange(n - i))) & MASQUE
+                faux = np.flatnonzero(ecart)
+                if len(faux) == 0:
+                    self.attendu = (self.attendu + self.pas * (n - i)) & MASQUE
+                    break
+                self.attendu = (self.attendu + self.pas * int(faux[0])) & MASQUE
+                i += int(faux[0])
+                self.trou = (self.tixels + i, self.attendu)
+            # reprise : premier tixel dont le compteur est en avance (ou egal) sur le compteur attendu
+            avance = (c[i:] - self.trou[1]) & MASQUE
+            reprise = np.flatnonzero(avance < self.saut_max)
+            if len(reprise) == 0:
+                break
+            j = i + int(reprise[0])
+            self._ferme_trou(self.tixels + j, int(avance[reprise[0]]) // self.pas)
+            self.attendu = int(c[j])
+            i = j
+        self.tixels += n
+
+    def reprise(self):
+        """
+        le compteur repart d'une nouvelle valeur (rearmement du boitier en acquisition continue) :
+        le prochain tixel donne le nouveau compteur attendu
+        """
+        self.attendu = None
+
+    def _ferme_trou(self, indice_reprise, perdus):
+        indice, compteur = self.trou
+        trou = Trou(indice, compteur, indice_reprise - indice, perdus)
+        self.trous.append(trou)
+        self.tixels_invalides += trou.invalides
+        self.tixels_perdus += trou.perdus
+        self.trou = None
+
+    def fin(self):
+        """
+        fin du flux : un trou en cours est ferme (ses tixels invalides sont comptes comme perdus)
+        """
+        if self.trou is not None:
+            self._ferme_trou(self.tixels, self.tixels - self.trou[0])
+
+    def resume(self):
+        """
+        :return: dictionnaire des compteurs de la verification
+        """
+        return {'tixels': self.tixels,
+                'trous': len(self.trous),
+                'tixels_invalides': self.tixels_invalides,
+                'tixels_perdus': self.tixels_perdus}
+
+    def __str__(self):
+        chaine = "verification du compteur : " + str(self.tixels) + " tixels, " + str(len(self.trous)) + \
+                 " trous, " + str(self.tixels_perdus) + " tixels perdus, " + \
+                 str(self.tixels_invalides) + " tixels invalides"
+        return chaine
+
+
+def _remplissage(nb_tixels, nb_voies, colonne, compteur, remplissage, pas=1):
+    """
+    tixels de remplissage : compteur restitue, autres voies a zero ('zero') ou a MARQUE ('marque')
+    """
+    valeur = 0 if remplissage == 'zero' else MARQUE
+    bloc = np.full((nb_tixels, nb_voies), valeur, np.int32)
+    compteurs = (compteur + pas * np.arange(nb_tixels)) & MASQUE
+    bloc[:, colonne] = compteurs.astype(np.uint32).view(np.int32)
+    return bloc
+
+
+def repare_dat(data, trous, sortie, colonne=-1, remplissage='zero', taille_bloc=1 << 16, pas=1):
+    """
+    copie des tixels en remplacant chaque trou par des tixels de remplissage :
+    le fichier de sortie a un compteur continu
+
+    :param data:        [np.array (nb_tixels, nb_voies)] tixels d'origine (memmap)
+    :param trous:       [list] trous trouves par VerifCompteur
+    :param sortie:      [str]  fichier .dat de sortie
+    :param colonne:     [int]  colonne du compteur
+    :param remplissage: [str]  'zero' ou 'marque'
+    :param taille_bloc: [int]  nombre de tixels copies ou generes a la fois
+    :param pas:         [int]  progression du compteur d'un tixel au suivant
+    :return:
+    """
+    if remplissage not in ('zero', 'marque'):
+        raise ValueError("remplissage inconnu : " + str(remplissage))
+    nb_voies = data.shape[1]
+    with open(sortie, 'wb') as f:
+        lu = 0
+        for trou in list(trous) + [Trou(len(data), 0, 0, 0)]:
+            for debut in range(lu, trou.indice, taille_bloc):
+                f.write(np.ascontiguousarray(data[debut:min(debut + taille_bloc, trou.indice)]).tobytes())
+            for debut in range(0, trou.perdus, taille_bloc):
+                n = min(taille_bloc, trou.perdus - debut)
+                f.write(_remplissage(n, nb_voies, colonne, trou.compteur + pas * debut, remplissage, pas).tobytes())
+            lu = trou.indice + trou.invalides
+
+
+def verifie_dat(nomfic, nb_voies, colonne=-1, sortie=None, remplissage='zero', taille_bloc=1 << 16, pas=1):
+    """
+    verification hors ligne d'un fichier .dat (int32 entrelaces)
+
+    :param nomfic:      [str] fichier .dat
+    :param nb_voies:    [int] nombre de voies entrelacees (compteur compris)
+    :param colonne:     [int] colonne du compteur
+    :param sortie:      [str] si donne, fichier .dat de sortie ou les trous sont combles (cf. repare_dat)
+    :param remplissage: [str] 'zero' ou 'marque'
+    :param taille_bloc: [int] nombre de tixels verifies a la fois
+    :param pas:         [int] progression du compteur d'un tixel au suivant (facteur de decimation)
+    :return: l'objet VerifCompteur (trous et compteurs)
+    """
+    nb_voies = int(nb_voies)
+    nb_tixels = os.path.getsize(nomfic) // (4 * nb_voies)
+    verif = VerifCompteur(colonne, pas=pas)
+    if nb_tixels == 0:
+        return verif
+    data = np.memmap(nomfic, dtype=np.int32, mode='r', shape=(nb_tixels, nb_voies))
+    for debut in range(0, nb_tixels, taille_bloc):
+        verif.paquet(data[debut:debut + taille_bloc])
+    verif.fin()
+    if sortie is not None:
+        repare_dat(data, verif.trous, sortie, colonne=colonne, remplissage=remplissage, taille_bloc=taille_bloc,
+                   pas=pas)
+    return verif
@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+"""
+Acquisition synchronisee sur plusieurs boitiers System128.
+
+Tous les boitiers sont ouverts dans le contexte libusb par defaut : une seule boucle
+libusb_handle_events traite les transferts de tous les boitiers, sans un processus (ni un
+thread) par boitier. Chaque boitier est en mode interactif avec le compteur actif ; la
+session aligne les flux sur la valeur du compteur puis fournit un flux unique rangé par voie :
+
+    session = MultiSystem128([{'serial': 'A'}, {'serial': 'B'}], duree=60.)
+    session.start()
+    (thread) session.show()
+    res, data = session.get_data(0.1)   # data : (nb_voies_total, nb_tixels)
+
+On suppose que les compteurs des boitiers partagent la meme base de temps (horloge et
+declenchement communs) : deux tixels de meme compteur sont alors simultanes.
+"""
+from __future__ import division
+import numpy as np
+import megaSysteme_128 as mega
+
+NULL = None
+MASQUE_COMPTEUR = 0xffffffff    # compteur du boitier sur 32 bits
+MOITIE_COMPTEUR = 1 << 31
+
+
+class MultiSystem128():
+    """
+    Session d'acquisition sur plusieurs boitiers, alignes sur leur voie compteur
+    """
+
+    def __init__(self, selections, mems=None, va=None, **kwargs):
+        """
+        :param selections:  [list] un dictionnaire par boitier avec les cles 'bus', 'port' et/ou 'serial'
+        :param mems:        [bool np.array(16,8) ou liste] MEMS actifs, communs ou par boitier
+        :param va:          [bool np.array(4,) ou liste]   voies analogiques actives, communes ou par boitier
+        :param kwargs:      autres parametres de System128 (duree, clockdiv, politique, backend, ...)
+        :return:
+        """
+        n = len(selections)
+        if mems is None:
+            mems = np.ones((16, 8), bool)
+        if va is None:
+            va = np.zeros((4,), bool)
+        if not isinstance(mems, (list, tuple)):
+            mems = [mems] * n
+        if not isinstance(va, (list, tuple)):
+            va = [va] * n
+        kwargs['cpt'] = 1
+        kwargs['interactif'] = 1
+        self.unites = []
+        for i, selection in enumerate(selections):
+            self.unites.append(mega.System128(mems=mems[i], va=va[i], bus=selection.get('bus'),
+                                              port=selection.get('port'), serial=selection.get('serial'),
+                                              **kwargs))
+        for unite in self.unites:
+            unite.init_voies(np.arange(unite.nb_voies), dtype=np.int32)
+        self.lib = self.unites[0].lib
+        self.frequence = self.unites[0].frequence_sortie
+        self.nb_voies = [int(u.nb_voies) for u in self.unites]
+        self.nb_voies_total = sum(self.nb_voies)
+        # premiere ligne de chaque boitier dans le flux fusionne
+        self.premieres_voies = np.cumsum([0] + self.nb_voies[:-1])
+        self.aligne = False
+        self.desynchronisations = 0
+        self.sortie = None
+
+    def start(self):
+        for unite in self.unites:
+            unite.start()
+
+    def stop(self):
+        for unite in self.unites:
+            unite.stop()
+
+    def termine(self):
+        return all(u.num_pkt >= u.n_pkt for u in self.unites)
+
+    def show(self):
+        """
+        boucle unique de gestion des evenements pour tous les boitiers
+        """
+        LIBUSB_SUCCESS = self.lib.LIBUSB_SUCCESS
+        rc = LIBUSB_SUCCESS
+        while rc == LIBUSB_SUCCESS and not self.termine():
+            rc = self.lib.libusb_handle_events(NULL)
+            for unite in self.unites:
+                if unite.num_pkt < unite.n_pkt:
+                    unite.fin_paquets()
+            if rc != LIBUSB_SUCCESS:
+                print ("ERREUR dans la gestion des events")
+                break
+        for unite in self.unites:
+            unite.ring.fin()
+            unite.fin_observateurs()
+
+    def compteurs(self):
+        """
+        :return: valeur du compteur du plus ancien tixel non lu de chaque boitier (None si vide)
+        """
+        compteurs = []
+        for unite in self.unites:
+            tixel = unite.ring.premier_tixel()
+            compteurs.append(None if tixel is None else int(tixel[unite.carte.colonne_cpt]) & MASQUE_COMPTEUR)
+        return compteurs
+
+    def aligne_flux(self):
+        """
+        saute, dans chaque boitier, les tixels anterieurs au premier compteur commun
+
+        Le compteur du boitier est sur 32 bits : les ecarts sont calcules modulo 2**32 (un ecart
+        de plus de 2**31 tixels est compte comme une avance de l'autre boitier).
+
+        :return: True si les flux sont alignes
+        """
+        compteurs = self.compteurs()
+        if None in compteurs:
+            return False
+        # boitier le plus en avance, par rapport au premier
+        reference = compteurs[0]
+        avance = max(((c - reference + MOITIE_COMPTEUR) & MASQUE_COMPTEUR) - MOITIE_COMPTEUR for c in compteurs)
+        cible = (reference + avance) & MASQUE_COMPTEUR
+        for unite, compteur in zip(self.unites, compteurs):
+            ecart = (cible - compteur) & MASQUE_COMPTEUR
+            if unite.ring.skip(ecart) != ecart:
+                return False
+        self.aligne = self.compteurs() == [cible] * len(self.unites)
+        return self.aligne
+
+    def colonne(self, unite, voie):
+        """
+        :param unite:   [int] indice du boitier
+        :param voie:    nom de la voie ou (faisceau, micro) (cf. CarteVoies.colonne)
+        :return: ligne de la voie dans les blocs de get_data
+        """
+        return int(self.premieres_voies[unite]) + self.unites[unite].carte.colonne(voie)
+
+    def get_data(self, duree, out=None):
+        """
+        bloc synchrone de tous les boitiers
+
+        :param duree: [float] duree du bloc (s)
+        :param out:   [np.array int32 (nb_voies_total, nb_tixels)] buffer prealloue a remplir (optionnel)
+        :return:
+        res = 1 si la fct retourne un bloc, 0 sinon
+        data (nb_voies_total, nb_tixels) : voies de chaque boitier les unes sous les autres,
+        chaque voie contigue en memoire. Sans out, le tableau est reutilise d'un appel a l'autre.
+        """
+        nb_tixels = int(duree * self.frequence)
+        if not self.aligne and not self.aligne_flux():
+            return 0, None
+        if min(u.ring.available() for u in self.unites) < nb_tixels:
+            return 0, None
+        if out is None:
+            if self.sortie is None or self.sortie.shape[1] != nb_tixels:
+                self.sortie = np.zeros((self.nb_voies_total, nb_tixels), np.int32)
+            out = self.sortie
+        premiers = []
+        for unite, ligne, nv in zip(self.unites, self.premieres_voies, self.nb_voies):
+            res, bloc = unite.get_data(duree)
+            unite.desentrelaceur.traite(bloc, out=out[ligne:ligne + nv])
+            premiers.append(int(bloc[0, unite.carte.colonne_cpt]))
+        if premiers != [premiers[0]] * len(premiers):
+            # un boitier a perdu des donnees : on realigne au bloc suivant
+            self.desynchronisations += 1
+            self.aligne = False
+        return 1, out
+
+    def close(self):
+        for unite in self.unites:
+            unite.close()
+
+    def __str__(self):
+        chaine = 50 * '=' + '\n'
+        chaine = chaine + ' Session Megamicros : ' + str(len(self.unites)) + ' boitiers, ' + \
+            str(self.nb_voies_total) + ' voies\n'
+        for i, unite in enumerate(self.unites):
+            chaine = chaine + ' boitier ' + str(i) + ' (serial ' + str(unite.usbh.serial) + ') : ' + \
+                str(unite.nb_voies) + ' voies, ' + str(unite.ring) + '\n'
+        chaine = chaine + ' desynchronisations : ' + str(self.desynchronisations) + '\n'
+        chaine = chaine + 50 * '=' + '\n'
+        return chaine
@@ -0,0 +1,433 @@
+# -*- coding: utf-8 -*-
+"""
+Traitements lourds dans un pool de processus alimente par un buffer circulaire en memoire partagee
+(Python 3.8 et plus : multiprocessing.shared_memory).
+
+Le callback libusb ecrit les paquets dans un buffer circulaire place en memoire partagee et,
+a chaque bloc complet, confie l'indice du bloc a une file de taches. Les processus du pool lisent
+le bloc directement dans la memoire partagee (sans copie), appliquent la fonction de traitement et
+renvoient le resultat par une file de resultats. Le processus d'acquisition ne fait que recopier
+les paquets : le GIL reste disponible pour le callback, les traitements utilisent tous les coeurs.
+
+Le meme buffer peut etre diffuse a d'autres processus locaux (affichage, enregistrement, analyse) :
+chaque abonne s'attache a la memoire partagee par son nom et lit avec son propre curseur, le
+producteur n'ecrit qu'une fois quel que soit le nombre d'abonnes (cf. Abonne, Mm.init_diffusion).
+
+    def energie(bloc):                  # fonction du niveau module (transmise aux processus)
+        return (bloc[:, :-1].astype(float) ** 2).mean(axis=0)
+
+    Mm = System128(duree=60., interactif=1)
+    pool = Mm.init_pool_dsp(energie, duree_bloc=0.1, nb_processus=4)
+    Mm.start()
+    (thread) Mm.show()
+    for indice, resultat in pool:       # resultats dans l'ordre des blocs, jusqu'a la fin de show
+        ...
+    Mm.close()
+    pool.close()
+
+Le callback n'attend jamais les processus : un bloc ecrase avant (ou pendant) son traitement est
+signale comme perdu (resultat None, compte dans pool.blocs_perdus).
+"""
+from __future__ import division
+import os
+import multiprocessing
+import numpy as np
+from multiprocessing import shared_memory, resource_tracker
+from megaSysteme_ring import RingBuffer
+
+# entete de la memoire partagee (int64)
+ECRIT = 0           # nombre total de mots ecrits
+CAPACITE = 1        # capacite du buffer en mots
+NB_VOIES = 2
+TAILLE_BLOC = 3     # taille des blocs en tixels
+ETAT = 4            # EN_COURS ou FIN
+FREQUENCE = 5       # frequence d'echantillonnage en mHz
+TAILLE_ENTETE = 8
+
+EN_COURS = 0
+FIN = 1
+
+_CREEES = set()     # memoires partagees creees par ce processus (cf. _attache)
+
+
+class RingPartage(RingBuffer):
+    """
+    Buffer circulaire en memoire partagee, decoupe en blocs qui ne sont jamais coupes par le retour a zero
+    """
+
+    def __init__(self, nb_blocs, taille_bloc, nb_voies, taches=None, frequence=0.):
+        """
+        :param nb_blocs:    [int]   capacite du buffer en blocs
+        :param taille_bloc: [int]   taille des blocs en tixels
+        :param nb_voies:    [int]   nombre de voies par tixel
+        :param taches:      file (multiprocessing.Queue) recevant l'indice de chaque bloc complet
+        :param frequence:   [float] frequence d'echantillonnage (Hz), transmise aux abonnes
+        :return:
+        """
+        self.nb_voies = int(nb_voies)
+        self.taille_bloc = int(taille_bloc)
+        self.mots_bloc = self.taille_bloc * self.nb_voies
+        self.capacite = int(nb_blocs) * self.mots_bloc
+        self.memoire = shared_memory.SharedMemory(create=True, size=8 * TAILLE_ENTETE + 4 * self.capacite)
+        self.entete = np.ndarray((TAILLE_ENTETE,), np.int64, self.memoire.buf)
+        self.entete[:] = 0
+        self.entete[CAPACITE] = self.capacite
+        self.entete[NB_VOIES] = self.nb_voies
+        self.entete[TAILLE_BLOC] = self.taille_bloc
+        self.entete[FREQUENCE] = int(round(frequence * 1000))
+        self.nom = self.memoire.name
+        _CREEES.add(self.nom)
+        self.buffer = np.ndarray((self.capacite,), np.int32, self.memoire.buf, 8 * TAILLE_ENTETE)
+        self.politique = 'drop_oldest'
+        self.timeout = 0.
+        self.taches = taches
+        self.ecrit = 0
+        self.lu = 0         # curseur d'un eventuel lecteur get_data dans le processus d'acquisition
+        self.lecteur = False    # True des la premiere lecture de ce lecteur
+        self.overruns = 0   # debordements constates par ce lecteur
+        self.perdus = 0     # tixels ecrases avant d'avoir ete lus par ce lecteur
+        self.blocs = 0      # nombre de blocs complets confies aux processus
+
+    def write(self, paquet):
+        """
+        ecriture d'un paquet (cote producteur) : le producteur n'attend jamais, les donnees
+        les plus anciennes sont ecrasees. Comme pour RingBuffer en 'drop_oldest', les tixels ecrases
+        avant d'avoir ete lus par le lecteur du processus d'acquisition (get_data) sont comptes dans
+        perdus, des sa premiere lecture ; les pertes du pool sont comptees dans PoolDSP.blocs_perdus.
+
+        :param paquet: [np.array 1D] mots a ecrire, de longueur quelconque
+        :return: True
+        """
+        n = len(paquet)
+        if n > self.capacite:
+            raise ValueError("paquet plus grand que le buffer circulaire")
+        if self.lecteur and n > self.free():
+            self.overruns += 1
+            lu = self.lu
+            self.perdus += self._retard(self.ecrit + n, lu) - self._retard(self.ecrit, lu)
+        debut = self.ecrit % self.capacite
+        fin = debut + n
+        if fin <= self.capacite:
+            self.buffer[debut:fin] = paquet
+        else:
+            coupe = self.capacite - debut
+            self.buffer[debut:] = paquet[:coupe]
+            self.buffer[:fin - self.capacite] = paquet[coupe:]
+        # le curseur n'est publie qu'une fois les donnees en place
+        self.ecrit += n
+        self.entete[ECRIT] = self.ecrit
+        complets = self.ecrit // self.mots_bloc
+        if self.taches is None:
+            self.blocs = complets
+        while self.blocs < complets:
+            self.taches.put(self.blocs)
+            self.blocs += 1
+        return True
+
+    def read(self, nb_tixels, out=None):
+        """
+        lecture d'un bloc par le lecteur du processus d'acquisition (cf. RingBuffer.read)
+        """
+        self.lecteur = True
+        return RingBuffer.read(self, nb_tixels, out=out)
+
+    def skip(self, nb_tixels):
+        self.lecteur = True
+        return RingBuffer.skip(self, nb_tixels)
+
+    def fin(self):
+        """
+        fin de l'ecriture : les processus s'arretent une fois les taches en attente traitees
+        """
+        if self.entete is not None:
+            self.entete[ETAT] = FIN
+        if self.taches is not None:
+            self.taches.put(None)
+
+    def libere(self):
+        """
+        supprime la memoire partagee (elle disparait quand le dernier processus la detache)
+        """
+        if self.entete is None:
+            return
+        self.entete = None
+        self.buffer = None
+        try:
+            self.memoire.close()
+        except BufferError:
+            # une vue (Mm.data, bloc retourne par get_data) existe encore dans ce processus
+            pass
+        self.memoire.unlink()
+        _CREEES.discard(self.nom)
+
+    def __str__(self):
+        chaine = "buffer circulaire partage " + self.nom + " : " + \
+                 str(self.capacite // self.mots_bloc) + " blocs de " + str(self.taille_bloc) + " tixels, " + \
+                 str(self.blocs) + " blocs produits"
+        return chaine
+
+
+def _attache(nom, suivi_partage=False):
+    """
+    attache une memoire partagee creee par un autre processus, sans que le resource_tracker la
+    supprime a la sortie de ce processus
+
+    Python 3.13 et plus : SharedMemory(track=False). Avant, l'attachement l'enregistre toujours
+    aupres du resource_tracker du processus et l'enregistrement est annule ici, sauf si ce
+    resource_tracker est celui du createur : c'est le cas du createur lui-meme et d'un processus
+    lance par multiprocessing depuis le createur (processus du pool), pour qui l'enregistrement est
+    sans effet et l'annuler retirerait celui du createur.
+
+    :param nom:             [str]  nom de la memoire partagee
+    :param suivi_partage:   [bool] le processus partage le resource_tracker du createur
+    :return: l'objet SharedMemory
+    """
+    try:
+        return shared_memory.SharedMemory(name=nom, track=False)
+    except TypeError:
+        memoire = shared_memory.SharedMemory(name=nom)
+        if os.name == 'posix' and not suivi_partage and nom not in _CREEES:
+            # sous POSIX, le resource_tracker enregistre le nom avec le '/' initial que memoire.name omet
+            resource_tracker.unregister('/' + memoire.name.lstrip('/'), 'shared_memory')
+        return memoire
+
+
+class Abonne(RingBuffer):
+    """
+    Lecteur d'un RingPartage depuis un autre processus, avec son propre curseur de lecture
+
+    Le producteur ne connait pas ses abonnes et ne les attend jamais : un abonne en retard de plus
+    que la capacite du buffer perd les donnees les plus anciennes (comptees dans perdus et overruns).
+    """
+
+    def __init__(self, nom, depuis='direct'):
+        """
+        :param nom:     [str] nom de la memoire partagee (RingPartage.nom)
+        :param depuis:  [str] 'direct' : lecture a partir du prochain tixel produit,
+                              'debut'  : a partir du plus ancien tixel encore dans le buffer
+        :return:
+        """
+        self.memoire = _attache(nom)
+        self.nom = nom
+        self.entete = np.ndarray((TAILLE_ENTETE,), np.int64, self.memoire.buf)
+        self.capacite = int(self.entete[CAPACITE])
+        self.nb_voies = int(self.entete[NB_VOIES])
+        self.frequence = self.entete[FREQUENCE] / 1000.
+        self.buffer = np.ndarray((self.capacite,), np.int32, self.memoire.buf, 8 * TAILLE_ENTETE)
+        self.buffer.flags.writeable = False
+        self.politique = 'drop_oldest'
+        self.overruns = 0
+        self.perdus = 0     # tixels ecrases avant d'avoir ete lus
+        self.ecrases = 0    # blocs ecrases pendant leur copie (les donnees retournees sont incoherentes)
+        ecrit = self.ecrit
+        if depuis == 'direct':
+            self.lu = (ecrit // self.nb_voies) * self.nb_voies
+        else:
+            self.lu = 0
+            self._recale()
+
+    @property
+    def ecrit(self):
+        # curseur publie par le producteur
+        return int(self.entete[ECRIT])
+
+    def _recale(self):
+        retard = self.ecrit - self.lu
+        if retard > self.capacite:
+            if self.lu:
+                self.overruns += 1
+                self.perdus += (retard - self.capacite + self.nb_voies - 1) // self.nb_voies
+            RingBuffer._recale(self)
+
+    def retard(self):
+        """
+        :return: nombre de tixels produits et pas encore lus
+        """
+        return (self.ecrit - self.lu) // self.nb_voies
+
+    def read(self, nb_tixels, out=None):
+        """
+        lecture d'un bloc (cf. RingBuffer.read) : une vue quand le bloc est contigu, valide tant que
+        le producteur ne l'a pas ecrase (retard() inferieur a la capacite)
+        """
+        bloc = RingBuffer.read(self, nb_tixels, out=out)
+        if bloc is not None and self.ecrit > self.lu - nb_tixels * self.nb_voies + self.capacite:
+            self.ecrases += 1
+        return bloc
+
+    def get_data(self, duree, out=None):
+        """
+        :param duree:   [float] duree du bloc (s)
+        :param out:     [np.array (nb_tixels, nb_voies)] buffer de sortie optionnel (copie)
+        :return: (1, bloc (nb_tixels, nb_voies)) ou (0, None) si les donnees ne sont pas encore disponibles
+                 (en fin d'acquisition, les tixels qui ne forment pas un bloc complet sont abandonnes)
+        """
+        bloc = self.read(int(duree * self.frequence), out=out)
+        if bloc is None:
+            if self.entete[ETAT] == FIN:
+                # fin de l'acquisition : le dernier bloc incomplet est abandonne
+                self.skip(self.available())
+            return 0, None
+        return 1, bloc
+
+    def termine(self):
+        """
+        :return: True si l'acquisition est terminee et qu'il ne reste plus de tixel complet a lire
+        """
+        return self.entete[ETAT] == FIN and self.available() == 0
+
+    def close(self):
+        self.entete = None
+        self.buffer = None
+        try:
+            self.memoire.close()
+        except BufferError:
+            # un bloc retourne par read est encore reference
+            pass
+
+    def __str__(self):
+        chaine = "abonne a " + self.nom + " : retard " + str(self.retard()) + " tixels, " + \
+                 str(self.overruns) + " debordements, " + str(self.perdus) + " tixels perdus"
+        return chaine
+
+
+def _travailleur(nom, fonction, taches, resultats):
+    """
+    boucle d'un processus du pool : traite les blocs designes par la file de taches
+
+    Un bloc n'est valide que si le producteur ne l'a pas ecrase : on le verifie avant et apres
+    le traitement (le producteur publie ECRIT apres avoir ecrit les donnees).
+    """
+    memoire = _attache(nom, suivi_partage=True)
+    entete = np.ndarray((TAILLE_ENTETE,), np.int64, memoire.buf)
+    capacite, nb_voies, taille_bloc = int(entete[CAPACITE]), int(entete[NB_VOIES]), int(entete[TAILLE_BLOC])
+    mots_bloc = taille_bloc * nb_voies
+    data = np.ndarray((capacite,), np.int32, memoire.buf, 8 * TAILLE_ENTETE)
+    data.flags.writeable = False
+    while True:
+        k = taches.get()
+        if k is None:
+            # l'arret est transmis aux autres processus
+            taches.put(None)
+            break
+        debut = k * mots_bloc
+        if entete[ECRIT] > debut + capacite:
+            resultats.put((k, None, None))
+            continue
+        bloc = data[debut % capacite:debut % capacite + mots_bloc].reshape((taille_bloc, nb_voies))
+        try:
+            resultat = fonction(bloc)
+        except Exception as e:
+            resultats.put((k, None, repr(e)))
+            continue
+        del bloc
+        if entete[ECRIT] > debut + capacite:
+            resultat = None
+        resultats.put((k, resultat, None))
+    resultats.put(None)
+    del entete, data
+    memoire.close()
+
+
+class PoolDSP():
+    """
+    Pool de processus de traitement des blocs d'un RingPartage
+    """
+
+    def __init__(self, fonction, nb_blocs, taille_bloc, nb_voies, nb_processus=None, frequence=0.):
+        """
+        :param fonction:        fonction(bloc) -> resultat, executee dans les processus du pool ;
+                                bloc est une vue en lecture seule (taille_bloc, nb_voies) sur la memoire partagee
+        :param nb_blocs:        [int] capacite du buffer circulaire en blocs
+        :param taille_bloc:     [int] taille des blocs en tixels
+        :param nb_voies:        [int] nombre de voies par tixel
+        :param nb_processus:    [int] nombre de processus (par defaut le nombre de coeurs moins un)
+        :param frequence:       [float] frequence d'echantillonnage (Hz)
+        :return:
+        """
+        if nb_processus is None:
+            nb_processus = max(1, multiprocessing.cpu_count() - 1)
+        self.nb_processus = int(nb_processus)
+        self.taches = multiprocessing.Queue()
+        self.resultats = multiprocessing.Queue()
+        self.ring = RingPartage(nb_blocs, taille_bloc, nb_voies, taches=self.taches, frequence=frequence)
+        self.processus = []
+        for i in range(self.nb_processus):
+            p = multiprocessing.Process(target=_travailleur,
+                                        args=(self.ring.memoire.name, fonction, self.taches, self.resultats))
+            p.daemon = True
+            p.start()
+            self.processus.append(p)
+        self.actifs = self.nb_processus
+        self.blocs_traites = 0
+        self.blocs_perdus = 0
+        self._en_attente = {}   # resultats arrives avant ceux des blocs precedents
+        self._prochain = 0      # indice du prochain bloc a rendre dans l'ordre
+
+    def get(self, timeout=None):
+        """
+        prochain resultat, dans l'ordre d'arrivee
+
+        :param timeout: [float] attente maximale (s), None pour attendre indefiniment
+        :return: (indice du bloc, resultat) ; resultat vaut None si le bloc a ete ecrase avant la fin du traitement.
+                 None quand tous les processus sont arretes.
+        """
+        while self.actifs:
+            message = self.resultats.get(timeout=timeout)
+            if message is None:
+                self.actifs -= 1
+                continue
+            k, resultat, erreur = message
+            if erreur is not None:
+                raise RuntimeError("erreur dans le traitement du bloc " + str(k) + " : " + erreur)
+            if resultat is None:
+                self.blocs_perdus += 1
+            else:
+                self.blocs_traites += 1
+            return k, resultat
+        return None
+
+    def __iter__(self):
+        """
+        resultats dans l'ordre des blocs, jusqu'a l'arret des processus (fin de show)
+        """
+        while True:
+            message = self.get()
+            if message is None:
+                break
+            self._en_attente[message[0]] = message[1]
+            while self._prochain in self._en_attente:
+                yield self._prochain, self._en_attente.pop(self._prochain)
+                self._prochain += 1
+        for k in sorted(self._en_attente):
+            yield k, self._en_attente.pop(k)
+
+    def close(self):
+        """
+        arrete les processus et supprime la memoire partagee
+
+        Si la vidange de la file de resultats echoue (erreur d'un traitement, interruption), les
+        processus encore actifs sont termines ; la memoire partagee est liberee dans tous les cas.
+        """
+        vide = False
+        try:
+            self.ring.fin()
+            while self.actifs:
+                # vide la file de resultats : un processus ne se termine qu'une fois ses envois recus
+                if self.get() is None:
+                    break
+            vide = True
+        finally:
+            try:
+                for p in self.processus:
+                    p.join(None if vide else 1.)
+                    if p.is_alive():
+                        p.terminate()
+                        p.join()
+            finally:
+                self.ring.libere()
+
+    def __str__(self):
+        chaine = "pool de traitement : " + str(self.nb_processus) + " processus, " + \
+                 str(self.blocs_traites) + " blocs traites, " + str(self.blocs_perdus) + " blocs perdus"
+        return chaine
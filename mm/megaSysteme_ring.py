@@ -0,0 +1,267 @@
+# -*- coding: utf-8 -*-
+"""
+Buffer circulaire mono-producteur / mono-consommateur pour le mode interactif.
+
+Le producteur (callback libusb) ecrit des paquets de longueur quelconque, le consommateur
+(thread qui appelle get_data) lit des blocs d'un nombre entier de tixels.
+Les deux curseurs (ecrit, lu) sont des compteurs absolus de mots int32 qui ne font que croitre :
+chacun n'est modifie que par son proprietaire, il n'y a donc pas besoin de verrou.
+"""
+from __future__ import division
+import numpy as np
+import time
+
+POLITIQUES = ('block', 'drop_oldest', 'raise')
+
+
+class OverrunError(Exception):
+    """
+    Levee quand le producteur rattrape le consommateur (politique 'raise' ou 'block' apres timeout)
+    """
+    pass
+
+
+class RingBuffer():
+    """
+    Buffer circulaire de mots int32 organise en tixels de nb_voies mots
+    """
+
+    def __init__(self, nb_tixels, nb_voies, politique='drop_oldest', timeout=1.0, dtype=np.int32):
+        """
+        Initialisation du buffer circulaire
+
+        :param nb_tixels:   [int]   capacite du buffer en tixels
+        :param nb_voies:    [int]   nombre de voies par tixel
+        :param politique:   [str]   comportement quand le buffer est plein :
+                                    'block'       le producteur attend que le consommateur libere de la place ;
+                                                  le producteur etant le callback libusb, l'attente suspend
+                                                  le service de tous les transferts usb (cf. timeout)
+                                    'drop_oldest' les donnees les plus anciennes sont ecrasees
+                                    'raise'       le producteur leve OverrunError
+        :param timeout:     [float] attente maximale (s) du producteur en politique 'block', a garder
+                                    nettement inferieure a la duree d'un paquet
+        :param dtype:       type des donnees stockees
+        :return:
+        """
+        if politique not in POLITIQUES:
+            raise ValueError("politique inconnue : " + str(politique))
+        self.nb_voies = int(nb_voies)
+        # la capacite est un multiple de nb_voies : un tixel n'est jamais coupe par le retour a zero
+        self.capacite = int(nb_tixels) * self.nb_voies
+        self.buffer = np.zeros((self.capacite,), dtype)
+        self.politique = politique
+        self.timeout = timeout
+        self.ecrit = 0      # nombre total de mots ecrits (modifie par le producteur uniquement)
+        self.lu = 0         # nombre total de mots lus (modifie par le consommateur uniquement)
+        self.overruns = 0   # nombre de debordements constates
+        self.perdus = 0     # nombre de tixels perdus (ecrases ou rejetes)
+        self.a_sauter = 0   # mots du dernier tixel rejete, a sauter au debut du paquet suivant
+
+    def available(self):
+        """
+        :return: nombre de tixels disponibles pour la lecture
+        """
+        return min(self.ecrit - self.lu, self.capacite) // self.nb_voies
+
+    def free(self):
+        """
+        :return: nombre de mots libres pour l'ecriture
+        """
+        return self.capacite - (self.ecrit - self.lu)
+
+    def write(self, paquet):
+        """
+        ecriture d'un paquet (cote producteur)
+
+        Les paquets ne sont pas alignes sur les tixels : un paquet rejete (politiques 'raise' et
+        'block') complete d'abord le tixel en cours, puis seuls des tixels entiers sont abandonnes,
+        les mots restants du dernier tixel abandonne etant sautes au debut du paquet suivant.
+        Les voies restent ainsi dans leurs colonnes apres une perte.
+
+        :param paquet: [np.array 1D] mots a ecrire, de longueur quelconque
+        :return: True si le paquet a ete ecrit, False s'il a ete rejete
+        """
+        if self.a_sauter:
+            k = min(self.a_sauter, len(paquet))
+            paquet = paquet[k:]
+            self.a_sauter -= k
+        n = len(paquet)
+        if n > self.capacite:
+            raise ValueError("paquet plus grand que le buffer circulaire")
+        if n > self.free():
+            if self.politique == 'raise':
+                self._rejette(paquet)
+                raise OverrunError("buffer circulaire plein : le lecteur est en retard de "
+                                   + str(self.available()) + " tixels")
+            elif self.politique == 'block':
+                limite = time.time() + self.timeout
+                while n > self.free():
+                    if time.time() > limite:
+                        self._rejette(paquet)
+                        return False
+                    time.sleep(0.0005)
+            else:
+                # drop_oldest : on ecrase, le consommateur se recalera a la prochaine lecture ;
+                # seuls les tixels non lus nouvellement ecrases sont comptes
+                self.overruns += 1
+                lu = self.lu
+                self.perdus += self._retard(self.ecrit + n, lu) - self._retard(self.ecrit, lu)
+        self._copie(paquet)
+        return True
+
+    def _retard(self, ecrit, lu):
+        """
+        :return: nombre de tixels non lus ecrases quand 'ecrit' mots ont ete ecrits
+        """
+        return (max(0, ecrit - self.capacite - lu) + self.nb_voies - 1) // self.nb_voies
+
+    def _rejette(self, paquet):
+        """
+        rejet d'un paquet : le tixel en cours est complete (la place libre est toujours suffisante,
+        la capacite etant un multiple de nb_voies), les tixels suivants sont abandonnes en entier
+        """
+        complement = min((-self.ecrit) % self.nb_voies, len(paquet))
+        self._copie(paquet[:complement])
+        abandon = len(paquet) - complement
+        self.a_sauter = (-abandon) % self.nb_voies
+        self.overruns += 1
+        self.perdus += (abandon + self.nb_voies - 1) // self.nb_voies
+
+    def _copie(self, paquet):
+        n = len(paquet)
+        debut = self.ecrit % self.capacite
+        fin = debut + n
+        if fin <= self.capacite:
+            self.buffer[debut:fin] = paquet
+        else:
+            coupe = self.capacite - debut
+            self.buffer[debut:] = paquet[:coupe]
+            self.buffer[:fin - self.capacite] = paquet[coupe:]
+        # le curseur n'est publie qu'une fois les donnees en place
+        self.ecrit += n
+
+    def _recale(self):
+        """
+        en cas d'ecrasement, place le curseur de lecture sur le plus ancien tixel encore valide
+        """
+        retard = self.ecrit - self.lu
+        if retard > self.capacite:
+            mini = self.ecrit - self.capacite
+            self.lu = ((mini + self.nb_voies - 1) // self.nb_voies) * self.nb_voies
+
+    def read(self, nb_tixels, out=None):
+        """
+        lecture d'un bloc de nb_tixels tixels (cote consommateur)
+
+        Si le bloc est contigu dans le buffer et que out n'est pas fourni, on retourne une vue
+        (sans copie) : elle reste valide tant que le producteur n'a pas fait un tour complet.
+        En politique 'drop_oldest', un bloc dont le debut a ete ecrase pendant la copie n'est pas
+        retourne : le curseur n'avance pas et sera recale a la lecture suivante (les tixels ecrases
+        sont comptes dans perdus par le producteur).
+
+        :param nb_tixels: [int] nombre de tixels demandes
+        :param out:       [np.array (nb_tixels, nb_voies)] buffer de sortie optionnel
+        :return: tableau (nb_tixels, nb_voies) ou None si les donnees ne sont pas encore disponibles
+                 (ou ont ete ecrasees pendant la copie)
+        """
+        size = int(nb_tixels) * self.nb_voies
+        if size > self.capacite:
+            raise ValueError("bloc demande plus grand que le buffer circulaire")
+        self._recale()
+        if self.ecrit - self.lu < size:
+            return None
+        debut = self.lu % self.capacite
+        fin = debut + size
+        if fin <= self.capacite:
+            bloc = self.buffer[debut:fin].reshape((nb_tixels, self.nb_voies))
+            if out is not None:
+                out[...] = bloc
+                bloc = out
+        else:
+            if out is None:
+                out = np.empty((nb_tixels, self.nb_voies), self.buffer.dtype)
+            plat = out.reshape(-1)
+            coupe = self.capacite - debut
+            plat[:coupe] = self.buffer[debut:]
+            plat[coupe:] = self.buffer[:fin - self.capacite]
+            bloc = out
+        # le producteur a pu ecraser le debut du bloc pendant la copie
+        if self.lu < self.ecrit - self.capacite:
+            return None
+        self.lu += size
+        return bloc
+
+    def premier_tixel(self):
+        """
+        :return: vue sur le plus ancien tixel non lu, ou None si le buffer est vide
+        """
+        self._recale()
+        if self.ecrit - self.lu < self.nb_voies:
+            return None
+        debut = self.lu % self.capacite
+        return self.buffer[debut:debut + self.nb_voies]
+
+    def plus_ancien(self):
+        """
+        :return: indice absolu (depuis le debut du flux) du plus ancien tixel encore present dans le buffer
+        """
+        mini = max(0, self.ecrit - self.capacite)
+        return (mini + self.nb_voies - 1) // self.nb_voies
+
+    def copie(self, debut, nb_tixels, out=None):
+        """
+        copie de tixels reperes par leur indice absolu, sans deplacer le curseur de lecture
+        (lecture de l'historique par un autre thread que le consommateur)
+
+        :param debut:     [int] indice absolu du premier tixel
+        :param nb_tixels: [int] nombre de tixels
+        :param out:       [np.array (nb_tixels, nb_voies)] buffer de sortie optionnel
+        :return: tableau (nb_tixels, nb_voies), ou None si une partie des tixels n'est pas encore
+                 ecrite ou a ete ecrasee (y compris pendant la copie)
+        """
+        mot = int(debut) * self.nb_voies
+        size = int(nb_tixels) * self.nb_voies
+        if mot + size > self.ecrit or mot < self.ecrit - self.capacite:
+            return None
+        if out is None:
+            out = np.empty((nb_tixels, self.nb_voies), self.buffer.dtype)
+        plat = out.reshape(-1)
+        d = mot % self.capacite
+        coupe = min(size, self.capacite - d)
+        plat[:coupe] = self.buffer[d:d + coupe]
+        plat[coupe:] = self.buffer[:size - coupe]
+        # le producteur a pu ecraser le debut pendant la copie
+        if mot < self.ecrit - self.capacite:
+            return None
+        return out
+
+    def skip(self, nb_tixels):
+        """
+        avance le curseur de lecture sans copier de donnees
+
+        :param nb_tixels: [int] nombre de tixels a sauter
+        :return: nombre de tixels effectivement sautes
+        """
+        self._recale()
+        n = min(int(nb_tixels), self.available())
+        self.lu += n * self.nb_voies
+        return n
+
+    def fin(self):
+        """
+        fin de l'ecriture (appele par show a la fin de l'acquisition)
+        """
+        pass
+
+    def libere(self):
+        """
+        libere les ressources du buffer (appele par close)
+        """
+        pass
+
+    def __str__(self):
+        chaine = "buffer circulaire : " + str(self.capacite // self.nb_voies) + " tixels, " + \
+                 "politique " + self.politique + ", " + \
+                 str(self.available()) + " tixels disponibles, " + \
+                 str(self.overruns) + " debordements, " + str(self.perdus) + " tixels perdus"
+        return chaine
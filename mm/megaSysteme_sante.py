@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+"""
+Surveillance en flux de l'etat des voies : micros muets, saturations, derive de la composante continue.
+
+SanteVoies est un observateur de MegaMicros : a chaque paquet, il accumule pour toutes les voies
+surveillees a la fois (sans boucle sur les voies ni sur les tixels) la somme, la somme des carres,
+les extrema, le nombre d'echantillons satures et la longueur des suites de zeros. A la fin de chaque
+periode d'evaluation, il en deduit la composante continue, la valeur efficace (hors continu) et la
+crete de chaque voie, les compare aux limites et leve une alerte pour chaque voie qui passe en defaut :
+
+    sante = Mm.init_sante(duree=1., rms_min=1., dc_max=1e5)
+    Mm.start()
+    (autre thread) sante.snapshot()['rms'], sante.en_defaut(), sante.alertes_depuis(0)
+
+Types d'alerte :
+    'muette'     valeur efficace inferieure a rms_min
+    'atypique'   valeur efficace hors de [mediane / ecart_median, mediane * ecart_median] des voies
+    'saturation' proportion d'echantillons satures superieure a taux_saturation
+    'continu'    composante continue superieure a dc_max en valeur absolue
+    'zeros'      suite de zeros plus longue que duree_zeros
+"""
+from __future__ import division
+import collections
+import numpy as np
+from megaSysteme_voies import indexeur
+
+ALERTES = ('muette', 'atypique', 'saturation', 'continu', 'zeros')
+
+
+class SanteVoies():
+    """
+    Statistiques par voie en flux et alertes (observateur de MegaMicros)
+    """
+
+    def __init__(self, colonnes, noms, frequence, duree=1., saturation=np.iinfo(np.int32).max,
+                 rms_min=1., ecart_median=10., taux_saturation=1e-3, dc_max=None, duree_zeros=0.1,
+                 bloc_max=8192):
+        """
+        :param colonnes:        [list]  colonnes surveillees
+        :param noms:            [list]  noms des voies surveillees (reportes dans les alertes)
+        :param frequence:       [float] frequence des tixels (Hz)
+        :param duree:           [float] periode d'evaluation des statistiques (s)
+        :param saturation:      [int]   valeur absolue a partir de laquelle un echantillon est sature
+        :param rms_min:         [float] valeur efficace minimale d'une voie active, None pour ne pas verifier
+        :param ecart_median:    [float] rapport maximal a la mediane des valeurs efficaces, None pour ne pas verifier
+        :param taux_saturation: [float] proportion maximale d'echantillons satures sur la periode
+        :param dc_max:          [float] composante continue maximale (valeur absolue), None pour ne pas verifier
+        :param duree_zeros:     [float] duree maximale (s) d'une suite de zeros, None pour ne pas verifier
+        :param bloc_max:        [int]   taille de bloc attendue (tixels), le buffer grandit si besoin
+        :return:
+        """
+        self.nb_voies = len(colonnes)
+        self.colonnes = indexeur(colonnes)
+        self.noms = list(noms)
+        self.frequence = float(frequence)
+        self.periode = max(1, int(duree * self.frequence))
+        self.saturation = saturation
+        self.rms_min = rms_min
+        self.ecart_median = ecart_median
+        self.taux_saturation = taux_saturation
+        self.dc_max = dc_max
+        self.zeros_max = None if duree_zeros is None else int(duree_zeros * self.frequence)
+        self.carres = np.zeros((int(bloc_max), self.nb_voies), np.float32)
+
+        # accumulateurs de la periode en cours
+        nv = self.nb_voies
+        self.n = 0
+        self.somme = np.zeros((nv,), np.float64)
+        self.somme_carres = np.zeros((nv,), np.float64)
+        self.mini = np.zeros((nv,), np.int32)
+        self.maxi = np.zeros((nv,), np.int32)
+        self.satures = np.zeros((nv,), np.int64)
+        self.zeros_periode = np.zeros((nv,), np.int64)   # plus longue suite de zeros de la periode
+        self.zeros = np.zeros((nv,), np.int64)           # suite de zeros en cours
+        # cumuls depuis le debut
+        self.tixels = 0
+        self.satures_total = np.zeros((nv,), np.int64)
+        self.crete_totale = np.zeros((nv,), np.int64)
+
+        self.defauts = dict((a, np.zeros((nv,), bool)) for a in ALERTES)
+        self.alertes = collections.deque(maxlen=4096)     # (numero, tixel, voie, type, valeur)
+        self.nb_alertes = 0
+        self.etat = None
+
+    def paquet(self, bloc):
+        """
+        :param bloc: [np.array (nb_tixels, nb_voies)] tixels consecutifs du flux
+        :return:
+        """
+        debut = 0
+        while debut < len(bloc):
+            # un bloc a cheval sur deux periodes est coupe a la fin de la periode
+            fin = min(len(bloc), debut + self.periode - self.n)
+            self._accumule(bloc[debut:fin, self.colonnes])
+            debut = fin
+            if self.n == self.periode:
+                self._evalue()
+
+    def _accumule(self, x):
+        n = len(x)
+        if n > len(self.carres):
+            self.carres = np.zeros((n, self.nb_voies), np.float32)
+        carres = np.multiply(x, x, out=self.carres[:n], dtype=np.float32)
+        self.somme += x.sum(axis=0, dtype=np.float64)
+        self.somme_carres += carres.sum(axis=0, dtype=np.float64)
+        mini = x.min(axis=0)
+        maxi = x.max(axis=0)
+        if self.n == 0:
+            self.mini[:] = mini
+            self.maxi[:] = maxi
+        else:
+            np.minimum(self.mini, mini, out=self.mini)
+            np.maximum(self.maxi, maxi, out=self.maxi)
+        # comptage des saturations seulement pour les voies dont les extrema du bloc saturent
+        satures = np.flatnonzero((maxi >= self.saturation) | (mini <= -self.saturation))
+        if len(satures):
+            xs = x[:, satures]
+            self.satures[satures] += np.count_nonzero((xs >= self.saturation) | (xs <= -self.saturation), axis=0)
+        if self.zeros_max is not None:
+            self._zeros(x, mini, maxi)
+        self.n += n
+        self.tixels += n
+
+    def _zeros(self, x, mini, maxi):
+        """
+        longueur des suites de zeros : zeros en tete du bloc ajoutes a la suite en cours, plus longue
+        suite interieure au bloc, zeros en fin de bloc pour la suite suivante
+        """
+        n = len(x)
+        nuls = (mini == 0) & (maxi == 0)
+        self.zeros[nuls] += n
+        partiels = np.flatnonzero(~nuls & ((mini <= 0) & (maxi >= 0)))
+        sans_zero = ~nuls
+        sans_zero[partiels] = False
+        self.zeros[sans_zero] = 0
+        if len(partiels):
+            non_nuls = x[:, partiels] != 0
+            # seules les voies ayant au moins un zero dans le bloc sont mesurees
+            avec_zero = ~non_nuls.all(axis=0)
+            self.zeros[partiels[~avec_zero]] = 0
+            partiels = partiels[avec_zero]
+            non_nuls = non_nuls[:, avec_zero]
+        if len(partiels):
+            tete = np.argmax(non_nuls, axis=0)
+            queue = np.argmax(non_nuls[::-1], axis=0)
+            # longueur de la suite de zeros en cours a chaque tixel : ecart au dernier mot non nul
+            indices = np.arange(n, dtype=np.int32)[:, None]
+            dernier = np.maximum.accumulate(np.where(non_nuls, indices, -1), axis=0)
+            interieure = (indices - dernier).max(axis=0)
+            longueur = np.maximum(self.zeros[partiels] + tete, interieure)
+            self.zeros_periode[partiels] = np.maximum(self.zeros_periode[partiels], longueur)
+            self.zeros[partiels] = queue
+        np.maximum(self.zeros_periode, self.zeros, out=self.zeros_periode)
+
+    def _evalue(self):
+        n = self.n
+        dc = self.somme / n
+        rms = np.sqrt(np.maximum(self.somme_carres / n - dc * dc, 0.))
+        crete = np.maximum(self.maxi.astype(np.int64), -self.mini.astype(np.int64))
+        np.maximum(self.crete_totale, crete, out=self.crete_totale)
+        self.satures_total += self.satures
+        taux = self.satures / n
+        defauts = {}
+        zero = np.zeros((self.nb_voies,), bool)
+        defauts['muette'] = rms < self.rms_min if self.rms_min is not None else zero
+        if self.ecart_median is not None and self.nb_voies > 2:
+            mediane = np.median(rms)
+            defauts['atypique'] = (rms > mediane * self.ecart_median) | (rms * self.ecart_median < mediane)
+        else:
+            defauts['atypique'] = zero
+        defauts['saturation'] = taux > self.taux_saturation
+        defauts['continu'] = np.abs(dc) > self.dc_max if self.dc_max is not None else zero
+        defauts['zeros'] = self.zeros_periode > self.zeros_max if self.zeros_max is not None else zero
+        valeurs = {'muette': rms, 'atypique': rms, 'saturation': taux, 'continu': dc,
+                   'zeros': self.zeros_periode / self.frequence}
+        # une alerte par voie qui passe en defaut
+        for alerte in ALERTES:
+            for k in np.flatnonzero(defauts[alerte] & ~self.defauts[alerte]):
+                self.nb_alertes += 1
+                self.alertes.append((self.nb_alertes, self.tixels, self.noms[k], alerte, float(valeurs[alerte][k])))
+        self.defauts = defauts
+        # l'etat est remplace d'un bloc : un autre thread le lit sans verrou
+        self.etat = {'tixel': self.tixels, 'duree': n / self.frequence, 'noms': self.noms,
+                     'rms': rms, 'dc': dc, 'crete': crete, 'saturations': self.satures.copy(),
+                     'zeros_max': self.zeros_periode / self.frequence,
+                     'crete_totale': self.crete_totale.copy(), 'saturations_totales': self.satures_total.copy(),
+                     'defauts': dict((a, d.copy()) for a, d in defauts.items())}
+        self.n = 0
+        self.somme[:] = 0
+        self.somme_carres[:] = 0
+        self.satures[:] = 0
+        self.zeros_periode[:] = self.zeros
+
+    def snapshot(self):
+        """
+        :return: statistiques de la derniere periode evaluee (dictionnaire de tableaux par voie), None avant
+                 la fin de la premiere periode
+        """
+        return self.etat
+
+    def en_defaut(self):
+        """
+        :return: dictionnaire nom de voie -> liste des defauts constates a la derniere evaluation
+        """
+        defauts = {}
+        for alerte in ALERTES:
+            for k in np.flatnonzero(self.defauts[alerte]):
+                defauts.setdefault(self.noms[k], []).append(alerte)
+        return defauts
+
+    def alertes_depuis(self, numero=0):
+        """
+        :param numero: [int] numero de la derniere alerte deja traitee
+        :return: liste des alertes (numero, tixel, voie, type, valeur) de numero superieur
+        """
+        return [a for a in list(self.alertes) if a[0] > numero]
+
+    def __str__(self):
+        chaine = "sante des voies : " + str(self.nb_voies) + " voies, " + str(self.nb_alertes) + " alertes"
+        defauts = self.en_defaut()
+        if defauts:
+            chaine = chaine + ", en defaut : " + ', '.join(nom + ' (' + ', '.join(d) + ')'
+                                                           for nom, d in sorted(defauts.items()))
+        return chaine
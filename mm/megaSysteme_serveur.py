@@ -0,0 +1,374 @@
+# -*- coding: utf-8 -*-
+"""
+Serveur de flux : les blocs de l'acquisition sont servis a des clients distants (TCP) ou locaux
+(socket unix), chacun avec sa selection de voies et son facteur de decimation.
+
+Le ServeurFlux est un observateur de MegaMicros : dans le callback il ne fait qu'une copie du
+paquet dans son buffer circulaire. Un thread unique (select) accepte les clients, lit leurs
+abonnements, prepare leurs trames et les envoie sans jamais bloquer : un client lent prend du
+retard sur son propre curseur, et s'il est rattrape par le producteur il saute les tixels ecrases
+(comptes dans 'perdus', visibles par la discontinuite des indices de trame).
+
+    serveur = Mm.init_serveur('tcp:0.0.0.0:5050')
+    (autre machine) client = ClientFlux('tcp:acquisition:5050', voies=['mems'], decimation=4)
+                    for premier, bloc in client: ...
+
+Protocole : le client envoie une ligne JSON d'abonnement ({"voies": [...], "decimation": 4,
+"duree_bloc": 0.05}), puis le serveur envoie des trames binaires :
+    entete ENTETE (little endian) : MAGIC, type, longueur de la charge (octets), indice du premier
+                                    tixel (a la frequence du client), nombre de tixels, nombre de voies
+    charge : TRAME_META : metadonnees JSON (voies, noms, frequence, decimation, dtype)
+             TRAME_DONNEES : int32 (nb_tixels, nb_voies) entrelaces
+             TRAME_FIN : vide, fin de l'acquisition
+"""
+from __future__ import division
+import errno
+import json
+import os
+import select
+import socket
+import struct
+import threading
+import numpy as np
+from megaSysteme_ring import RingBuffer
+from megaSysteme_decimation import Decimateur
+
+MAGIC = b'MMF1'
+ENTETE = struct.Struct('<4sBIQII')
+TRAME_META = 0
+TRAME_DONNEES = 1
+TRAME_FIN = 2
+
+
+def _socket(adresse):
+    """
+    :param adresse: [str] 'tcp:<hote>:<port>' ou 'unix:<chemin>'
+    :return: (famille, adresse au sens de socket)
+    """
+    if adresse.startswith('unix:'):
+        return socket.AF_UNIX, adresse[len('unix:'):]
+    if adresse.startswith('tcp:'):
+        hote, port = adresse[len('tcp:'):].rsplit(':', 1)
+        return socket.AF_INET, (hote, int(port))
+    raise ValueError("adresse inconnue : " + str(adresse) + " ('tcp:<hote>:<port>' ou 'unix:<chemin>')")
+
+
+def trame(type_trame, charge=b'', premier=0, nb_tixels=0, nb_voies=0):
+    """
+    :return: trame binaire (entete + charge)
+    """
+    return ENTETE.pack(MAGIC, type_trame, len(charge), premier, nb_tixels, nb_voies) + charge
+
+
+class ClientServeur():
+    """
+    Etat d'un client cote serveur : abonnement, curseur dans le buffer, trame en cours d'envoi
+    """
+
+    def __init__(self, connexion, serveur):
+        self.socket = connexion
+        self.socket.setblocking(False)
+        self.serveur = serveur
+        self.entree = b''
+        self.abonne = False
+        self.sortie = None      # trame en cours d'envoi (memoryview), None si aucune
+        self.envoye = 0         # octets de la trame en cours deja envoyes
+        self.curseur = 0        # prochain tixel du buffer du serveur a envoyer
+        self.premier = 0        # indice du prochain tixel envoye, a la frequence du client
+        self.perdus = 0         # tixels ecrases avant d'avoir ete envoyes
+        self.envoyes = 0        # octets envoyes
+        self.fin_envoyee = False
+        self.ferme = False
+
+    def recoit(self):
+        """
+        lecture de la ligne d'abonnement (ou detection de la deconnexion)
+        """
+        try:
+            donnees = self.socket.recv(4096)
+        except socket.error as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            donnees = b''
+        if not donnees:
+            self.ferme = True
+            return
+        if self.abonne:
+            return
+        self.entree += donnees
+        if b'\n' in self.entree:
+            ligne = self.entree.split(b'\n', 1)[0]
+            try:
+                self.abonne_a(json.loads(ligne.decode('utf-8')))
+            except (ValueError, KeyError, TypeError) as e:
+                self._sortie(trame(TRAME_FIN, json.dumps({'erreur': str(e)}).encode('utf-8')))
+                self.fin_envoyee = True
+
+    def abonne_a(self, abonnement):
+        serveur = self.serveur
+        voies = abonnement.get('voies')
+        if isinstance(voies, list):
+            # les couples (faisceau, micro) arrivent en listes JSON
+            voies = [tuple(v) if isinstance(v, list) else (v if isinstance(v, int) else str(v)) for v in voies]
+        elif voies is not None:
+            voies = str(voies)
+        self.colonnes = serveur.carte.selection(voies)
+        self.decimation = max(1, int(abonnement.get('decimation', 1)))
+        self.taille_bloc = max(1, int(float(abonnement.get('duree_bloc', serveur.duree_bloc)) * serveur.frequence))
+        self.decimateur = None
+        if self.decimation > 1:
+            cpt = serveur.carte.colonne_cpt
+            brutes = [i for i, c in enumerate(self.colonnes) if c == cpt]
+            self.decimateur = Decimateur(self.decimation, len(self.colonnes), brutes=brutes,
+                                         bloc_max=serveur.lot_max)
+        ring = serveur.ring
+        self.curseur = ring.plus_ancien() if abonnement.get('depuis') == 'debut' else ring.ecrit // ring.nb_voies
+        noms = [serveur.carte.noms[c] for c in self.colonnes]
+        meta = {'nb_voies': len(self.colonnes), 'colonnes': [int(c) for c in self.colonnes], 'noms': noms,
+                'frequence': serveur.frequence / self.decimation, 'decimation': self.decimation,
+                'dtype': 'int32', 'premier_tixel_serveur': self.curseur}
+        self._sortie(trame(TRAME_META, json.dumps(meta).encode('utf-8'), nb_voies=len(self.colonnes)))
+        self.abonne = True
+
+    def prepare(self):
+        """
+        construit la trame suivante si la precedente est envoyee et que des tixels sont disponibles
+        """
+        if self.sortie is not None or not self.abonne or self.fin_envoyee:
+            return
+        serveur = self.serveur
+        ring = serveur.ring
+        ancien = ring.plus_ancien()
+        if self.curseur < ancien:
+            # client trop lent : les tixels ont ete ecrases, l'indice des trames saute d'autant
+            self.perdus += ancien - self.curseur
+            self.premier += (ancien - self.curseur) // self.decimation
+            self.curseur = ancien
+        n = min(ring.ecrit // ring.nb_voies - self.curseur, serveur.lot_max)
+        if n < self.taille_bloc and not (serveur.fin_flux and n > 0):
+            if serveur.fin_flux and n <= 0:
+                self._sortie(trame(TRAME_FIN))
+                self.fin_envoyee = True
+            return
+        bloc = ring.copie(self.curseur, n, out=serveur.copie[:n])
+        if bloc is None:
+            return
+        self.curseur += n
+        x = bloc[:, self.colonnes]
+        if self.decimateur is not None:
+            x = self.decimateur.traite(x.reshape(-1))
+        if len(x) == 0:
+            return
+        # une seule copie des tixels, directement derriere l'entete
+        donnees = bytearray(ENTETE.size + 4 * x.size)
+        ENTETE.pack_into(donnees, 0, MAGIC, TRAME_DONNEES, 4 * x.size, self.premier, len(x), len(self.colonnes))
+        np.frombuffer(donnees, '<i4', offset=ENTETE.size).reshape(x.shape)[...] = x
+        self._sortie(donnees)
+        self.premier += len(x)
+
+    def _sortie(self, donnees):
+        self.sortie = memoryview(donnees)
+        self.envoye = 0
+
+    def envoie(self):
+        """
+        envoi de la suite de la trame en cours (une vue sur le reste, sans recopie)
+        """
+        try:
+            n = self.socket.send(self.sortie[self.envoye:])
+        except socket.error as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            self.ferme = True
+            return
+        self.envoyes += n
+        self.envoye += n
+        if self.envoye == len(self.sortie):
+            self.sortie = None
+            if self.fin_envoyee:
+                self.ferme = True
+
+    def close(self):
+        try:
+            self.socket.close()
+        except socket.error:
+            pass
+
+
+class ServeurFlux():
+    """
+    Serveur de flux multi-clients (observateur de MegaMicros)
+    """
+
+    def __init__(self, adresse, nb_voies, frequence, carte, duree_buffer=2., duree_bloc=0.05, attente=0.005):
+        """
+        :param adresse:         [str]   'tcp:<hote>:<port>' ou 'unix:<chemin>'
+        :param nb_voies:        [int]   nombre de voies des tixels
+        :param frequence:       [float] frequence des tixels (Hz)
+        :param carte:           CarteVoies de l'acquisition (selection des voies par nom)
+        :param duree_buffer:    [float] retard maximal (s) d'un client avant qu'il perde des tixels
+        :param duree_bloc:      [float] duree par defaut des trames (s)
+        :param attente:         [float] attente maximale (s) du thread entre deux verifications
+        :return:
+        """
+        self.nb_voies = int(nb_voies)
+        self.frequence = float(frequence)
+        self.carte = carte
+        self.duree_bloc = duree_bloc
+        self.attente = attente
+        self.ring = RingBuffer(int(duree_buffer * self.frequence), self.nb_voies, politique='drop_oldest')
+        # un client en retard recoit au plus 8 blocs par trame
+        self.lot_max = max(1, int(8 * duree_bloc * self.frequence))
+        self.copie = np.empty((self.lot_max, self.nb_voies), np.int32)
+        famille, self.adresse = _socket(adresse)
+        self.socket = socket.socket(famille, socket.SOCK_STREAM)
+        if famille == socket.AF_INET:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind(self.adresse)
+        self.socket.listen(8)
+        self.socket.setblocking(False)
+        if famille == socket.AF_INET:
+            self.adresse = self.socket.getsockname()
+        self.clients = []
+        self.nb_clients = 0
+        self.fin_flux = False
+        self.arret = threading.Event()
+        self.thread = threading.Thread(target=self._boucle)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def paquet(self, bloc):
+        """
+        copie du bloc dans le buffer du serveur (appele depuis le callback, ne bloque jamais)
+        """
+        self.ring.write(bloc.reshape(-1))
+
+    def fin(self):
+        """
+        fin du flux : les clients recoivent les tixels restants puis une trame de fin
+        """
+        self.fin_flux = True
+
+    def _boucle(self):
+        while not self.arret.is_set():
+            for client in self.clients:
+                client.prepare()
+            lecture = [self.socket] + [c.socket for c in self.clients]
+            ecriture = [c.socket for c in self.clients if c.sortie is not None]
+            lisibles, inscriptibles, _ = select.select(lecture, ecriture, [], self.attente)
+            for s in lisibles:
+                if s is self.socket:
+                    try:
+                        connexion, _ = self.socket.accept()
+                    except socket.error:
+                        continue
+                    self.clients.append(ClientServeur(connexion, self))
+                    self.nb_clients += 1
+                else:
+                    self._client(s).recoit()
+            for s in inscriptibles:
+                self._client(s).envoie()
+            for client in [c for c in self.clients if c.ferme]:
+                client.close()
+                self.clients.remove(client)
+
+    def _client(self, s):
+        for client in self.clients:
+            if client.socket is s:
+                return client
+
+    def close(self):
+        """
+        arrete le thread et ferme toutes les connexions
+        """
+        self.arret.set()
+        self.thread.join()
+        for client in self.clients:
+            client.close()
+        self.socket.close()
+        if self.socket.family == socket.AF_UNIX:
+            if os.path.exists(self.adresse):
+                os.remove(self.adresse)
+
+    def __str__(self):
+        perdus = sum(c.perdus for c in self.clients)
+        chaine = "serveur de flux " + str(self.adresse) + " : " + str(len(self.clients)) + " clients connectes (" + \
+                 str(self.nb_clients) + " au total), " + str(perdus) + " tixels perdus par les clients connectes"
+        return chaine
+
+
+class ClientFlux():
+    """
+    Client d'un ServeurFlux
+    """
+
+    def __init__(self, adresse, voies=None, decimation=1, duree_bloc=0.05, depuis='direct', timeout=None):
+        """
+        :param adresse:     [str]   'tcp:<hote>:<port>' ou 'unix:<chemin>'
+        :param voies:       voies demandees (noms ou colonnes, cf. CarteVoies.selection), None pour toutes sauf le compteur
+        :param decimation:  [int]   facteur de decimation applique par le serveur
+        :param duree_bloc:  [float] duree minimale des trames (s)
+        :param depuis:      [str]   'direct' : a partir des tixels recus apres l'abonnement,
+                                    'debut' : a partir du plus ancien tixel du buffer du serveur
+        :param timeout:     [float] attente maximale d'une trame (s), None pour attendre indefiniment
+        :return:
+        """
+        famille, adresse = _socket(adresse)
+        self.socket = socket.socket(famille, socket.SOCK_STREAM)
+        self.socket.settimeout(timeout)
+        self.socket.connect(adresse)
+        if isinstance(voies, (str, tuple)):
+            voies = [voies]
+        abonnement = {'voies': None if voies is None else [v if isinstance(v, str) else
+                                                          (list(v) if isinstance(v, tuple) else int(v))
+                                                          for v in voies],
+                      'decimation': int(decimation), 'duree_bloc': duree_bloc, 'depuis': depuis}
+        self.socket.sendall(json.dumps(abonnement).encode('utf-8') + b'\n')
+        type_trame, _, _, _, charge = self.lit_trame()
+        if type_trame != TRAME_META:
+            raise ValueError("abonnement refuse : " + charge.decode('utf-8'))
+        self.metadonnees = json.loads(charge.decode('utf-8'))
+        self.nb_voies = self.metadonnees['nb_voies']
+        self.frequence = self.metadonnees['frequence']
+        self.termine = False
+
+    def _lit(self, n):
+        morceaux = []
+        while n:
+            morceau = self.socket.recv(min(n, 1 << 20))
+            if not morceau:
+                raise EOFError("connexion fermee par le serveur")
+            morceaux.append(morceau)
+            n -= len(morceau)
+        return b''.join(morceaux)
+
+    def lit_trame(self):
+        """
+        :return: (type, premier tixel, nb_tixels, nb_voies, charge)
+        """
+        magic, type_trame, longueur, premier, nb_tixels, nb_voies = ENTETE.unpack(self._lit(ENTETE.size))
+        if magic != MAGIC:
+            raise ValueError("trame invalide")
+        return type_trame, premier, nb_tixels, nb_voies, self._lit(longueur)
+
+    def get_data(self):
+        """
+        :return: (indice du premier tixel, bloc int32 (nb_tixels, nb_voies)), ou None a la fin du flux
+        """
+        if self.termine:
+            return None
+        type_trame, premier, nb_tixels, nb_voies, charge = self.lit_trame()
+        if type_trame == TRAME_FIN:
+            self.termine = True
+            return None
+        return premier, np.frombuffer(charge, '<i4').reshape((nb_tixels, nb_voies))
+
+    def __iter__(self):
+        while True:
+            donnees = self.get_data()
+            if donnees is None:
+                return
+            yield donnees
+
+    def close(self):
+        self.socket.close()
@@ -0,0 +1,346 @@
+# -*- coding: utf-8 -*-
+"""
+Backend libusb simule : un (ou plusieurs) boitier(s) Megamicros dans le processus.
+
+LibusbSimu expose les memes fonctions et constantes que le module libusb1 utilisees par
+megaSysteme_core et megaSysteme_128. Il suffit de le passer en parametre backend :
+
+    simu = LibusbSimu(debit=0)
+    Mm = System128(duree=2., backend=simu)
+
+Le peripherique simule interprete les commandes de controle envoyees par init_module128
+(reset, clockdiv, COUNT, type de donnees, pages de voies actives, start, packet end) et
+remplit les transferts bulk avec un flux synthetique entrelace :
+    - les MEMS actifs dans l'ordre des pages (faisceau 0 micros 0..7, faisceau 1, ...),
+    - puis les voies analogiques actives,
+    - puis le compteur d'echantillons (si actif).
+"""
+from __future__ import division
+import numpy as np
+import ctypes
+import struct
+import time
+
+LIBUSB_SUCCESS = 0
+LIBUSB_ERROR_NOT_FOUND = -5
+LIBUSB_TRANSFER_COMPLETED = 0
+LIBUSB_TRANSFER_ERROR = 1
+LIBUSB_TRANSFER_TIMED_OUT = 2
+LIBUSB_TRANSFER_CANCELLED = 3
+LIBUSB_TRANSFER_STALL = 4
+LIBUSB_TRANSFER_NO_DEVICE = 5
+LIBUSB_TRANSFER_OVERFLOW = 6
+
+
+class libusb_transfer(ctypes.Structure):
+    """
+    sous-ensemble de la structure libusb_transfer lu par le callback
+    """
+    _fields_ = [('endpoint', ctypes.c_ubyte),
+                ('status', ctypes.c_int),
+                ('timeout', ctypes.c_uint),
+                ('length', ctypes.c_int),
+                ('actual_length', ctypes.c_int),
+                ('buffer', ctypes.c_void_p)]
+
+
+libusb_transfer_p = ctypes.POINTER(libusb_transfer)
+
+
+class PeripheriqueSimu():
+    """
+    Etat d'un boitier Megamicros simule
+    """
+
+    def __init__(self, vid=0xFE27, pid=0xAC00, serial='SIMU0', bus=1, port=1, amplitude=1 << 20, seed=0):
+        self.vid = vid
+        self.pid = pid
+        self.serial = serial
+        self.bus = bus
+        self.port = port
+        self.amplitude = amplitude
+        self.random = np.random.RandomState(seed)
+        self.ouvert = False
+        self.reset()
+
+    def reset(self):
+        self.clockdiv = 9
+        self.count = 0
+        self.datatype = 'int32'
+        self.pages = [0] * 17
+        self.demarre = False
+        self.fin_demandee = False
+        self.mot = 0            # nombre de mots deja emis
+        self.t0 = None
+        self.motif = None
+
+    def frequence(self):
+        return 500000. / (self.clockdiv + 1)
+
+    def nb_mems(self):
+        return sum(bin(p).count('1') for p in self.pages[:16])
+
+    def nb_voies(self):
+        return self.nb_mems() + bin(self.pages[16] & 0x0F).count('1') + (self.pages[16] >> 7 & 1)
+
+    def commande(self, request, data):
+        """
+        interpretation d'une commande de controle
+
+        :param request: [int] signature de la commande
+        :param data:    [bytes] contenu de la commande
+        """
+        if request == 0xB0 and data[0] == 0x00:
+            self.reset()
+        elif request == 0xB1 and data[0] == 0x01:
+            self.clockdiv = data[1]
+        elif request == 0xB1 and data[0] == 0x09:
+            self.datatype = 'float32' if data[1] == 0x01 else 'int32'
+        elif request == 0xB1 and data[0] == 0x02:
+            self.demarre = True
+            self.t0 = time.time()
+            self.mot = 0        # un start (ou un rearmement) relance le comptage des COUNT tixels
+            self._motif()
+        elif request == 0xB4 and data[0] == 0x04:
+            self.count = struct.unpack('<I', bytes(data[1:5]))[0]
+        elif request == 0xB3 and data[0] == 0x05:
+            page = 16 if data[2] == 0xFF else data[2]
+            self.pages[page] = data[3]
+        elif request == 0xC1:
+            self.fin_demandee = True
+
+    def _motif(self):
+        """
+        precalcul d'une seconde de signal synthetique (sinus de frequence propre a chaque voie + bruit)
+        """
+        nv = self.nb_voies()
+        n = int(self.frequence())
+        t = np.arange(n) / self.frequence()
+        f = 440. * (1 + np.arange(nv) / 8.)
+        motif = self.amplitude * np.sin(2 * np.pi * t[:, None] * f[None, :])
+        motif += self.random.normal(0, self.amplitude / 100., motif.shape)
+        self.motif = motif.astype(np.int32)
+        self.compteur = (self.pages[16] >> 7) & 1
+
+    def mots_restants(self):
+        if self.count == 0:
+            return 0
+        return self.count * self.nb_voies() - self.mot
+
+    def genere(self, n_mots):
+        """
+        :param n_mots: [int] nombre de mots a produire
+        :return: np.array int32 des n_mots suivants du flux entrelace
+        """
+        nv = self.nb_voies()
+        k0 = self.mot // nv
+        k1 = (self.mot + n_mots + nv - 1) // nv
+        idx = np.arange(k0, k1)
+        bloc = self.motif[idx % len(self.motif)]
+        if self.compteur:
+            bloc[:, -1] = idx
+        debut = self.mot - k0 * nv
+        self.mot += n_mots
+        return bloc.reshape(-1)[debut:debut + n_mots]
+
+    def echeance(self, n_mots, debit):
+        """
+        :return: instant ou n_mots supplementaires auront ete produits par le boitier
+        """
+        if debit == 0:
+            return 0.
+        return self.t0 + (self.mot + n_mots) / (self.nb_voies() * self.frequence() * debit)
+
+
+class LibusbSimu():
+    """
+    Remplacement du module libusb1 par un ou plusieurs boitiers simules
+    """
+
+    LIBUSB_SUCCESS = LIBUSB_SUCCESS
+    LIBUSB_TRANSFER_COMPLETED = LIBUSB_TRANSFER_COMPLETED
+    LIBUSB_TRANSFER_ERROR = LIBUSB_TRANSFER_ERROR
+    LIBUSB_TRANSFER_TIMED_OUT = LIBUSB_TRANSFER_TIMED_OUT
+    LIBUSB_TRANSFER_CANCELLED = LIBUSB_TRANSFER_CANCELLED
+    LIBUSB_TRANSFER_STALL = LIBUSB_TRANSFER_STALL
+    LIBUSB_TRANSFER_NO_DEVICE = LIBUSB_TRANSFER_NO_DEVICE
+    LIBUSB_TRANSFER_OVERFLOW = LIBUSB_TRANSFER_OVERFLOW
+    libusb_transfer_p = libusb_transfer_p
+
+    def __init__(self, peripheriques=None, debit=1.0, timeouts=(), proba_timeout=0., pertes=(), proba_perte=0.,
+                 seed=0):
+        """
+        :param peripheriques:   [list]  boitiers simules (PeripheriqueSimu), un seul par defaut
+        :param debit:           [float] vitesse de production relative au temps reel (0 : aussi vite que possible)
+        :param timeouts:        [list]  numeros des transferts a faire echouer en TIMEOUT : le transfert ne
+                                        recoit qu'une partie des mots, les autres restent dans la FIFO et
+                                        arrivent dans le transfert suivant
+        :param proba_timeout:   [float] probabilite qu'un transfert echoue en TIMEOUT
+        :param pertes:          [list]  numeros des transferts a faire echouer en OVERFLOW : leurs donnees sont perdues
+        :param proba_perte:     [float] probabilite qu'un transfert echoue en OVERFLOW
+        :param seed:            [int]   graine du generateur aleatoire
+        :return:
+        """
+        if peripheriques is None:
+            peripheriques = [PeripheriqueSimu()]
+        self.peripheriques = peripheriques
+        self.debit = debit
+        self.timeouts = set(timeouts)
+        self.proba_timeout = proba_timeout
+        self.pertes = set(pertes)
+        self.proba_perte = proba_perte
+        self.random = np.random.RandomState(seed)
+        self.transferts = {}    # adresse du transfert -> [transfert, handle, callback]
+        self.soumis = []        # adresses des transferts en attente, dans l'ordre de soumission
+        self.n_transferts = 0   # nombre de transferts termines
+        self.n_timeouts = 0
+        self.n_pertes = 0
+
+    # --------------------------------------------------------------------------
+    # gestion du contexte et des peripheriques
+    # --------------------------------------------------------------------------
+    def libusb_init(self, ctx):
+        return LIBUSB_SUCCESS
+
+    def libusb_set_debug(self, ctx, level):
+        pass
+
+    def libusb_exit(self, ctx):
+        pass
+
+    def libusb_open_device_with_vid_pid(self, ctx, vid, pid):
+        for periph in self.peripheriques:
+            if periph.vid == vid and periph.pid == pid and not periph.ouvert:
+                periph.ouvert = True
+                return periph
+        return None
+
+    def liste_peripheriques(self, vid, pid):
+        """
+        equivalent simule de l'enumeration libusb (cf. usb.liste_peripheriques)
+        """
+        return [{'bus': p.bus, 'port': p.port, 'serial': p.serial, 'device': p}
+                for p in self.peripheriques if p.vid == vid and p.pid == pid]
+
+    def ouvre_peripherique(self, device):
+        device.ouvert = True
+        return device
+
+    def libusb_claim_interface(self, handle, interface):
+        return LIBUSB_SUCCESS
+
+    def libusb_release_interface(self, handle, interface):
+        return LIBUSB_SUCCESS
+
+    def libusb_close(self, handle):
+        handle.ouvert = False
+
+    def libusb_control_transfer(self, handle, typerequest, request, value, index, data, length, timeout):
+        if hasattr(data, 'raw'):
+            data = data.raw
+        elif not isinstance(data, bytes):
+            data = data.encode('latin-1')
+        handle.commande(request, bytearray(data[:length] + b'\x00' * 16))
+        return length
+
+    # --------------------------------------------------------------------------
+    # transferts bulk asynchrones
+    # --------------------------------------------------------------------------
+    def libusb_alloc_transfer(self, iso_packets):
+        transfert = ctypes.pointer(libusb_transfer())
+        self.transferts[ctypes.addressof(transfert.contents)] = [transfert, None, None]
+        return transfert
+
+    def libusb_free_transfer(self, transfert):
+        self.transferts.pop(ctypes.addressof(transfert.contents), None)
+
+    def libusb_fill_bulk_transfer(self, transfert, handle, endpoint, buffer, length, callback, user_data, timeout):
+        t = transfert.contents
+        t.endpoint = endpoint
+        t.buffer = int(buffer)
+        t.length = int(length)
+        t.timeout = int(timeout)
+        etat = self.transferts[ctypes.addressof(t)]
+        etat[1] = handle
+        etat[2] = callback
+
+    def libusb_submit_transfer(self, transfert):
+        self.soumis.append(ctypes.addressof(transfert.contents))
+        return LIBUSB_SUCCESS
+
+    def libusb_cancel_transfer(self, transfert):
+        adresse = ctypes.addressof(transfert.contents)
+        if adresse not in self.soumis:
+            return LIBUSB_ERROR_NOT_FOUND
+        self.soumis.remove(adresse)
+        return LIBUSB_SUCCESS
+
+    def _prochain(self):
+        """
+        :return: rang dans self.soumis du prochain transfert a terminer : pour chaque boitier le plus
+                 ancien transfert soumis, et parmi ceux-ci celui dont les donnees sont pretes le plus tot
+        """
+        vus = set()
+        choix, echeance_min = 0, None
+        for rang, adresse in enumerate(self.soumis):
+            transfert, handle, callback = self.transferts[adresse]
+            if id(handle) in vus:
+                continue
+            vus.add(id(handle))
+            restants = handle.mots_restants() if handle.demarre else 0
+            if restants <= 0:
+                continue
+            echeance = handle.echeance(min(transfert.contents.length // 4, restants), self.debit)
+            if echeance_min is None or echeance < echeance_min:
+                choix, echeance_min = rang, echeance
+        return choix
+
+    def libusb_handle_events(self, ctx):
+        """
+        termine le plus ancien transfert soumis (en respectant le debit du boitier) et appelle son callback
+        """
+        if not self.soumis:
+            time.sleep(0.001)
+            return LIBUSB_SUCCESS
+        adresse = self.soumis.pop(self._prochain())
+        transfert, handle, callback = self.transferts[adresse]
+        t = transfert.contents
+        n_mots = t.length // 4
+        restants = handle.mots_restants() if handle.demarre else 0
+        if restants <= 0:
+            # plus rien a emettre : le transfert expire
+            time.sleep(t.timeout / 1000. if self.debit else 0.)
+            t.status = LIBUSB_TRANSFER_TIMED_OUT
+            t.actual_length = 0
+        else:
+            if restants < n_mots:
+                # dernier paquet, plus court
+                n_mots = restants
+            timeout = self.n_transferts in self.timeouts or \
+                (self.proba_timeout and self.random.random_sample() < self.proba_timeout)
+            if timeout:
+                # seule une partie des mots (par paquets USB de 512 octets) est transferee avant
+                # l'expiration, le reste reste dans la FIFO du boitier
+                n_mots = (n_mots // 2) // 128 * 128
+            attente = handle.echeance(n_mots, self.debit) - time.time()
+            if attente > 0:
+                time.sleep(attente)
+            donnees = handle.genere(n_mots)
+            if timeout:
+                ctypes.memmove(t.buffer, donnees.ctypes.data, 4 * n_mots)
+                t.status = LIBUSB_TRANSFER_TIMED_OUT
+                t.actual_length = 4 * n_mots
+                self.n_timeouts += 1
+            elif self.n_transferts in self.pertes or \
+                    (self.proba_perte and self.random.random_sample() < self.proba_perte):
+                # les donnees de ce transfert sont perdues
+                t.status = LIBUSB_TRANSFER_OVERFLOW
+                t.actual_length = 0
+                self.n_pertes += 1
+            else:
+                ctypes.memmove(t.buffer, donnees.ctypes.data, 4 * n_mots)
+                t.status = LIBUSB_TRANSFER_COMPLETED
+                t.actual_length = 4 * n_mots
+        self.n_transferts += 1
+        callback(transfert)
+        return LIBUSB_SUCCESS
@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+"""
+Instrumentation du chemin critique de l'acquisition (fn_callback_py).
+
+A chaque paquet, le callback releve quatre instants (entree, fin du stockage, fin des observateurs,
+fin de la relance) et le nombre de transferts encore en attente dans libusb. L'enregistrement se
+fait dans des tableaux preallouees circulaires et dans des histogrammes en puissances de 2 :
+pas d'allocation ni d'entree/sortie dans le callback, il peut rester actif en production.
+
+Les statistiques sont lues par resume() (depuis n'importe quel thread : la lecture peut etre
+decalee d'un paquet) et peuvent etre exportees periodiquement par un thread, en lignes JSON
+dans un fichier ou en datagrammes sur une socket unix locale :
+
+    stats = Mm.init_stats(export='unix:/tmp/megamicros.sock', periode=1.)
+"""
+from __future__ import division
+import json
+import socket
+import threading
+import time
+import numpy as np
+
+horloge = getattr(time, 'perf_counter', time.time)
+
+ETAPES = ('stockage', 'observateurs', 'relance', 'callback')
+
+
+class StatsCallback():
+    """
+    Statistiques du callback usb : durees par etape, transferts en attente, debit
+    """
+
+    def __init__(self, debit_attendu, s_pkt, n_tdf, taille=4096, nb_classes=24):
+        """
+        :param debit_attendu:   [float] debit du boitier en octets/s
+        :param s_pkt:           [int]   taille des paquets en octets
+        :param n_tdf:           [int]   nombre de transferts en parallele
+        :param taille:          [int]   nombre de paquets conserves pour les percentiles et le debit
+        :param nb_classes:      [int]   nombre de classes des histogrammes (classe k : [2**(k-1), 2**k[ us)
+        :return:
+        """
+        self.horloge = horloge
+        self.debit_attendu = float(debit_attendu)
+        self.periode_paquet = s_pkt / self.debit_attendu  # temps disponible par paquet (s)
+        self.n_tdf = int(n_tdf)
+        self.taille = int(taille)
+        self.nb_classes = int(nb_classes)
+        self.instants = np.zeros((self.taille,))                # entree dans le callback
+        self.durees = np.zeros((self.taille, len(ETAPES)))      # duree de chaque etape (s)
+        self.octets_paquet = np.zeros((self.taille,), np.int64)
+        self.en_vol = np.zeros((self.taille,), np.int32)        # transferts en attente a l'entree
+        self.histogrammes = np.zeros((len(ETAPES), self.nb_classes), np.int64)
+        self.n = 0              # nombre de paquets enregistres
+        self.octets = 0         # nombre total d'octets recus
+        self.en_vol_min = self.n_tdf
+        self.famines = 0        # paquets recus alors qu'aucun autre transfert n'etait en attente
+        self.exportateur = None
+
+    def _classe(self, duree):
+        return min(int(duree * 1e6).bit_length(), self.nb_classes - 1)
+
+    def enregistre(self, t0, t1, t2, t3, octets, en_vol, vidange=False):
+        """
+        enregistrement d'un paquet (appele depuis le callback)
+
+        :param t0:      [float] entree dans le callback
+        :param t1:      [float] fin du stockage (buffer2disque / buffer2buffer)
+        :param t2:      [float] fin des observateurs
+        :param t3:      [float] fin de la relance du transfert
+        :param octets:  [int]   octets recus
+        :param en_vol:  [int]   transferts encore en attente a l'entree du callback
+        :param vidange: [bool]  fin d'acquisition : les transferts ne sont plus relances,
+                                en_vol ne compte pas pour en_vol_min ni pour les famines
+        :return:
+        """
+        i = self.n % self.taille
+        self.instants[i] = t0
+        durees = (t1 - t0, t2 - t1, t3 - t2, t3 - t0)
+        self.durees[i] = durees
+        h = self.histogrammes
+        for k in range(len(ETAPES)):
+            h[k, self._classe(durees[k])] += 1
+        self.octets_paquet[i] = octets
+        self.en_vol[i] = en_vol
+        if not vidange:
+            if en_vol < self.en_vol_min:
+                self.en_vol_min = en_vol
+            if en_vol == 0:
+                self.famines += 1
+        self.octets += octets
+        self.n += 1
+
+    def resume(self):
+        """
+        :return: dictionnaire des statistiques (durees en microsecondes, debit en octets/s)
+        """
+        n = min(self.n, self.taille)
+        resume = {'paquets': self.n,
+                  'octets': self.octets,
+                  'en_vol_min': int(self.en_vol_min),
+                  'famines': self.famines,
+                  'histogrammes': dict((e, self.histogrammes[k].tolist()) for k, e in enumerate(ETAPES))}
+        if n == 0:
+            return resume
+        # ordre chronologique des paquets conserves
+        ordre = np.arange(self.n - n, self.n) % self.taille
+        instants = self.instants[ordre]
+        durees = self.durees[ordre] * 1e6
+        for k, e in enumerate(ETAPES):
+            resume[e] = {'moyenne': float(durees[:, k].mean()),
+                         'p50': float(np.percentile(durees[:, k], 50)),
+                         'p99': float(np.percentile(durees[:, k], 99)),
+                         'max': float(durees[:, k].max())}
+        resume['en_vol'] = int(self.en_vol[ordre[-1]])
+        resume['en_vol_moyen'] = float(self.en_vol[ordre].mean())
+        # part du temps disponible par paquet passee dans le callback
+        resume['charge'] = float(durees[:, -1].mean() * 1e-6 / self.periode_paquet)
+        if n > 1:
+            intervalle = instants[-1] - instants[0]
+            resume['debit'] = float(self.octets_paquet[ordre[1:]].sum() / intervalle) if intervalle > 0 else 0.
+            resume['debit_attendu'] = self.debit_attendu
+            resume['intervalle_max'] = float(np.diff(instants).max() * 1e6)
+        return resume
+
+    def exporte(self, destination, periode=1.):
+        """
+        export periodique de resume() par un thread
+
+        :param destination: [str]   fichier (une ligne JSON par periode) ou 'unix:<chemin>' (un datagramme par periode)
+        :param periode:     [float] intervalle entre deux exports (s)
+        :return:
+        """
+        self.exportateur = ExportStats(self, destination, periode)
+
+    def close(self):
+        if self.exportateur is not None:
+            self.exportateur.close()
+            self.exportateur = None
+
+    def __str__(self):
+        resume = self.resume()
+        chaine = "callback : " + str(resume['paquets']) + " paquets, " + str(resume['famines']) + \
+                 " famines, transferts en attente min " + str(resume['en_vol_min'])
+        if 'callback' in resume:
+            chaine = chaine + ", duree p99 " + str(round(resume['callback']['p99'], 1)) + " us, max " + \
+                     str(round(resume['callback']['max'], 1)) + " us, charge " + \
+                     str(round(100 * resume['charge'], 2)) + " %"
+        return chaine
+
+
+class ExportStats():
+    """
+    Thread d'export periodique des statistiques
+    """
+
+    def __init__(self, stats, destination, periode=1.):
+        self.stats = stats
+        self.destination = destination
+        self.periode = periode
+        self.echecs = 0     # exports perdus (pas de lecteur sur la socket, disque plein, ...)
+        self.socket = None
+        self.fichier = None
+        if destination.startswith('unix:'):
+            self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            self.chemin = destination[len('unix:'):]
+        else:
+            self.fichier = open(destination, 'a')
+        self.arret = threading.Event()
+        self.thread = threading.Thread(target=self._boucle)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def envoie(self):
+        resume = self.stats.resume()
+        resume['date'] = time.time()
+        ligne = json.dumps(resume)
+        try:
+            if self.socket is not None:
+                self.socket.sendto(ligne.encode('utf-8'), self.chemin)
+            else:
+                self.fichier.write(ligne + '\n')
+                self.fichier.flush()
+        except (IOError, OSError, socket.error):
+            self.echecs += 1
+
+    def _boucle(self):
+        while not self.arret.wait(self.periode):
+            self.envoie()
+
+    def close(self):
+        """
+        arrete le thread apres un dernier export
+        """
+        self.arret.set()
+        self.thread.join()
+        self.envoie()
+        if self.socket is not None:
+            self.socket.close()
+        else:
+            self.fichier.close()
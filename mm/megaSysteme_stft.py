@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+"""
+Transformee de Fourier a court terme en flux, a cheval sur les blocs de get_data.
+
+Les tixels qui n'ont pas encore rempli une trame complete sont conserves d'un bloc au suivant :
+la suite des trames produites est identique a celle que donnerait une STFT sur le signal entier,
+quel que soit le decoupage en blocs. Toutes les trames et toutes les voies d'un bloc sont
+transformees par une seule FFT, dans un buffer de sortie prealloue et reutilise (ecrit directement
+par la FFT avec NumPy 2 et plus, recopie avec les versions precedentes).
+"""
+from __future__ import division
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+
+
+class StreamingSTFT():
+    """
+    STFT en flux multi-voies avec etat de fenetrage conserve entre les blocs
+    """
+
+    def __init__(self, nfft, hop, colonnes, frequence, fenetre=None, bloc_max=8192):
+        """
+        :param nfft:        [int]   taille des trames
+        :param hop:         [int]   pas entre deux trames (tixels)
+        :param colonnes:    [list]  colonnes des blocs a transformer
+        :param frequence:   [float] frequence d'echantillonnage (Hz)
+        :param fenetre:     [np.array (nfft,)] fenetre d'analyse (Hann par defaut)
+        :param bloc_max:    [int]   taille de bloc attendue (tixels), les buffers grandissent si besoin
+        :return:
+        """
+        if hop <= 0 or hop > nfft:
+            raise ValueError("le pas doit etre compris entre 1 et nfft")
+        self.nfft = int(nfft)
+        self.hop = int(hop)
+        self.colonnes = np.asarray(colonnes)
+        self.nb_voies = len(self.colonnes)
+        self.frequence = float(frequence)
+        self.fenetre = (np.hanning(self.nfft) if fenetre is None else np.asarray(fenetre)).astype(np.float32)
+        self.freqs = np.fft.rfftfreq(self.nfft, 1. / self.frequence)
+        self.n_reste = 0        # tixels en attente dans le tampon
+        self.tixel = 0          # indice absolu du premier tixel du tampon
+        self._out = True        # np.fft.rfft accepte l'argument out (NumPy 2 et plus)
+        self._alloue(bloc_max)
+
+    def _alloue(self, bloc_max):
+        """
+        (re)allocation du tampon d'entree et du buffer de sortie pour des blocs de bloc_max tixels
+        """
+        self.bloc_max = int(bloc_max)
+        tampon = np.zeros((self.nfft + self.bloc_max, self.nb_voies), np.float32)
+        if hasattr(self, 'tampon'):
+            tampon[:self.n_reste] = self.tampon[:self.n_reste]
+        self.tampon = tampon
+        n_trames = (self.nfft + self.bloc_max) // self.hop + 1
+        self.trames = np.zeros((n_trames, self.nfft, self.nb_voies), np.float32)
+        self.sortie = np.zeros((n_trames, len(self.freqs), self.nb_voies), np.complex64)
+        self.debuts = np.zeros((n_trames,), np.int64)
+
+    def push(self, bloc):
+        """
+        ajoute un bloc et calcule les trames completes
+
+        :param bloc: [np.array (nb_tixels, nb_voies_bloc)] bloc retourne par get_data
+        :return: (spectres np.array complex64 (nb_trames, nb_freq, nb_voies), indices absolus des premiers tixels)
+                 ce sont des vues sur des buffers reutilises : elles sont valides jusqu'au push suivant
+        """
+        n = len(bloc)
+        if self.n_reste + n > self.nfft + self.bloc_max:
+            self._alloue(n)
+        total = self.n_reste + n
+        self.tampon[self.n_reste:total] = bloc[:, self.colonnes]
+        if total < self.nfft:
+            self.n_reste = total
+            return self.sortie[:0], self.debuts[:0]
+        n_trames = (total - self.nfft) // self.hop + 1
+        pas_t, pas_v = self.tampon.strides
+        vues = as_strided(self.tampon, shape=(n_trames, self.nfft, self.nb_voies),
+                          strides=(self.hop * pas_t, pas_t, pas_v), writeable=False)
+        trames = self.trames[:n_trames]
+        np.multiply(vues, self.fenetre[None, :, None], out=trames)
+        self._rfft(trames, self.sortie[:n_trames])
+        self.debuts[:n_trames] = self.tixel + self.hop * np.arange(n_trames)
+        # on garde les tixels qui serviront aux trames suivantes
+        suivant = n_trames * self.hop
+        self.n_reste = total - suivant
+        self.tampon[:self.n_reste] = self.tampon[suivant:total]
+        self.tixel += suivant
+        return self.sortie[:n_trames], self.debuts[:n_trames]
+
+    def _rfft(self, trames, sortie):
+        """
+        FFT des trames directement dans le buffer de sortie (NumPy 2 et plus : calcul en simple
+        precision sans tableau intermediaire) ; avec une version plus ancienne, sans argument out,
+        le resultat est calcule en double precision puis recopie
+        """
+        if self._out:
+            try:
+                np.fft.rfft(trames, axis=1, out=sortie)
+                return
+            except TypeError:
+                self._out = False
+        sortie[...] = np.fft.rfft(trames, axis=1)
+
+    def reset(self):
+        self.n_reste = 0
+        self.tixel = 0
@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+"""
+Carte des voies d'acquisition et desentrelacement en voies contigues.
+
+Les blocs (get_data, fichiers .dat) sont ranges par tixel : (nb_tixels, nb_voies), une colonne par
+voie dans l'ordre des pages de SelectChannels : les MEMS actifs (faisceau 0 micros 0..7, faisceau 1,
+...), puis les voies analogiques actives, puis les voies logiques, puis le compteur (derniere colonne).
+CarteVoies calcule une fois cette correspondance :
+
+    carte = CarteVoies(mems, va, cpt)
+    carte.colonne((3, 5))       # MEMS 5 du faisceau 3
+    carte.colonne('va_1')       # voie analogique 1
+    carte.selection('mems')     # colonnes de tous les MEMS actifs
+    carte.indexeur('mems')      # index des colonnes (une tranche si elles sont contigues)
+
+Le traitement voie par voie est plus rapide sur des voies contigues en memoire : Desentrelaceur
+recopie les colonnes choisies dans un buffer (nb_voies_choisies, nb_tixels) prealloue et reutilise
+d'un bloc a l'autre. La transposition se fait par tuiles de tixels qui restent dans le cache.
+"""
+from __future__ import division
+import numpy as np
+
+NB_FAISCEAUX = 16
+NB_MICROS = 8
+NB_VA = 4
+
+
+class CarteVoies():
+    """
+    Correspondance entre les colonnes des blocs et les voies (MEMS, voies analogiques, compteur)
+    """
+
+    def __init__(self, mems, va, cpt, vl=0):
+        """
+        :param mems:    [bool np.array(16,8) ou 'all'] MEMS actifs
+        :param va:      [bool np.array(4,) ou 'all']   voies analogiques actives
+        :param cpt:     [int] flag indiquant si le compteur est actif
+        :param vl:      [int] nombre de voies logiques
+        :return:
+        """
+        if isinstance(mems, str) and mems == 'all':
+            mems = np.ones((NB_FAISCEAUX, NB_MICROS), bool)
+        if isinstance(va, str) and va == 'all':
+            va = np.ones((NB_VA,), bool)
+        self.mems = np.asarray(mems, bool)
+        self.va = np.asarray(va, bool)
+        self.cpt = int(cpt)
+        self.vl = int(vl)
+
+        # MEMS actifs dans l'ordre des voies
+        self.faisceaux, self.micros = np.nonzero(self.mems)
+        self.nb_mems = len(self.faisceaux)
+        self.colonnes_mems = np.arange(self.nb_mems)
+        # table (faisceau, micro) -> colonne, -1 pour un MEMS inactif
+        self.table_mems = np.full(self.mems.shape, -1, int)
+        self.table_mems[self.faisceaux, self.micros] = self.colonnes_mems
+
+        self.va_actives = np.flatnonzero(self.va)
+        self.colonnes_va = self.nb_mems + np.arange(len(self.va_actives))
+        debut = self.nb_mems + len(self.va_actives)
+        self.colonnes_vl = debut + np.arange(self.vl)
+        self.colonne_cpt = debut + self.vl if self.cpt else None
+        self.nb_voies = debut + self.vl + self.cpt
+
+        # nom de chaque colonne et index inverse
+        self.noms = ['mems_' + str(f) + '_' + str(m) for f, m in zip(self.faisceaux, self.micros)]
+        self.noms += ['va_' + str(k) for k in self.va_actives]
+        self.noms += ['vl_' + str(k) for k in range(self.vl)]
+        if self.cpt:
+            self.noms.append('cpt')
+        self.index = dict((nom, colonne) for colonne, nom in enumerate(self.noms))
+        self.groupes = {'mems': self.colonnes_mems,
+                        'va': self.colonnes_va,
+                        'vl': self.colonnes_vl,
+                        'cpt': np.arange(self.colonne_cpt, self.colonne_cpt + 1) if self.cpt else np.arange(0),
+                        'signal': np.arange(self.nb_voies - self.cpt)}
+
+    def __len__(self):
+        return self.nb_voies
+
+    def colonne(self, voie):
+        """
+        :param voie: [str ou tuple] nom de la voie ('mems_3_5', 'va_1', 'cpt') ou (faisceau, micro)
+        :return: indice de la colonne de la voie
+        """
+        if isinstance(voie, tuple):
+            colonne = int(self.table_mems[voie])
+            if colonne < 0:
+                raise KeyError("MEMS inactif : " + str(voie))
+            return colonne
+        try:
+            return self.index[voie]
+        except KeyError:
+            raise KeyError("voie inconnue : " + str(voie))
+
+    def selection(self, voies=None):
+        """
+        :param voies: None (toutes les voies sauf le compteur), un groupe ('mems', 'va', 'vl', 'cpt',
+                      'signal'), un nom ou un tuple (faisceau, micro), un indice de colonne ou une
+                      liste de ces elements
+        :return: np.array des indices de colonnes
+        """
+        if voies is None:
+            voies = 'signal'
+        if isinstance(voies, str) and voies in self.groupes:
+            return self.groupes[voies]
+        if isinstance(voies, (str, tuple, int, np.integer)):
+            voies = [voies]
+        colonnes = []
+        for voie in voies:
+            if isinstance(voie, (int, np.integer)):
+                colonnes.append(int(voie) % self.nb_voies)
+            elif isinstance(voie, str) and voie in self.groupes:
+                colonnes.extend(self.groupes[voie])
+            else:
+                colonnes.append(self.colonne(voie))
+        return np.asarray(colonnes, int)
+
+    def indexeur(self, voies=None):
+        """
+        :param voies: selection des voies (cf. selection())
+        :return: index des colonnes choisies dans les blocs (cf. indexeur())
+        """
+        return indexeur(self.selection(voies))
+
+    def desentrelaceur(self, voies=None, dtype=np.float32, bloc_max=8192):
+        """
+        :param voies:   selection des voies (cf. selection())
+        :param dtype:   type des echantillons en sortie
+        :return: Desentrelaceur des voies choisies
+        """
+        return Desentrelaceur(self.selection(voies), dtype=dtype, bloc_max=bloc_max)
+
+    def __str__(self):
+        return "voies : " + str(self.nb_mems) + " MEMS, " + str(len(self.va_actives)) + " va, " + \
+               str(self.vl) + " vl, compteur " + ('actif' if self.cpt else 'inactif')
+
+
+def indexeur(colonnes):
+    """
+    index de colonnes pour bloc[:, index] : une tranche quand les colonnes sont contigues et
+    croissantes (cas courant, par exemple toutes les voies sauf le compteur), la selection ne copie
+    alors pas le bloc ; sinon le tableau des colonnes (indexation avancee)
+
+    :param colonnes: [list] indices des colonnes
+    :return: slice ou np.array d'entiers
+    """
+    colonnes = np.asarray(colonnes, int)
+    if len(colonnes) and np.all(np.diff(colonnes) == 1):
+        return slice(int(colonnes[0]), int(colonnes[-1]) + 1)
+    return colonnes
+
+
+def carte_metadonnees(meta):
+    """
+    :param meta: [dict] metadonnees d'acquisition (MegaMicros.metadonnees(), entete des fichiers .mmc)
+    :return: CarteVoies correspondante
+    """
+    return CarteVoies(meta['mems'], meta['va'], meta['cpt'])
+
+
+class Desentrelaceur():
+    """
+    Recopie de colonnes choisies des blocs (nb_tixels, nb_voies) en voies contigues (nb_choisies, nb_tixels)
+    """
+
+    def __init__(self, colonnes, dtype=np.float32, bloc_max=8192, tuile=512):
+        """
+        :param colonnes:    [list] colonnes a recopier, dans l'ordre des lignes de sortie
+        :param dtype:       type des echantillons en sortie
+        :param bloc_max:    [int] taille de bloc attendue (tixels), le buffer grandit si besoin
+        :param tuile:       [int] nombre de tixels transposes a la fois
+        :return:
+        """
+        self.colonnes = np.asarray(colonnes, int)
+        self.nb_voies = len(self.colonnes)
+        self.dtype = np.dtype(dtype)
+        self.tuile = int(tuile)
+        # suites de colonnes consecutives : chacune est recopiee par tranche, sans indexation avancee
+        self.tranches = []
+        ligne = 0
+        for suite in np.split(self.colonnes, np.flatnonzero(np.diff(self.colonnes) != 1) + 1):
+            if len(suite):
+                self.tranches.append((ligne, ligne + len(suite), slice(suite[0], suite[-1] + 1)))
+                ligne += len(suite)
+        self._alloue(bloc_max)
+
+    def _alloue(self, bloc_max):
+        self.bloc_max = int(bloc_max)
+        self.buffer = np.zeros((self.nb_voies * self.bloc_max,), self.dtype)
+
+    def traite(self, bloc, out=None):
+        """
+        :param bloc:    [np.array (nb_tixels, nb_voies)] tixels consecutifs
+        :param out:     [np.array (nb_choisies, nb_tixels)] destination, par defaut le buffer interne
+        :return: np.array (nb_choisies, nb_tixels) contigu ; sans out, c'est une vue sur le buffer
+                 interne, valide jusqu'a l'appel suivant
+        """
+        n = len(bloc)
+        if out is None:
+            if n > self.bloc_max:
+                self._alloue(n)
+            out = self.buffer[:self.nb_voies * n].reshape((self.nb_voies, n))
+        for debut in range(0, n, self.tuile):
+            fin = min(debut + self.tuile, n)
+            for l0, l1, colonnes in self.tranches:
+                out[l0:l1, debut:fin] = bloc[debut:fin, colonnes].T
+        return out
@@ -0,0 +1,327 @@
+# -*- coding: utf-8 -*-
+"""
+Ecriture asynchrone des paquets sur le disque.
+
+Le callback libusb recopie le paquet recu dans un buffer prealloue et le confie a un thread
+d'ecriture via une file bornee : il ne fait jamais d'entree/sortie disque.
+Si tous les buffers sont occupes, le paquet est remplace dans le fichier par un bloc de meme
+taille rempli de valeur_perte (cf. init_verif_compteur) : le fichier reste aligne sur les tixels
+et le trou est repere dans 'trous'. Les paquets perdus consecutifs forment un seul trou et une
+seule marque dans la file, qui reste bornee (au plus une marque entre deux buffers) meme si le
+thread d'ecriture est bloque longtemps ; le bloc de remplissage est prealloue et reutilise.
+Le thread d'ecriture regroupe les paquets en attente en une seule ecriture (os.writev quand
+il est disponible) et peut forcer un fsync a intervalle regulier.
+Il peut aussi alimenter un conteneur (cf. megaSysteme_format.ChunkWriter) : la compression
+se fait alors dans le thread d'ecriture, jamais dans le callback.
+
+En acquisition continue, le thread change de fichier tous les 'rotation' octets (toto_00000.dat,
+toto_00001.dat, ...) : un paquet a cheval sur la limite est coupe entre les deux fichiers, aucun
+octet n'est perdu et, la limite etant un multiple de la taille d'un tixel, chaque fichier contient
+un nombre entier de tixels. Le dernier fichier (ou le fichier unique) peut se terminer par un tixel
+incomplet quand l'acquisition est arretee par stop() : si taille_tixel est fourni, il est tronque
+a la fermeture.
+"""
+from __future__ import division
+import numpy as np
+import threading
+import time
+import os
+import collections
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+PERTE = 'perte'  # marque de paquets perdus consecutifs dans la file du thread d'ecriture
+IOV_MAX = 1024   # nombre maximal de vues par appel a os.writev
+
+
+class DiskWriter():
+    """
+    Thread d'ecriture alimente par une file bornee de buffers de paquets preallouees
+    """
+
+    def __init__(self, fichier, s_pkt, n_buffers=64, coalesce=16, fsync_interval=0., conteneur=None,
+                 rotation=0, fabrique=None, taille_tixel=0):
+        """
+        Initialisation du thread d'ecriture
+
+        :param fichier:         [str]   chemin du fichier de donnees
+        :param s_pkt:           [int]   taille maximale d'un paquet en octets
+        :param n_buffers:       [int]   nombre de buffers de paquets preallouees (profondeur de la file)
+        :param coalesce:        [int]   nombre maximal de paquets regroupes dans une meme ecriture
+        :param fsync_interval:  [float] intervalle (s) entre deux fsync, 0 pour ne jamais forcer
+        :param conteneur:       objet d'ecriture (write, fileno, close) qui remplace le fichier brut
+        :param rotation:        [int]   taille (octets) de chaque fichier, 0 pour un fichier unique
+        :param fabrique:        fabrique(chemin) -> conteneur, pour les fichiers suivants de la rotation
+        :param taille_tixel:    [int]   taille d'un tixel (octets) : le dernier fichier est tronque a un nombre
+                                        entier de tixels, 0 pour ne pas tronquer
+        :return:
+        """
+        self.fichier = fichier
+        self.s_pkt = int(s_pkt)
+        self.n_buffers = int(n_buffers)
+        self.coalesce = int(coalesce)
+        self.fsync_interval = fsync_interval
+        self.rotation = int(rotation)
+        self.fabrique = fabrique
+        self.taille_tixel = int(taille_tixel)
+        self.tronques = 0           # octets du tixel incomplet retires a la fin du dernier fichier
+        self.fichiers = []          # fichiers ecrits (rotation)
+        self.octets_fichier = 0     # octets ecrits dans le fichier courant
+        self.conteneur = conteneur
+        if self.rotation:
+            base, extension = os.path.splitext(fichier)
+            self.modele = base + '_%05d' + extension
+            self.Filep = self._ouvre()
+        elif conteneur is None:
+            self.Filep = open(fichier, 'wb', 0)
+        else:
+            self.Filep = conteneur
+
+        self.pool = np.empty((self.n_buffers, self.s_pkt), np.uint8)
+        self.tailles = [0] * self.n_buffers
+        self.libres = queue.Queue()
+        for i in range(self.n_buffers):
+            self.libres.put(i)
+        self.pleins = queue.Queue()
+        self.perte_en_cours = 0     # octets des paquets perdus consecutifs, pas encore confies au thread
+        self.remplissage = None     # bloc de valeur_perte reutilise pour ecrire les trous
+
+        # statistiques
+        self.paquets = 0            # paquets confies au thread
+        self.perdus = 0             # paquets rejetes faute de buffer libre (remplaces par valeur_perte)
+        self.trous = collections.deque(maxlen=1024)  # (premier paquet perdu, position en octets, taille), les derniers
+        self.octets_soumis = 0      # octets confies au thread, paquets perdus compris
+        self.valeur_perte = 0       # valeur (int32) des mots des paquets perdus
+        self.profondeur_max = 0     # profondeur maximale atteinte par la file
+        self.ecritures = 0          # nombre d'appels systeme d'ecriture
+        self.octets = 0             # octets ecrits
+        self.fsyncs = 0
+        self.latences = collections.deque(maxlen=4096)  # duree (s) des dernieres ecritures
+        self.erreur = None          # exception levee dans le thread d'ecriture
+
+        self.thread = threading.Thread(target=self._boucle)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def submit(self, paquet):
+        """
+        confie un paquet au thread d'ecriture (appele depuis le callback, ne bloque jamais)
+
+        :param paquet: [np.array uint8] contenu du paquet (peut etre une vue sur BBUFFER)
+        :return: True si le paquet a ete pris en charge, False s'il a ete remplace par un bloc de valeur_perte
+        """
+        n = len(paquet)
+        position = self.octets_soumis
+        self.octets_soumis += n
+        try:
+            i = self.libres.get_nowait()
+        except queue.Empty:
+            # plus de buffer libre : le thread ecrira a la place un bloc de meme taille rempli de
+            # valeur_perte, le fichier reste aligne sur les tixels et le trou est repere ; les pertes
+            # consecutives sont cumulees et confiees au thread avec le paquet suivant
+            self.perdus += 1
+            if self.perte_en_cours:
+                numero, debut, taille = self.trous[-1]
+                self.trous[-1] = (numero, debut, taille + n)
+            else:
+                self.trous.append((self.paquets + self.perdus - 1, position, n))
+            self.perte_en_cours += n
+            return False
+        self._signale_perte()
+        self.pool[i, :n] = paquet
+        self.tailles[i] = n
+        self.pleins.put(i)
+        self.paquets += 1
+        profondeur = self.pleins.qsize()
+        if profondeur > self.profondeur_max:
+            self.profondeur_max = profondeur
+        return True
+
+    def _signale_perte(self):
+        """
+        confie au thread d'ecriture la marque des paquets perdus depuis le dernier paquet pris en charge
+        """
+        if self.perte_en_cours:
+            self.pleins.put((PERTE, self.perte_en_cours))
+            self.perte_en_cours = 0
+
+    def _ouvre(self):
+        """
+        ouverture du fichier suivant de la rotation
+        """
+        chemin = self.modele % len(self.fichiers)
+        self.fichiers.append(chemin)
+        self.octets_fichier = 0
+        if self.fabrique is not None:
+            self.conteneur = self.fabrique(chemin)
+            return self.conteneur
+        return open(chemin, 'wb', 0)
+
+    def _ferme(self):
+        if self.conteneur is None:
+            os.fsync(self.Filep.fileno())
+        self.Filep.close()
+
+    def _ecrit(self, vues):
+        """
+        ecriture groupee d'une liste de vues, avec changement de fichier a chaque limite de rotation
+        """
+        if not self.rotation:
+            self._ecrit_fichier(vues)
+            return
+        lot = []
+        place = self.rotation - self.octets_fichier
+        for vue in vues:
+            while len(vue) > place:
+                # la vue deborde du fichier courant : on le complete puis on passe au suivant
+                lot.append(vue[:place])
+                self._ecrit_fichier(lot)
+                self._ferme()
+                self.Filep = self._ouvre()
+                lot = []
+                vue = vue[place:]
+                place = self.rotation
+            lot.append(vue)
+            place -= len(vue)
+        self._ecrit_fichier(lot)
+
+    def _ecrit_fichier(self, vues):
+        """
+        ecriture groupee d'une liste de vues dans le fichier courant, en gerant les ecritures partielles
+        """
+        self.octets_fichier += sum(len(vue) for vue in vues)
+        fd = self.Filep.fileno()
+        if self.conteneur is None and hasattr(os, 'writev'):
+            k = 0
+            while k < len(vues):
+                n = os.writev(fd, vues[k:k + IOV_MAX])
+                self.ecritures += 1
+                self.octets += n
+                # on saute ce qui a deja ete ecrit
+                while k < len(vues) and n >= len(vues[k]):
+                    n -= len(vues[k])
+                    k += 1
+                if n:
+                    vues[k] = vues[k][n:]
+        else:
+            for vue in vues:
+                self.Filep.write(vue)
+                self.ecritures += 1
+                self.octets += len(vue)
+
+    def _boucle(self):
+        """
+        boucle du thread d'ecriture : vide la file jusqu'a la reception de None
+        """
+        dernier_fsync = time.time()
+        fin = False
+        while not fin:
+            i = self.pleins.get()
+            if i is None:
+                break
+            lot = [i]
+            while len(lot) < self.coalesce:
+                try:
+                    j = self.pleins.get_nowait()
+                except queue.Empty:
+                    break
+                if j is None:
+                    fin = True
+                    break
+                lot.append(j)
+            t0 = time.time()
+            try:
+                vues = []
+                for j in lot:
+                    vues.extend(self._vues(j))
+                self._ecrit(vues)
+                if self.fsync_interval and t0 - dernier_fsync >= self.fsync_interval:
+                    os.fsync(self.Filep.fileno())
+                    self.fsyncs += 1
+                    dernier_fsync = t0
+            except (IOError, OSError) as e:
+                self.erreur = e
+            self.latences.append(time.time() - t0)
+            for j in lot:
+                if not isinstance(j, tuple):
+                    self.libres.put(j)
+
+    def _vues(self, j):
+        """
+        :return: liste de vues : sur le buffer j, ou sur le bloc de remplissage pour des paquets
+                 perdus (PERTE, taille)
+        """
+        if not isinstance(j, tuple):
+            return [memoryview(self.pool[j, :self.tailles[j]])]
+        if self.remplissage is None or self.remplissage[0] != self.valeur_perte:
+            # valeur_perte peut etre fixee apres la creation (cf. init_verif_compteur)
+            bloc = np.full((self.s_pkt // 4,), self.valeur_perte, np.int32)
+            self.remplissage = (self.valeur_perte, memoryview(bloc.view(np.uint8)))
+        bloc = self.remplissage[1]
+        reste = j[1]
+        vues = []
+        while reste:
+            vues.append(bloc[:min(reste, len(bloc))])
+            reste -= len(vues[-1])
+        return vues
+
+    def profondeur(self):
+        """
+        :return: nombre de paquets en attente d'ecriture
+        """
+        return self.pleins.qsize()
+
+    def stats(self):
+        """
+        :return: dictionnaire des statistiques du thread d'ecriture
+        """
+        latences = np.array(self.latences)
+        stats = {'profondeur': self.profondeur(),
+                 'profondeur_max': self.profondeur_max,
+                 'paquets': self.paquets,
+                 'perdus': self.perdus,
+                 'trous': list(self.trous),
+                 'ecritures': self.ecritures,
+                 'octets': self.octets,
+                 'fsyncs': self.fsyncs}
+        if len(latences):
+            stats['latence_moyenne'] = float(latences.mean())
+            stats['latence_p99'] = float(np.percentile(latences, 99))
+            stats['latence_max'] = float(latences.max())
+        return stats
+
+    def close(self):
+        """
+        vide la file, tronque le dernier fichier a un nombre entier de tixels, force l'ecriture sur le
+        disque et ferme le fichier
+        """
+        self._signale_perte()
+        self.pleins.put(None)
+        self.thread.join()
+        if self.conteneur is None and self.taille_tixel:
+            # les conteneurs (ChunkWriter) n'ecrivent deja que des tixels complets
+            self.tronques = self.octets_fichier % self.taille_tixel
+            if self.tronques:
+                self.octets_fichier -= self.tronques
+                self.Filep.truncate(self.octets_fichier)
+        self._ferme()
+        if self.erreur is not None:
+            raise self.erreur
+
+    def __str__(self):
+        stats = self.stats()
+        chaine = "ecriture asynchrone : " + str(stats['octets']) + " octets en " + \
+                 str(stats['ecritures']) + " ecritures, file " + str(stats['profondeur']) + "/" + \
+                 str(self.n_buffers) + " (max " + str(stats['profondeur_max']) + "), " + \
+                 str(stats['perdus']) + " paquets perdus"
+        if self.trous:
+            chaine = chaine + " (paquets " + str([t[0] for t in list(self.trous)[-10:]]) + \
+                     " remplaces par " + str(self.valeur_perte) + ")"
+        if self.rotation:
+            chaine = chaine + ", " + str(len(self.fichiers)) + " fichiers"
+        if 'latence_max' in stats:
+            chaine = chaine + ", latence max " + str(round(stats['latence_max'] * 1000, 2)) + " ms"
+        return chaine
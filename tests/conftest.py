@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+"""
+Tests du pipeline d'acquisition, pilotes par le boitier simule (cf. megaSysteme_simu) :
+
+    python -m pytest tests
+"""
+from __future__ import division
+import os
+import sys
+import time
+
+import numpy as np
+import pytest
+
+REPERTOIRE = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(REPERTOIRE, '..', 'mm'))
+sys.path.append(os.path.join(REPERTOIRE, '..', 'lecture'))
+
+import megaSysteme_core as core
+import megaSysteme_128 as mega
+from megaSysteme_simu import LibusbSimu
+
+
+class TempsSimule():
+    """
+    module time sans les attentes de mise sous tension et de fermeture du boitier, inutiles avec le simulateur
+    """
+
+    def __getattr__(self, nom):
+        return getattr(time, nom)
+
+    def sleep(self, duree):
+        pass
+
+
+@pytest.fixture
+def systeme(monkeypatch, tmp_path):
+    """
+    fabrique de System128 sur le boitier simule : 3 MEMS et le compteur (4 voies), fichier 'acq.dat'
+    dans le repertoire temporaire du test. Le boitier produit aussi vite que possible (debit=0) ; les
+    tests de l'ecriture asynchrone lui donnent un debit fini pour que le thread d'ecriture suive
+    """
+    monkeypatch.setattr(mega, 'time', TempsSimule())
+    monkeypatch.setattr(core, 'time', TempsSimule())
+
+    def fabrique(duree=0.5, debit=0, simu=None, **kwargs):
+        mems = np.zeros((16, 8), bool)
+        mems[0, :3] = True
+        kwargs.setdefault('filename', 'acq.dat')
+        kwargs.setdefault('path', str(tmp_path))
+        return mega.System128(duree=duree, mems=mems, va=np.zeros((4,), bool), cpt=1,
+                              backend=LibusbSimu(debit=debit, **(simu or {})), **kwargs)
+    return fabrique
+
@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+"""
+Acquisition de bout en bout sur le boitier simule : continuite du compteur dans chaque mode,
+trous dus aux pertes et aux timeouts, rotation des fichiers et rearmement en acquisition continue.
+"""
+from __future__ import division
+import os
+
+import numpy as np
+import pytest
+
+import megaSysteme_core as core
+
+NB_VOIES = 4                # 3 MEMS et le compteur (cf. conftest.systeme)
+TIXELS_PAQUET = 192         # s_pkt par defaut : 1024 octets par MEMS
+DEBIT_ASYNC = 5             # debit du simulateur (x temps reel) suivi par le thread d'ecriture
+
+
+class Arret():
+    """
+    observateur qui arrete l'acquisition continue apres nb_tixels tixels
+    """
+
+    def __init__(self, Mm, nb_tixels):
+        self.Mm = Mm
+        self.nb_tixels = nb_tixels
+        self.tixels = 0
+
+    def paquet(self, bloc):
+        self.tixels += len(bloc)
+        if self.tixels >= self.nb_tixels:
+            self.Mm.stop()
+
+
+def lit_interactif(Mm, duree_bloc=0.01):
+    """
+    :return: tous les tixels restant dans le buffer interactif, concatenes
+    """
+    blocs = []
+    while True:
+        res, bloc = Mm.get_data(duree_bloc)
+        if res == 0:
+            break
+        blocs.append(bloc.copy())
+    # fin du flux, plus courte qu'un bloc
+    blocs.append(Mm.ring.read(Mm.ring.available()).copy())
+    return np.concatenate(blocs)
+
+
+def tixels_attendus(Mm):
+    """
+    :return: nombre de tixels du flux : en mode interactif, l'acquisition s'arrete au dernier paquet
+             de taille standard (cf. fin_paquets), le dernier paquet (plus court) n'est pas lu
+    """
+    if Mm.interactif == 1:
+        return (Mm.n_pkt - 1) * TIXELS_PAQUET
+    return Mm.COUNT
+
+
+def acquiert(Mm):
+    """
+    :return: tixels acquis (fichier ou buffer interactif)
+    """
+    Mm.start()
+    Mm.show()
+    if Mm.interactif == 1:
+        tixels = lit_interactif(Mm)
+        Mm.close()
+        return tixels
+    Mm.close()
+    return np.fromfile(Mm.fichier, np.int32).reshape((-1, NB_VOIES))
+
+
+@pytest.mark.parametrize('mode', [{'interactif': 0, 'ecriture_async': 0},
+                                  {'interactif': 0, 'ecriture_async': 1, 'debit': DEBIT_ASYNC},
+                                  {'interactif': 1}],
+                         ids=['disque', 'asynchrone', 'interactif'])
+def test_compteur_continu(systeme, mode):
+    Mm = systeme(duree=0.5, **mode)
+    verif = Mm.init_verif_compteur()
+    tixels = acquiert(Mm)
+    assert len(tixels) == tixels_attendus(Mm)
+    assert np.all(tixels[:, -1] == np.arange(len(tixels)))
+    assert verif.tixels == len(tixels) and verif.trous == []
+    if Mm.writer is not None:
+        assert Mm.writer.perdus == 0
+
+
+@pytest.mark.parametrize('interactif', [0, 1])
+def test_pertes_vues_par_verif(systeme, interactif):
+    Mm = systeme(duree=0.5, interactif=interactif, simu={'pertes': (10, 30, 31)})
+    verif = Mm.init_verif_compteur(remplissage=-1)
+    tixels = acquiert(Mm)
+    # les paquets perdus sont remplaces par des paquets de meme taille : le flux garde sa longueur
+    assert len(tixels) == tixels_attendus(Mm)
+    assert [(t.indice, t.perdus) for t in verif.trous] == [(10 * TIXELS_PAQUET, TIXELS_PAQUET),
+                                                         (30 * TIXELS_PAQUET, 2 * TIXELS_PAQUET)]
+    remplis = np.all(tixels == -1, axis=1)
+    assert np.count_nonzero(remplis) == verif.tixels_perdus
+    assert np.all(tixels[~remplis, -1] == np.flatnonzero(~remplis))
+
+
+@pytest.mark.parametrize('interactif', [0, 1])
+def test_timeouts_sans_trou(systeme, interactif):
+    Mm = systeme(duree=0.5, interactif=interactif, simu={'timeouts': (10, 30, 31)})
+    verif = Mm.init_verif_compteur(remplissage=-1)
+    tixels = acquiert(Mm)
+    # les mots non transferts arrivent dans les paquets suivants : ni trou ni remplissage
+    assert Mm.mots_retardes > 0
+    assert verif.trous == []
+    assert not np.any(tixels == -1)
+    assert np.all(tixels[:, -1] == np.arange(len(tixels)))
+
+
+def test_rotation_dat(systeme):
+    Mm = systeme(continu=1, filename='rotation.dat', taille_fichier=100000, debit=DEBIT_ASYNC)
+    Mm.ajoute_observateur(Arret(Mm, 50000))
+    Mm.start()
+    Mm.show()
+    Mm.close()
+    assert Mm.writer.perdus == 0
+    fichiers = Mm.writer.fichiers
+    assert len(fichiers) > 3
+    taille_tixel = 4 * NB_VOIES
+    assert all(os.path.getsize(f) % taille_tixel == 0 for f in fichiers)
+    assert all(os.path.getsize(f) == Mm.writer.rotation for f in fichiers[:-1])
+    compteur = np.concatenate([np.fromfile(f, np.int32).reshape((-1, NB_VOIES))[:, -1] for f in fichiers])
+    assert len(compteur) >= 50000
+    assert np.all(compteur == np.arange(len(compteur)))
+
+
+def test_rearmement_continu(systeme, monkeypatch):
+    # compteur du boitier reduit pour rearmer apres quelques paquets
+    monkeypatch.setattr(core, 'COUNT_MAX', 3 * 32768 + 5)
+    Mm = systeme(continu=1, filename='rearme.dat', duree_fichier=1., debit=DEBIT_ASYNC)
+    assert Mm.COUNT % TIXELS_PAQUET == 0 and Mm.COUNT <= core.COUNT_MAX
+    verif = Mm.init_verif_compteur()
+    Mm.ajoute_observateur(Arret(Mm, 350000))
+    Mm.start()
+    Mm.show()
+    Mm.close()
+    assert verif.trous == [] and Mm.writer.perdus == 0
+    assert len(Mm.rearmements) == 3
+    compteur = np.concatenate([np.fromfile(f, np.int32).reshape((-1, NB_VOIES))[:, -1]
+                               for f in Mm.writer.fichiers])
+    # le compteur du boitier repart de zero a chaque rearmement
+    assert list(np.flatnonzero(np.diff(compteur) != 1) + 1) == [r[0] for r in Mm.rearmements]
+    assert np.all(compteur == np.arange(len(compteur)) % Mm.COUNT)
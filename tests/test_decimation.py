@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+"""
+Decimation en flux : sortie identique a un filtrage hors ligne quel que soit le decoupage en paquets,
+colonnes brutes a n'importe quelle position, saturation aux bornes des int32.
+"""
+from __future__ import division
+import numpy as np
+import pytest
+
+from megaSysteme_decimation import Decimateur, filtre_decimation
+
+INT32_MIN = np.iinfo(np.int32).min
+INT32_MAX = np.iinfo(np.int32).max
+
+
+def decimation_hors_ligne(x, facteur, brutes, longueur=12):
+    """
+    :param x: [np.array int32 (n, nb_voies)] signal entier
+    :return: sorties completes (fenetre de la sortie m : tixels [m * facteur, m * facteur + n_h[)
+    """
+    h = filtre_decimation(facteur, longueur)
+    n_sorties = (len(x) - len(h)) // facteur + 1
+    sortie = np.zeros((n_sorties, x.shape[1]), np.int32)
+    for m in range(n_sorties):
+        fenetre = x[m * facteur:m * facteur + len(h)].astype(np.float64)
+        sortie[m] = np.rint(np.clip(h.dot(fenetre), INT32_MIN, INT32_MAX))
+    centre = longueur * facteur
+    sortie[:, brutes] = x[centre:centre + facteur * n_sorties:facteur][:, brutes]
+    return sortie
+
+
+def decime(decimateur, x, tailles):
+    """
+    :return: sorties concatenees de x (tixels entrelaces) decoupe en paquets de tailles donnees (mots)
+    """
+    mots = x.reshape(-1)
+    sorties = []
+    i = 0
+    for taille in tailles:
+        sorties.append(decimateur.traite(mots[i:i + taille]).copy())
+        i += taille
+    return np.concatenate(sorties)
+
+
+@pytest.mark.parametrize('brutes', [[3], [0], [1, 3], []])
+def test_flux_egal_hors_ligne(brutes):
+    aleatoire = np.random.RandomState(5)
+    x = aleatoire.randint(-100000, 100000, (3000, 4)).astype(np.int32)
+    x[:, brutes] = np.arange(len(x))[:, None]
+    # paquets non alignes sur les tixels, plus grands que bloc_max pour certains
+    tailles = aleatoire.randint(1, 900, 40)
+    tailles = tailles[np.cumsum(tailles) <= x.size]
+    tailles = np.append(tailles, x.size - tailles.sum())
+    decimateur = Decimateur(4, 4, brutes=brutes, bloc_max=64)
+    sortie = decime(decimateur, x, tailles)
+    np.testing.assert_array_equal(sortie, decimation_hors_ligne(x, 4, brutes))
+    for b in brutes:
+        # le compteur de sortie progresse de facteur par tixel
+        assert np.all(np.diff(sortie[:, b]) == 4)
+
+
+def test_saturation():
+    # creneau pleine echelle : le depassement du filtre sature au lieu de deborder
+    x = np.zeros((2000, 2), np.int32)
+    x[:, 0] = np.where((np.arange(len(x)) // 50) % 2, INT32_MAX, INT32_MIN)
+    x[:, 1] = np.arange(len(x))
+    sortie = decime(Decimateur(4, 2, brutes=[1]), x, [1000, 1000, 2000])
+    attendu = decimation_hors_ligne(x, 4, [1])
+    np.testing.assert_array_equal(sortie, attendu)
+    assert sortie[:, 0].max() == INT32_MAX and sortie[:, 0].min() == INT32_MIN
+    # le filtre depasse bien la pleine echelle : sans saturation, ces sorties changeraient de signe
+    h = filtre_decimation(4)
+    brut = np.array([h.dot(x[m:m + len(h), 0].astype(np.float64)) for m in range(0, len(x) - len(h), 4)])
+    assert brut.max() > INT32_MAX and brut.min() < INT32_MIN
+
+
+def test_sans_allocation_par_paquet():
+    decimateur = Decimateur(4, 4, brutes=[3], bloc_max=256)
+    tampon, sortie, calcul = decimateur.tampon, decimateur.sortie, decimateur.calcul
+    x = np.random.RandomState(6).randint(-1000, 1000, (5000, 4)).astype(np.int32).reshape(-1)
+    for debut in range(0, len(x), 1000):
+        decimateur.traite(x[debut:debut + 1000])
+    assert decimateur.tampon is tampon and decimateur.sortie is sortie and decimateur.calcul is calcul
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+"""
+Enveloppe : les points lus (min, max, valeur efficace) sont ceux calcules directement sur les tixels.
+"""
+from __future__ import division
+import numpy as np
+import pytest
+
+from megaSysteme_enveloppe import Enveloppe
+from test_acquisition import NB_VOIES
+
+
+class Enregistreur():
+    """
+    observateur qui garde une copie de tous les tixels recus
+    """
+
+    def __init__(self):
+        self.blocs = []
+
+    def paquet(self, bloc):
+        self.blocs.append(bloc.copy())
+
+    def tixels(self):
+        return np.concatenate(self.blocs)
+
+
+def verifie(x, resultat, colonnes):
+    """
+    compare une lecture de l'enveloppe au calcul direct sur les tixels x (nb_tixels, nb_voies)
+    """
+    debut, pas, mins, maxs, rms = resultat
+    nb_points = mins.shape[1]
+    assert mins.shape == maxs.shape == rms.shape == (len(colonnes), nb_points)
+    assert debut + nb_points * pas <= len(x)
+    for tableau in (mins, maxs, rms):
+        assert tableau.flags['C_CONTIGUOUS']
+    points = x[debut:debut + nb_points * pas, colonnes].reshape((nb_points, pas, len(colonnes)))
+    np.testing.assert_array_equal(mins, points.min(axis=1).T)
+    np.testing.assert_array_equal(maxs, points.max(axis=1).T)
+    np.testing.assert_allclose(rms, np.sqrt(np.mean(points.astype(np.float64) ** 2, axis=1)).T, rtol=1e-5)
+
+
+def remplit(enveloppe, x, graine=3):
+    """
+    pousse x dans l'enveloppe par blocs de tailles aleatoires
+    """
+    tailles = np.random.RandomState(graine).randint(0, 700, len(x))
+    i = 0
+    for taille in tailles:
+        enveloppe.paquet(x[i:i + taille])
+        i += taille
+        if i >= len(x):
+            break
+
+
+@pytest.fixture
+def signal():
+    aleatoire = np.random.RandomState(4)
+    x = aleatoire.randint(-30000, 30000, (40000, 5)).astype(np.int32)
+    x[:, 4] = np.arange(len(x))
+    return x
+
+
+@pytest.mark.parametrize('debut, fin, nb_pixels', [(39000, 40000, 100),       # niveau 0
+                                                   (36000, 40000, 200),       # niveau 1, regroupe par 4
+                                                   (33000, 39990, 20),        # niveau 2
+                                                   (0, 40000, 7)])            # niveau 2, historique tronque
+def test_lit_egal_calcul_direct(signal, debut, fin, nb_pixels):
+    colonnes = [0, 1, 2, 3]
+    enveloppe = Enveloppe(colonnes, 50000., resolutions=(4, 16, 128), capacite=256)
+    remplit(enveloppe, signal)
+    assert enveloppe.tixels == len(signal)
+    resultat = enveloppe.lit(debut, fin, nb_pixels)
+    verifie(signal, resultat, colonnes)
+    n = resultat[2].shape[1]
+    assert 0 < n < 2 * nb_pixels
+
+
+def test_lignes_et_colonnes_non_contigues(signal):
+    colonnes = [3, 0, 2]
+    enveloppe = Enveloppe(colonnes, 50000., resolutions=(8, 64), capacite=512)
+    remplit(enveloppe, signal)
+    resultat = enveloppe.derniers(0.05, 100, lignes=[2, 0])
+    verifie(signal, resultat, [2, 3])
+    assert resultat[0] + resultat[2].shape[1] * resultat[1] > len(signal) - 8 * 4
+
+
+def test_fenetre_hors_historique(signal):
+    enveloppe = Enveloppe([0, 1], 50000., resolutions=(4, 16), capacite=64)
+    remplit(enveloppe, signal)
+    # l'historique du niveau 0 couvre les 256 derniers tixels
+    debut, pas, mins, maxs, rms = enveloppe.lit(1000, 2000, 100)
+    assert mins.shape == maxs.shape == rms.shape == (2, 0)
+    # fenetre posterieure au dernier point
+    assert enveloppe.lit(len(signal), len(signal) + 400, 10, lignes=[1])[2].shape == (1, 0)
+
+
+def test_resolutions_invalides():
+    with pytest.raises(ValueError):
+        Enveloppe([0], 50000., resolutions=(64, 100))
+
+
+def test_get_enveloppe_acquisition(systeme):
+    Mm = systeme(duree=0.5)
+    enveloppe = Mm.init_enveloppe(resolutions=(64, 512), capacite=1024)
+    enregistreur = Enregistreur()
+    Mm.ajoute_observateur(enregistreur)
+    Mm.start()
+    Mm.show()
+    Mm.close()
+    x = enregistreur.tixels()
+    assert enveloppe.tixels == len(x)
+    verifie(x, Mm.get_enveloppe(0.2, 50), list(range(NB_VOIES - 1)))
+    verifie(x, Mm.get_enveloppe(0.1, 50, voies=[(0, 1)]), [1])
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+"""
+Codecs sans perte du format .mmc (y compris aux bornes des int32) et enregistrement .mmc de bout en bout.
+"""
+from __future__ import division
+import numpy as np
+import pytest
+
+import megaSysteme_format as fmt
+from megaSysteme_format import encode, decode, ChunkWriter, LectureMMC
+from test_acquisition import NB_VOIES, DEBIT_ASYNC
+
+INT32_MIN = np.iinfo(np.int32).min
+INT32_MAX = np.iinfo(np.int32).max
+
+CODECS = ['raw', 'bitpack', 'zlib',
+          pytest.param('zstd', marks=pytest.mark.skipif(fmt.zstandard is None, reason="zstandard absent")),
+          pytest.param('lz4', marks=pytest.mark.skipif(fmt.lz4 is None, reason="lz4 absent"))]
+
+
+def bloc_test(n=1000, graine=0):
+    """
+    :return: bloc int32 (n, 6) : signal, bruit pleine echelle, alternance des bornes int32 (differences
+             qui debordent), voie constante, voie aux bornes constantes, compteur qui passe INT32_MAX
+    """
+    aleatoire = np.random.RandomState(graine)
+    bloc = np.zeros((n, 6), np.int32)
+    bloc[:, 0] = (1e6 * np.sin(np.arange(n) / 7.)).astype(np.int32)
+    bloc[:, 1] = aleatoire.randint(INT32_MIN, INT32_MAX, n, dtype=np.int64)
+    bloc[:, 2] = np.where(np.arange(n) % 2, INT32_MAX, INT32_MIN)
+    bloc[:, 3] = -12345
+    bloc[:, 4] = INT32_MIN
+    bloc[:, 5] = ((np.arange(n) + INT32_MAX - n // 2 + (1 << 31)) % (1 << 32) - (1 << 31)).astype(np.int32)
+    return bloc
+
+
+@pytest.mark.parametrize('codec', CODECS)
+@pytest.mark.parametrize('n', [1, 2, 3, 1000])
+def test_aller_retour(codec, n):
+    bloc = bloc_test(n)
+    donnees = encode(bloc, codec)
+    assert isinstance(donnees, bytes)
+    sortie = decode(donnees, codec, n, bloc.shape[1])
+    assert sortie.dtype == np.int32
+    np.testing.assert_array_equal(sortie, bloc)
+
+
+@pytest.mark.parametrize('codec', CODECS)
+def test_aller_retour_vue_non_contigue(codec):
+    bloc = bloc_test(500)
+    vue = bloc[::2, [5, 0, 2]]
+    np.testing.assert_array_equal(decode(encode(vue, codec), codec, len(vue), 3), vue)
+
+
+def test_bitpack_compresse_un_signal_lent():
+    bloc = bloc_test(1000)[:, [0, 3, 5]]
+    # differences sur 18 bits au plus, voie constante sur 0 bit
+    assert len(encode(bloc, 'bitpack')) < 0.3 * bloc.nbytes
+
+
+def test_codec_inconnu():
+    with pytest.raises(ValueError):
+        encode(bloc_test(10), 'lzma')
+    with pytest.raises(ValueError):
+        ChunkWriter('inutile.mmc', {'nb_voies': 4}, codec='lzma')
+
+
+@pytest.mark.parametrize('codec', ['bitpack', 'zlib'])
+def test_chunkwriter_paquets_non_alignes(tmp_path, codec):
+    bloc = bloc_test(1234)
+    fichier = str(tmp_path / 'blocs.mmc')
+    writer = ChunkWriter(fichier, {'nb_voies': 6, 'frequence': 1000.}, codec=codec, tixels_par_bloc=100)
+    mots = bloc.reshape(-1)
+    for debut in range(0, len(mots), 77):
+        writer.write(mots[debut:debut + 77])
+    writer.close()
+    lecture = LectureMMC(fichier)
+    assert len(lecture) == 1234 and len(lecture.premiers) == 13
+    np.testing.assert_array_equal(lecture.lire(), bloc)
+    # fenetre a cheval sur plusieurs blocs, voies choisies
+    np.testing.assert_array_equal(lecture.lire(0.15, 0.405, voies=[5, 1]), bloc[150:405, [5, 1]])
+    lecture.close()
+
+
+def test_acquisition_mmc(systeme):
+    Mm = systeme(duree=0.5, filename='acq.mmc', format='mmc', codec='bitpack', debit=DEBIT_ASYNC)
+    Mm.start()
+    Mm.show()
+    Mm.close()
+    assert Mm.writer.perdus == 0
+    lecture = LectureMMC(Mm.fichier)
+    assert lecture.metadonnees['codec'] == 'bitpack' and lecture.nb_voies == NB_VOIES
+    tixels = lecture.lire()
+    assert np.all(tixels[:, -1] == np.arange(Mm.COUNT))
+    lecture.close()
@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+"""
+Buffer circulaire du mode interactif : les trois politiques de debordement, seul et derriere le
+boitier simule, et la lecture d'un bloc ecrase pendant sa copie.
+"""
+from __future__ import division
+import threading
+
+import numpy as np
+import pytest
+
+from megaSysteme_ring import RingBuffer, OverrunError
+from test_acquisition import NB_VOIES, TIXELS_PAQUET, lit_interactif, tixels_attendus
+
+
+def tixels(debut, n, nb_voies=NB_VOIES):
+    """
+    :return: mots de n tixels dont toutes les voies valent l'indice du tixel (a partir de debut)
+    """
+    return np.repeat(np.arange(debut, debut + n, dtype=np.int32), nb_voies)
+
+
+class Ecrasement(np.ndarray):
+    """
+    buffer de sortie qui fait ecrire le producteur pendant la copie du consommateur
+    """
+
+    def __array_finalize__(self, obj):
+        self.ring = getattr(obj, 'ring', None)
+
+    def __setitem__(self, cle, valeur):
+        ring = self.ring
+        if ring is not None:
+            ring.write(tixels(ring.ecrit // ring.nb_voies, ring.capacite // ring.nb_voies))
+        np.ndarray.__setitem__(self, cle, valeur)
+
+
+def test_drop_oldest_recale_le_lecteur():
+    ring = RingBuffer(10, NB_VOIES)
+    ring.write(tixels(0, 6))
+    assert ring.read(2)[:, 0].tolist() == [0, 1]
+    ring.write(tixels(6, 9))
+    # 15 tixels ecrits, 2 lus : les tixels 2 a 4 ont ete ecrases sans avoir ete lus
+    assert ring.overruns == 1 and ring.perdus == 3
+    assert ring.available() == 10
+    assert ring.read(10)[:, 0].tolist() == list(range(5, 15))
+
+
+def test_drop_oldest_paquets_non_alignes():
+    ring = RingBuffer(10, NB_VOIES)
+    mots = tixels(0, 40)
+    for debut in range(0, len(mots), 7):
+        ring.write(mots[debut:debut + 7])
+    bloc = ring.read(ring.available())
+    assert np.all(bloc == bloc[:, :1])
+    assert bloc[:, 0].tolist() == list(range(30, 40))
+    assert ring.perdus == 30
+
+
+def test_raise_garde_l_alignement():
+    ring = RingBuffer(10, NB_VOIES, politique='raise')
+    ring.write(tixels(0, 8))
+    # paquet coupe au milieu d'un tixel : le tixel 8 est complete, les suivants sont rejetes
+    paquet = tixels(8, 5)[:-2]
+    ring.write(paquet[:2])
+    with pytest.raises(OverrunError):
+        ring.write(paquet[2:])
+    assert ring.overruns == 1 and ring.perdus == 4
+    # les 2 mots restants du tixel 12 sont sautes au debut du paquet suivant
+    ring.read(9)
+    ring.write(tixels(12, 3)[2:])
+    assert ring.a_sauter == 0
+    assert ring.read(2).tolist() == [[13] * NB_VOIES, [14] * NB_VOIES]
+
+
+def test_block_timeout_rejette_le_paquet():
+    ring = RingBuffer(4, NB_VOIES, politique='block', timeout=0.01)
+    assert ring.write(tixels(0, 4))
+    assert not ring.write(tixels(4, 2))
+    assert ring.overruns == 1 and ring.perdus == 2
+    assert ring.read(4)[:, 0].tolist() == [0, 1, 2, 3]
+
+
+def test_block_attend_le_lecteur():
+    ring = RingBuffer(8, NB_VOIES, politique='block', timeout=5.)
+    lus = []
+
+    def lecteur():
+        while len(lus) < 100:
+            bloc = ring.read(1)
+            if bloc is not None:
+                lus.append(int(bloc[0, 0]))
+
+    thread = threading.Thread(target=lecteur)
+    thread.start()
+    for debut in range(0, 100, 5):
+        assert ring.write(tixels(debut, 5))
+    thread.join(10.)
+    assert lus == list(range(100))
+    assert ring.overruns == 0 and ring.perdus == 0
+
+
+@pytest.mark.parametrize('contigu', [True, False])
+def test_bloc_ecrase_pendant_la_lecture(contigu):
+    ring = RingBuffer(10, NB_VOIES)
+    ring.write(tixels(0, 3 if contigu else 7))
+    if not contigu:
+        ring.read(7)
+        ring.write(tixels(7, 6))
+    lu = ring.lu
+    out = np.zeros((5, NB_VOIES), np.int32).view(Ecrasement)
+    out.ring = ring
+    if contigu:
+        assert ring.read(5) is None     # moins de 5 tixels disponibles
+        ring.write(tixels(3, 2))
+    assert ring.read(5, out=out) is None
+    assert ring.lu == lu
+    # le lecteur est recale sur les tixels encore valides a la lecture suivante
+    bloc = ring.read(10)
+    assert bloc[:, 0].tolist() == list(range(bloc[0, 0], bloc[0, 0] + 10))
+    assert ring.ecrit // NB_VOIES - bloc[-1, 0] == 1
+
+
+@pytest.mark.parametrize('politique', ['drop_oldest', 'raise', 'block'])
+def test_politiques_lecteur_absent(systeme, politique):
+    # buffer de 0.1 s et aucun lecteur pendant 0.5 s d'acquisition
+    Mm = systeme(duree=0.5, interactif=1, politique=politique, duree_buffer=0.1)
+    Mm.start()
+    Mm.show()
+    capacite = Mm.ring.capacite // NB_VOIES
+    ecrits = tixels_attendus(Mm)
+    if politique == 'drop_oldest':
+        bloc = lit_interactif(Mm)
+        assert len(bloc) == capacite
+        assert Mm.ring.perdus == ecrits - capacite
+        assert np.all(bloc[:, -1] == np.arange(ecrits - capacite, ecrits))
+    else:
+        with pytest.raises(OverrunError):
+            Mm.get_data(0.01)
+        bloc = lit_interactif(Mm)
+        # le debut du flux est conserve, les paquets suivants sont rejetes par tixels entiers
+        assert capacite - TIXELS_PAQUET < len(bloc) <= capacite
+        assert np.all(bloc[:, -1] == np.arange(len(bloc)))
+        assert len(bloc) + Mm.ring.perdus == ecrits
+    Mm.close()
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+"""
+StreamingSTFT : les trames calculees en flux sont celles d'une STFT sur le signal entier,
+quel que soit le decoupage en blocs.
+"""
+from __future__ import division
+import numpy as np
+import pytest
+
+from megaSysteme_stft import StreamingSTFT
+
+
+def stft_hors_ligne(x, nfft, hop):
+    """
+    :param x: [np.array (n, nb_voies)] signal entier
+    :return: (spectres (nb_trames, nfft // 2 + 1, nb_voies), premiers tixels des trames)
+    """
+    debuts = np.arange(0, len(x) - nfft + 1, hop)
+    fenetre = np.hanning(nfft)
+    trames = np.stack([x[d:d + nfft] * fenetre[:, None] for d in debuts])
+    return np.fft.rfft(trames, axis=1), debuts
+
+
+def pousse(stft, x, tailles):
+    """
+    :return: (spectres, debuts) concatenes de tous les push de x decoupe en blocs de tailles donnees
+    """
+    spectres, debuts = [], []
+    i = 0
+    for taille in tailles:
+        s, d = stft.push(x[i:i + taille])
+        # vues sur les buffers de la STFT : copies avant le push suivant
+        spectres.append(s.copy())
+        debuts.append(d.copy())
+        i += taille
+    assert i == len(x)
+    return np.concatenate(spectres), np.concatenate(debuts)
+
+
+@pytest.mark.parametrize('nfft, hop', [(256, 64), (256, 256), (100, 37)])
+def test_flux_egal_hors_ligne(nfft, hop):
+    aleatoire = np.random.RandomState(1)
+    x = aleatoire.randint(-2000, 2000, (6000, 4)).astype(np.int32)
+    # blocs irreguliers : plus courts qu'une trame, vides, et plus grands que bloc_max
+    tailles = [1, 7, 0, 300, 2500, 13, 90, 1089, 2000]
+    colonnes = [2, 0, 1]
+    stft = StreamingSTFT(nfft, hop, colonnes, 50000., bloc_max=1024)
+    spectres, debuts = pousse(stft, x, tailles)
+    attendus, debuts_attendus = stft_hors_ligne(x[:, colonnes].astype(np.float64), nfft, hop)
+    np.testing.assert_array_equal(debuts, debuts_attendus)
+    assert spectres.shape == attendus.shape and spectres.dtype == np.complex64
+    np.testing.assert_allclose(spectres, attendus, rtol=0, atol=1e-5 * np.abs(attendus).max())
+    np.testing.assert_allclose(stft.freqs, np.fft.rfftfreq(nfft, 1 / 50000.))
+
+
+def test_reset():
+    x = np.random.RandomState(2).randint(-100, 100, (1000, 2)).astype(np.int32)
+    stft = StreamingSTFT(128, 32, [0, 1], 1000.)
+    premier, _ = pousse(stft, x, [1000])
+    stft.push(x[:50])
+    stft.reset()
+    second, debuts = pousse(stft, x, [500, 500])
+    np.testing.assert_allclose(second, premier, rtol=0, atol=1e-5 * np.abs(premier).max())
+    assert debuts[0] == 0
+
+
+def test_pas_invalide():
+    with pytest.raises(ValueError):
+        StreamingSTFT(128, 0, [0], 1000.)
+    with pytest.raises(ValueError):
+        StreamingSTFT(128, 129, [0], 1000.)
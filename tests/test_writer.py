@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+"""
+Ecriture asynchrone : paquets perdus quand le thread d'ecriture est bloque (un seul trou pour des
+pertes consecutives, fichier aligne) et rotation des fichiers.
+"""
+from __future__ import division
+import threading
+import time
+
+import numpy as np
+
+from megaSysteme_writer import DiskWriter
+
+S_PKT = 16          # 4 mots int32 par paquet
+
+
+class WriterBloque(DiskWriter):
+    """
+    DiskWriter dont le thread d'ecriture attend l'autorisation d'ecrire
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.autorise = threading.Event()
+        DiskWriter.__init__(self, *args, **kwargs)
+
+    def _ecrit(self, vues):
+        self.autorise.wait()
+        DiskWriter._ecrit(self, vues)
+
+
+def paquet(k):
+    return np.arange(4 * k, 4 * k + 4, dtype=np.int32).view(np.uint8)
+
+
+def test_pertes_consecutives_un_seul_trou(tmp_path):
+    fichier = str(tmp_path / 'pertes.dat')
+    writer = WriterBloque(fichier, S_PKT, n_buffers=2)
+    writer.valeur_perte = -1
+    # deux buffers occupes : les 1500 paquets suivants sont perdus (plus de IOV_MAX vues de remplissage)
+    resultats = [writer.submit(paquet(k)) for k in range(1502)]
+    assert resultats == [True, True] + [False] * 1500
+    assert writer.perdus == 1500 and list(writer.trous) == [(2, 2 * S_PKT, 1500 * S_PKT)]
+    assert writer.perte_en_cours == 1500 * S_PKT and writer.pleins.qsize() <= 2
+    writer.autorise.set()
+    while writer.libres.qsize() < 2:
+        time.sleep(0.001)
+    assert writer.submit(paquet(1502)) and writer.submit(paquet(1503))
+    writer.close()
+    mots = np.fromfile(fichier, np.int32)
+    assert len(mots) == 4 * 1504
+    attendu = np.arange(4 * 1504)
+    attendu[8:8 + 4 * 1500] = -1
+    np.testing.assert_array_equal(mots, attendu)
+    assert writer.stats()['trous'] == [(2, 2 * S_PKT, 1500 * S_PKT)]
+
+
+def test_rotation_coupe_les_paquets(tmp_path):
+    # 3 tixels de 2 voies par fichier : les paquets de 4 mots sont coupes entre deux fichiers
+    writer = DiskWriter(str(tmp_path / 'rotation.dat'), 2 * S_PKT, rotation=24, taille_tixel=8)
+    for k in range(10):
+        writer.submit(paquet(k))
+    # paquet final incomplet : le dernier tixel est tronque a la fermeture
+    writer.submit(np.arange(40, 45, dtype=np.int32).view(np.uint8))
+    writer.close()
+    morceaux = [np.fromfile(f, np.int32) for f in writer.fichiers]
+    assert [len(m) for m in morceaux] == [6] * 7 + [2]
+    assert writer.tronques == 4
+    np.testing.assert_array_equal(np.concatenate(morceaux), np.arange(44))